@@ -0,0 +1,51 @@
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+
+
+def make_dataset(folder, num_images, size=256, num_classes=3, seed=0):
+    """
+    Synthetic COCO dataset: images with random filled rectangles, one category per color, in train.json/val.json and
+    images/, the layout run.py expects of --dataset. Small enough to train on CPU, for benchmarks and trying out tools.
+
+    @return: number of classes, for --num-classes
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(folder, "images"), exist_ok=True)
+    categories = [{"id": i + 1, "name": "class_{}".format(i)} for i in range(num_classes)]
+    splits = {"train": {"images": [], "annotations": [], "categories": categories},
+              "val": {"images": [], "annotations": [], "categories": categories}}
+    annotation_id = 1
+    for image_id in range(1, num_images + 1):
+        split = splits["val" if image_id % 5 == 0 else "train"]
+        image = np.full((size, size, 3), 127, dtype=np.uint8)
+        file_name = "{:06d}.jpg".format(image_id)
+        for _ in range(rng.randint(1, 4)):
+            category = rng.randint(num_classes)
+            x, y = rng.randint(0, size - 40, size=2)
+            w, h = rng.randint(20, 40, size=2)
+            image[y:y + h, x:x + w] = 60 * (category + 1)
+            split["annotations"].append({
+                "id": annotation_id, "image_id": image_id, "category_id": category + 1, "iscrowd": 0,
+                "bbox": [int(x), int(y), int(w), int(h)], "area": int(w * h),
+                "segmentation": [[int(x), int(y), int(x + w), int(y), int(x + w), int(y + h), int(x), int(y + h)]]})
+            annotation_id += 1
+        cv2.imwrite(os.path.join(folder, "images", file_name), image)
+        split["images"].append({"id": image_id, "file_name": file_name, "width": size, "height": size})
+    for name, split in splits.items():
+        with open(os.path.join(folder, name + ".json"), "w") as f:
+            json.dump(split, f)
+    return num_classes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a synthetic COCO dataset")
+    parser.add_argument("folder", help="Output folder, use it as --dataset with a trailing /")
+    parser.add_argument("--num-images", type=int, default=40)
+    parser.add_argument("--size", type=int, default=256, help="Width and height of the images")
+    parser.add_argument("--num-classes", type=int, default=3)
+    args = parser.parse_args()
+    make_dataset(args.folder, args.num_images, args.size, args.num_classes)
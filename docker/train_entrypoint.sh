@@ -4,11 +4,5 @@
 gsutil -m cp -r gs://your-bucket-name/data ./
 unzip data/"*.zip" -d data
 
-# turn on bash's job control
-set -m 
-
-#start the primary process and put it in the background 
-# start model script
-scripts/trainer.sh $@ &
-#Run the mapwatcher as helper process
-scripts/map_watcher.sh
+# start model script, it uploads its own checkpoints and logs
+scripts/trainer.sh $@
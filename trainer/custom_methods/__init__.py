@@ -1,13 +1,43 @@
 # __init__.py
 
+from .storage_backend import StorageBackend, GCSBackend, LocalBackend, TransferPool, get_backend
+from .artifact_cache import ArtifactCache
 from .gcp_data_connection import get_available_folder, connect_to_bucket, load_checkpoint
 from .custom_parser import get_parser
+from .cluster import cluster_from_env, resolve_cluster
+from .inference_engine import BatchedPredictor, InferenceEngine
+from .prediction_export import PredictionExporter
+from .prediction_cache import PredictionCache
+from .export_model import ExportedModel, load_export, load_or_export
+from .quantization import load_or_quantize, quantization_report
+from .serving import MicroBatcher, build_server
 from .inference import inference
+from .checkpoint_sweep import sweep
 
 __all__ = [
     "get_available_folder",
     "connect_to_bucket",
+    "StorageBackend",
+    "GCSBackend",
+    "LocalBackend",
+    "TransferPool",
+    "get_backend",
+    "ArtifactCache",
     "load_checkpoint",
     "get_parser",
-    "inference"
+    "cluster_from_env",
+    "resolve_cluster",
+    "inference",
+    "sweep",
+    "BatchedPredictor",
+    "InferenceEngine",
+    "PredictionExporter",
+    "PredictionCache",
+    "ExportedModel",
+    "load_export",
+    "load_or_export",
+    "load_or_quantize",
+    "quantization_report",
+    "MicroBatcher",
+    "build_server"
 ]
\ No newline at end of file
@@ -0,0 +1,223 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+
+logger = logging.getLogger(__name__)
+
+# prefixes of the model zoo, as resolved by detectron2's checkpointer
+ZOO_PREFIXES = {
+    "detectron2://": "https://dl.fbaipublicfiles.com/detectron2/",
+}
+
+
+class BucketSource:
+    """
+    Object in the bucket, read through a StorageBackend.
+    """
+
+    def __init__(self, backend, remote_path):
+        self.backend = backend
+        self.remote_path = remote_path
+
+    def stat(self):
+        return self.backend.stat(self.remote_path)
+
+    def read_range(self, start, end, generation=None):
+        return self.backend.read_range(self.remote_path, start, end, generation)
+
+    def __str__(self):
+        return self.remote_path
+
+
+class HTTPSource:
+    """
+    File on a web server, like the model zoo. Ranges are read with Range requests, if the server supports them. The
+    ETag (or the modification time, if there is no ETag) serves as generation, http servers do not report an md5.
+    """
+
+    def __init__(self, url, timeout=60.0):
+        self.url = url
+        self.timeout = timeout
+        self.supports_ranges = False
+
+    def stat(self):
+        request = urllib.request.Request(self.url, method="HEAD")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                headers = response.headers
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        self.supports_ranges = headers.get("Accept-Ranges", "") == "bytes"
+        return {"size": int(headers["Content-Length"]), "md5": None,
+                "generation": headers.get("ETag") or headers.get("Last-Modified")}
+
+    def read_range(self, start, end, generation=None):
+        headers = {"Range": "bytes={}-{}".format(start, end - 1)}
+        if generation is not None:
+            # the server answers with the whole file instead if it changed in the meantime
+            headers["If-Range"] = generation
+        request = urllib.request.Request(self.url, headers=headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status != 206 and (start, end) != (0, int(response.headers["Content-Length"])):
+                raise IOError("{} changed during the download or does not support ranges".format(self.url))
+            return response.read()
+
+    def __str__(self):
+        return self.url
+
+
+class ArtifactCache:
+    """
+    Downloads artifacts (checkpoints, pretrained weights) to a local path, and skips the download if the local copy
+    is still the same as the remote one. Every downloaded file gets a sidecar .<file>.meta.json with the identity of
+    the remote object (size, md5, generation) and of the local file (size, modification time). A download is skipped
+    only if the remote object has the same identity as the sidecar, and the local file was not touched since.
+
+    Large files are fetched in chunks with parallel ranged requests into a temporary file, which is checked against
+    the size (and md5, if the remote reports one) before it is renamed into place, so a crashed or corrupt download is
+    never mistaken for a complete one.
+    """
+
+    def __init__(self, backend=None, workers=8, chunk_size=16 * 1024 * 1024, max_retries=3):
+        """
+        @param backend: StorageBackend of the bucket, for bucket paths and the model zoo mirror
+        @param workers: parallel range requests per file
+        @param chunk_size: bytes per range request, smaller files are fetched in one request
+        """
+        self.backend = backend
+        self.workers = max(1, int(workers))
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+
+    @staticmethod
+    def _meta_path(local_path):
+        # hidden, like the temporary download, so the artifact uploader skips it
+        directory, name = os.path.split(local_path)
+        return os.path.join(directory, "." + name + ".meta.json")
+
+    def is_current(self, local_path, remote):
+        """
+        @param remote: stat of the remote object
+        @return: whether local_path is a verified copy of it
+        """
+        meta_path = self._meta_path(local_path)
+        if not (os.path.isfile(local_path) and os.path.isfile(meta_path)):
+            return False
+        with open(meta_path) as file:
+            meta = json.load(file)
+        local = os.stat(local_path)
+        return (meta.get("remote") == remote and meta.get("local_size") == local.st_size
+                and meta.get("local_mtime_ns") == local.st_mtime_ns)
+
+    def fetch(self, remote_path, local_path):
+        """
+        Copies remote_path from the bucket to local_path, unless the copy there is still current.
+
+        @return: local_path
+        """
+        return self.fetch_source(BucketSource(self.backend, remote_path), local_path)
+
+    def fetch_source(self, source, local_path):
+        start = time.perf_counter()
+        remote = source.stat()
+        if remote is None:
+            raise FileNotFoundError("{} does not exist".format(source))
+        if self.is_current(local_path, remote):
+            logger.info("{} is up to date with {}, skipping the download".format(local_path, source))
+            return local_path
+
+        directory = os.path.dirname(local_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".download_")
+        try:
+            ranges = [(offset, min(offset + self.chunk_size, remote["size"]))
+                      for offset in range(0, remote["size"], self.chunk_size)]
+            os.ftruncate(fd, remote["size"])
+
+            def fetch_range(byte_range):
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        data = source.read_range(byte_range[0], byte_range[1], remote["generation"])
+                        break
+                    except Exception:
+                        if attempt == self.max_retries:
+                            raise
+                        time.sleep(0.5 * 2 ** attempt)
+                if len(data) != byte_range[1] - byte_range[0]:
+                    raise IOError("Got {} bytes of range {} of {}".format(len(data), byte_range, source))
+                os.pwrite(fd, data, byte_range[0])
+
+            if len(ranges) > 1 and getattr(source, "supports_ranges", True):
+                with ThreadPoolExecutor(min(self.workers, len(ranges)), thread_name_prefix="range") as pool:
+                    list(pool.map(fetch_range, ranges))
+            elif ranges:
+                fetch_range((0, remote["size"]))
+            os.close(fd)
+            fd = None
+            self._verify(tmp_path, remote, source)
+            os.replace(tmp_path, local_path)
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        local = os.stat(local_path)
+        with open(self._meta_path(local_path), "w") as file:
+            json.dump({"source": str(source), "remote": remote, "local_size": local.st_size,
+                       "local_mtime_ns": local.st_mtime_ns}, file)
+        seconds = time.perf_counter() - start
+        logger.info("Downloaded {} ({:.1f} MB) in {:.1f}s, {:.1f} MB/s".format(
+            source, remote["size"] / 1e6, seconds, remote["size"] / 1e6 / max(seconds, 1e-9)))
+        return local_path
+
+    @staticmethod
+    def _verify(path, remote, source):
+        size = os.path.getsize(path)
+        if size != remote["size"]:
+            raise IOError("Download of {} has {} bytes instead of {}".format(source, size, remote["size"]))
+        if remote.get("md5"):
+            digest = hashlib.md5()
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(chunk)
+            if base64.b64encode(digest.digest()).decode() != remote["md5"]:
+                raise IOError("Download of {} does not match its md5".format(source))
+
+    def fetch_weights(self, weights, cache_dir):
+        """
+        Local copy of model zoo weights like detectron2://ImageNetPretrained/MSRA/R-101.pkl. They are mirrored to
+        model_zoo/ in the bucket the first time, later jobs get them from there. Local paths and unknown schemes are
+        returned unchanged, for the checkpointer to handle.
+
+        @return: local path of the weights
+        """
+        for prefix, base_url in ZOO_PREFIXES.items():
+            if weights.startswith(prefix):
+                url = base_url + weights[len(prefix):]
+                break
+        else:
+            if not weights.startswith(("http://", "https://")):
+                return weights
+            url = weights
+
+        relative_path = "model_zoo/" + url.split("://", 1)[1]
+        local_path = os.path.join(cache_dir, relative_path)
+        if self.backend is not None and self.backend.stat(relative_path) is not None:
+            return self.fetch(relative_path, local_path)
+
+        self.fetch_source(HTTPSource(url), local_path)
+        if self.backend is not None:
+            self.backend.upload(local_path, relative_path)
+            logger.info("Mirrored {} to {} in the bucket".format(url, relative_path))
+        return local_path
@@ -0,0 +1,253 @@
+import csv
+import logging
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import torch
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.data import DatasetCatalog
+from detectron2.evaluation import COCOEvaluator
+from detectron2.modeling import build_model
+
+from custom_trainers.streaming_evaluator import StreamingCOCOEvaluator
+from .artifact_cache import ArtifactCache
+from .gcp_data_connection import connect_to_bucket
+from .inference_engine import BatchedPredictor
+from .storage_backend import TransferPool
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PATTERN = re.compile(r"model_(\d+|final)\.pth$")
+
+
+def list_checkpoints(bucket, output_dir):
+    """
+    @return: iterations of the checkpoints of output_dir in the bucket, in training order with final last
+    """
+    names, _ = bucket.list(prefix=output_dir + "/", delimiter="/")
+    iterations = [m.group(1) for m in (CHECKPOINT_PATTERN.search(name) for name in names) if m]
+    return sorted(iterations, key=lambda it: (it == "final", int(it) if it != "final" else 0))
+
+
+def parse_checkpoints(specs, available=None):
+    """
+    @param specs: iterations like 0004999 or 4999, final, all, or an inclusive range start:stop:step like
+                  4999:19999:5000
+    @param available: iterations that exist, needed for "all"
+    @return: list of checkpoint iterations as they are named in the bucket, without duplicates
+    """
+    checkpoints = []
+    for spec in specs:
+        if spec == "all":
+            if available is None:
+                raise ValueError("Cannot sweep all checkpoints without a list of the available ones")
+            checkpoints.extend(available)
+        elif spec == "final":
+            checkpoints.append(spec)
+        elif ":" in spec:
+            parts = [int(part) for part in spec.split(":")]
+            start, stop, step = parts[0], parts[1], parts[2] if len(parts) > 2 else 1
+            checkpoints.extend("{:07d}".format(it) for it in range(start, stop + 1, step))
+        else:
+            checkpoints.append("{:07d}".format(int(spec)))
+    return list(OrderedDict.fromkeys(checkpoints))
+
+
+class PreprocessedInputs:
+    """
+    Validation inputs of a sweep. Images are read and preprocessed once and shared by all checkpoints, up to
+    max_bytes: the resized images are kept as uint8, which is lossless as they are only converted to float by the
+    predictor, and four times smaller. The images past max_bytes are read again for every checkpoint, in the decode
+    threads ahead of the model, so memory stays bounded on a large validation set.
+    """
+
+    def __init__(self, predictor, records, workers=4, max_bytes=4 * 2 ** 30):
+        self._predictor = predictor
+        self._records = records
+        self._workers = max(1, workers)
+        self._cached = []
+        self.nbytes = 0
+        # in chunks, so no more than a chunk is decoded past the limit
+        chunk = 4 * self._workers
+        with ThreadPoolExecutor(self._workers, thread_name_prefix="decode") as pool:
+            for start in range(0, len(records), chunk):
+                if self.nbytes >= max_bytes:
+                    break
+                for model_input in pool.map(self._load, records[start:start + chunk]):
+                    self._cached.append(model_input)
+                    self.nbytes += model_input["image"].numel()
+        if len(self._cached) < len(records):
+            logger.info("Kept {} of {} preprocessed images in memory ({:.0f} MB), the others are read for every "
+                        "checkpoint".format(len(self._cached), len(records), self.nbytes / 2 ** 20))
+
+    def _load(self, record):
+        model_input = self._predictor.preprocess(cv2.imread(record["file_name"]))
+        model_input["image"] = model_input["image"].to(torch.uint8)
+        # for the evaluator
+        model_input["image_id"] = record["image_id"]
+        return model_input
+
+    def __len__(self):
+        return len(self._records)
+
+    def batches(self, batch_size):
+        """
+        @return: generator of lists of at most batch_size model inputs, over all records
+        """
+        for start in range(0, len(self._cached), batch_size):
+            yield self._cached[start:start + batch_size]
+        rest = self._records[len(self._cached):]
+        if not rest:
+            return
+        with ThreadPoolExecutor(self._workers, thread_name_prefix="decode") as pool:
+            pending = deque()
+            batch = []
+            for record in rest:
+                pending.append(pool.submit(self._load, record))
+                # reads ahead at most two batches
+                if len(pending) < 2 * batch_size:
+                    continue
+                batch.append(pending.popleft().result())
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            while pending:
+                batch.append(pending.popleft().result())
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+
+def evaluate_checkpoint(predictor, inputs, evaluator, batch_size=4):
+    """
+    Runs all inputs through the current weights of the predictor. Matching against the ground truth happens in a
+    second thread, overlapped with the next batch.
+
+    @param inputs: PreprocessedInputs
+    @return: results of the evaluator
+    """
+    evaluator.reset()
+    with ThreadPoolExecutor(1, thread_name_prefix="evaluate") as evaluate_pool:
+        pending = None
+        for batch in inputs.batches(batch_size):
+            outputs = predictor.predict([dict(model_input, image=model_input["image"].float())
+                                         for model_input in batch])
+            outputs = [{"instances": output["instances"].to("cpu")} for output in outputs]
+            if pending is not None:
+                pending.result()
+            pending = evaluate_pool.submit(evaluator.process, batch, outputs)
+        if pending is not None:
+            pending.result()
+    return evaluator.evaluate()
+
+
+def build_sweep_evaluator(cfg, dataset_name, kind="coco"):
+    """
+    @param kind: coco for detectron2's COCOEvaluator, streaming for the StreamingCOCOEvaluator (approximate metrics)
+    """
+    tasks = ("bbox", "segm") if cfg.MODEL.MASK_ON else ("bbox",)
+    if kind == "streaming":
+        return StreamingCOCOEvaluator(dataset_name, tasks=tasks)
+    return COCOEvaluator(dataset_name, tasks=tasks, distributed=False)
+
+
+def write_sweep_table(rows, output_dir, note=""):
+    """
+    Writes the results per checkpoint to sweep_results.csv and sweep_results.md in output_dir.
+
+    @param rows: list of OrderedDicts, one per checkpoint
+    @param note: line above the markdown table, like how the metrics were computed
+    @return: paths of the written files
+    """
+    columns = list(OrderedDict.fromkeys(column for row in rows for column in row))
+    csv_path = os.path.join(output_dir, "sweep_results.csv")
+    with open(csv_path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=columns, restval="")
+        writer.writeheader()
+        writer.writerows(rows)
+
+    def cell(value):
+        return "{:.2f}".format(value) if isinstance(value, float) else str(value)
+
+    md_path = os.path.join(output_dir, "sweep_results.md")
+    with open(md_path, "w") as file:
+        if note:
+            file.write(note + "\n\n")
+        file.write("| " + " | ".join(columns) + " |\n")
+        file.write("|" + "---|" * len(columns) + "\n")
+        for row in rows:
+            file.write("| " + " | ".join(cell(row.get(column, "")) for column in columns) + " |\n")
+    return csv_path, md_path
+
+
+def sweep(cfg, args):
+    """
+    Evaluates several checkpoints of the run of --eval-name in one job, as given by --checkpoints. The model is built
+    once and only the weights are swapped, the validation images are read and preprocessed once (up to
+    --sweep-cache-mb, the rest is read per checkpoint), and checkpoints are
+    downloaded in the background while earlier ones are evaluated. The COCO metrics of all checkpoints end up in one
+    table, sweep_results.csv/.md in the output folder (and the bucket). They are exact with --sweep-evaluator coco,
+    the default, and approximate with streaming, which the table says in its evaluator column.
+
+    The score threshold of the config is used, so not the one of --score-thresh, as AP needs the low scores as well.
+    """
+    bucket = connect_to_bucket(args.bucket)
+    available = list_checkpoints(bucket, cfg.OUTPUT_DIR)
+    checkpoints = parse_checkpoints(args.checkpoints, available)
+    missing = [checkpoint for checkpoint in checkpoints if checkpoint not in available]
+    if missing:
+        # ranges do not have to line up with the checkpoint period exactly
+        logger.warning("Skipping checkpoints that are not in the bucket: {}".format(", ".join(missing)))
+        checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint in available]
+    if not checkpoints:
+        raise Exception("No checkpoints to sweep, check --checkpoints.")
+    os.makedirs(cfg.OUTPUT_DIR, exist_ok=True)
+    logger.info("Sweeping checkpoints {}".format(", ".join(checkpoints)))
+
+    rows = []
+    with TransferPool(bucket, max_workers=args.transfer_workers) as transfers:
+        paths = [os.path.join(cfg.OUTPUT_DIR, "model_" + checkpoint + ".pth") for checkpoint in checkpoints]
+        # checkpoints that were downloaded before and did not change are not downloaded again
+        cache = ArtifactCache(bucket, workers=args.download_workers)
+        downloads = [transfers.submit(cache.fetch, path, path) for path in paths]
+
+        start = time.perf_counter()
+        # built once, without weights as those are loaded per checkpoint
+        model = build_model(cfg)
+        model.eval()
+        checkpointer = DetectionCheckpointer(model)
+        predictor = BatchedPredictor(cfg, model)
+        records = DatasetCatalog.get(args.eval_dataset)
+        inputs = PreprocessedInputs(predictor, records, args.decode_workers, args.sweep_cache_mb * 2 ** 20)
+        evaluator = build_sweep_evaluator(cfg, args.eval_dataset, args.sweep_evaluator)
+        logger.info("Preprocessed {} validation images in {:.1f}s".format(len(inputs), time.perf_counter() - start))
+
+        evaluator_label = "COCOEvaluator" if args.sweep_evaluator == "coco" else "streaming (approximate)"
+        for checkpoint, path, download in zip(checkpoints, paths, downloads):
+            download.result()
+            start = time.perf_counter()
+            checkpointer.load(path)
+            results = evaluate_checkpoint(predictor, inputs, evaluator, args.inference_batch_size)
+
+            row = OrderedDict([("checkpoint", checkpoint), ("evaluator", evaluator_label)])
+            for task, metrics in results.items():
+                for metric, value in metrics.items():
+                    row["{}/{}".format(task, metric)] = value
+            row["seconds"] = time.perf_counter() - start
+            rows.append(row)
+            logger.info("Checkpoint {}: ".format(checkpoint) + ", ".join(
+                "{} {:.2f}".format(key, value) for key, value in row.items() if key.endswith("/AP")))
+
+        if rows:
+            note = "COCO metrics of detectron2's COCOEvaluator." if args.sweep_evaluator == "coco" else \
+                "Approximate COCO metrics of the StreamingCOCOEvaluator (scores binned), use --sweep-evaluator coco " \
+                "for the exact ones."
+            for path in write_sweep_table(rows, cfg.OUTPUT_DIR, note):
+                transfers.upload(path, path)
+    return rows
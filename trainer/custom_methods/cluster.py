@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# task types of the machine that gets rank 0, AI Platform calls it master and TF_CONFIG chief
+MASTER_TASKS = ("master", "chief")
+DEFAULT_PORT = 2222
+
+
+def cluster_from_env(environ=None):
+    """
+    Reads the cluster of a multi-machine job from CLUSTER_SPEC (AI Platform) or TF_CONFIG, which look like
+    {"cluster": {"master": ["host:2222"], "worker": ["host-0:2222", ...]}, "task": {"type": "worker", "index": 0}}.
+    The master machine gets rank 0, the workers 1 and up in the order of their index, and the address of the master
+    is the rendezvous of torch.distributed. Parameter servers and evaluators are not part of the training.
+
+    @return: (number of machines, rank of this machine, dist_url), None if there is no cluster spec
+    """
+    environ = os.environ if environ is None else environ
+    for variable in ("CLUSTER_SPEC", "TF_CONFIG"):
+        if environ.get(variable):
+            spec = json.loads(environ[variable])
+            break
+    else:
+        return None
+
+    cluster = spec.get("cluster", {})
+    task = spec.get("task", {})
+    masters = [address for task_type in MASTER_TASKS for address in cluster.get(task_type, [])]
+    workers = cluster.get("worker", [])
+    machines = masters + workers
+    if len(masters) != 1:
+        raise ValueError("{} should have one master or chief, got {}".format(variable, masters))
+
+    task_type, index = task.get("type", "master"), int(task.get("index", 0))
+    if task_type in MASTER_TASKS:
+        machine_rank = 0
+    elif task_type == "worker":
+        machine_rank = 1 + index
+    else:
+        raise ValueError("{} task {} does not take part in training".format(variable, task_type))
+    if machine_rank >= len(machines):
+        raise ValueError("{} task {} {} is not in the cluster".format(variable, task_type, index))
+
+    host, _, port = masters[0].rpartition(":")
+    if not host:
+        host, port = masters[0], DEFAULT_PORT
+    return len(machines), machine_rank, "tcp://{}:{}".format(host, port)
+
+
+def resolve_cluster(args, environ=None):
+    """
+    Sets args.num_machines, args.machine_rank and args.dist_url from the cluster spec of the environment, for the ones
+    that are not given on the command line. Without a cluster spec it is a single machine job.
+    """
+    spec = cluster_from_env(environ) or (1, 0, "auto")
+    for name, value in zip(("num_machines", "machine_rank", "dist_url"), spec):
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+    if args.num_machines > 1 and args.dist_url == "auto":
+        raise ValueError("--dist-url auto only works on one machine, set it to tcp://<address of machine 0>:<port>")
+    if args.num_machines > 1:
+        logger.info("Machine {} of {}, rendezvous at {}".format(args.machine_rank, args.num_machines, args.dist_url))
+    return args
@@ -1,10 +1,23 @@
 import argparse
 
 
+class ArgumentParser(argparse.ArgumentParser):
+    """
+    ArgumentParser that also rejects arguments that can not be combined, for run.py and the tools that extend it.
+    """
+
+    def parse_known_args(self, args=None, namespace=None):
+        args, extras = super().parse_known_args(args, namespace)
+        if getattr(args, "export_model", "none") != "none" and getattr(args, "quantize", "none") != "none":
+            # the int8 model of --quantize is a TorchScript export of its own
+            self.error("--export-model can not be combined with --quantize, the quantized model replaces the export")
+        return args, extras
+
+
 def get_parser():
     #######################################################################################################
     # MODEL ARGUMENTS
-    parser = argparse.ArgumentParser(description="Detectron2 demo for builtin configs")
+    parser = ArgumentParser(description="Detectron2 demo for builtin configs")
     parser.add_argument("--config-file", default="",  # has to be a valid path, model checks before use
                         metavar="FILE", help="path to config file",
                         )
@@ -12,12 +25,30 @@ def get_parser():
                         help="Name of this run which is set as output folder. Set through ai platform job name.",
                         )
     parser.add_argument("--local", action="store_true", help="If local, ask for run-name in terminal.", )
-    parser.add_argument("--bucket", default="vehicle-damage", help="Specify the bucket to work with")
+    parser.add_argument("--bucket", default="vehicle-damage",
+                        help="Specify the bucket to work with, file:///some/folder uses a local folder instead")
+    parser.add_argument("--transfer-workers", type=int, default=8,
+                        help="Number of concurrent uploads/downloads to the bucket")
+    parser.add_argument("--upload-timeout", type=float, default=600,
+                        help="Seconds the end of training waits for the last uploads of the run")
+    parser.add_argument("--download-workers", type=int, default=8,
+                        help="Parallel range requests per checkpoint or pretrained weights download")
     parser.add_argument("--num-gpus", type=int, default=1, help="number of gpus *per machine*")
+    parser.add_argument("--num-machines", type=int, default=None,
+                        help="Number of machines of the training job, read from CLUSTER_SPEC or TF_CONFIG if not set")
+    parser.add_argument("--machine-rank", type=int, default=None,
+                        help="Rank of this machine, 0 is the master, read from CLUSTER_SPEC or TF_CONFIG if not set")
+    parser.add_argument("--dist-url", default=None,
+                        help="tcp://<address>:<port> of machine 0, auto on a single machine. Read from CLUSTER_SPEC "
+                             "or TF_CONFIG if not set")
     # goal specific arguments, like training with previous weights, normal training or inference
     parser.add_argument("--architecture", default="",
-                        help="If you want to use AdelaiDet to for example use Blendmask, specify this here",
+                        help="If you want to use AdelaiDet to for example use Blendmask, specify this here: adet, "
+                             "d2go or detectron2 (default). Only the backend of this architecture is imported.",
                         )
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Log the time of every startup phase (imports, config, dataset registration, model "
+                             "build, checkpoint load) up to the first iteration, and write it to startup_profile.json")
     parser.add_argument("--dataset", default="./data/",
                         help="""Enter name of the to be processed dataset, with trailing _. Default is './data/', 
                         example is './data/synth_'.""",
@@ -41,6 +72,17 @@ def get_parser():
                         help="Starts a new run with weights from checkpoint defined by --eval-run and --checkpoint")
     parser.add_argument("--eval-only", action="store_true", help="perform evaluation only")
     parser.add_argument("--checkpoint", help="Specify the iteration number or *final*.", default="")
+    parser.add_argument("--checkpoints", nargs='+', default=[],
+                        help="With --eval-only, evaluate several checkpoints of --eval-name in one job instead of "
+                             "--checkpoint, e.g. 4999 9999 final, a range 4999:19999:5000 or all. Writes a table "
+                             "with the COCO metrics per checkpoint to sweep_results.csv/.md")
+    parser.add_argument("--sweep-evaluator", default="coco", choices=["coco", "streaming"],
+                        help="Evaluator of --checkpoints: coco is detectron2's COCOEvaluator (exact COCO metrics), "
+                             "streaming the StreamingCOCOEvaluator, which keeps no predictions in memory but bins the "
+                             "scores, so its metrics are approximate")
+    parser.add_argument("--sweep-cache-mb", type=int, default=4096,
+                        help="Memory for the preprocessed validation images that --checkpoints shares between the "
+                             "checkpoints, the images past it are read again for every checkpoint")
     parser.add_argument("--eval-name",
                         help="This should be the same name of the run that is being evaluated. Sets output folder, "
                              "just as --run-name, but as this is set through GCP and has to be unique, a second "
@@ -48,9 +90,113 @@ def get_parser():
                         default=""
                         )
     parser.add_argument("--iterations", help="Specify the additional number of iterations if --resume.", default="")
+    parser.add_argument("--score-thresh", type=float, default=0.7, help="Score threshold of the predictions")
+    parser.add_argument("--prediction-cache", default="",
+                        help="With --eval-only, folder of a cache of raw model outputs per checkpoint and image, which "
+                             "is kept in the bucket as well. Cached images skip the model, so only threshold, render "
+                             "and export changes are fast to rerun. Off if empty.")
+    parser.add_argument("--cache-score-floor", type=float, default=0.05,
+                        help="Score threshold the cached raw outputs are made with, --score-thresh can be anything "
+                             "above it without a new forward pass")
+    parser.add_argument("--eval-dataset", default="car_damage_val", help="Registered dataset to run --eval-only on")
+    parser.add_argument("--eval-workers", type=int, default=1,
+                        help="Split --eval-only inference over this many processes, one GPU each or a part of the CPU "
+                             "cores. Their predictions are merged at the end.")
+    parser.add_argument("--inference-batch-size", type=int, default=1,
+                        help="Number of images per forward pass with --eval-only. Padding in a batch can change "
+                             "detections at the edges of smaller images, so the first batch is checked against "
+                             "per-image predictions and the difference is logged. 1 gives the exact per-image results")
+    parser.add_argument("--decode-workers", type=int, default=4,
+                        help="Threads that read and preprocess images ahead of the model with --eval-only")
+    parser.add_argument("--output-workers", type=int, default=4,
+                        help="Threads that render, write and upload predictions with --eval-only")
+    parser.add_argument("--export-format", default="images", choices=["images", "jsonl"],
+                        help="With --eval-only, render every image (images) or stream the predictions to a COCO "
+                             "results predictions.jsonl (jsonl)")
+    parser.add_argument("--render-fraction", type=float, default=None,
+                        help="Part of the images that is rendered with --eval-only. Defaults to all images with "
+                             "--export-format images and none with jsonl.")
+    parser.add_argument("--renderer", default="fast", choices=["fast", "visualizer"],
+                        help="Draw predictions with the OpenCV renderer (fast) or detectron2's Visualizer")
+    parser.add_argument("--export-model", default="none", choices=["none", "tracing", "scripting"],
+                        help="With --eval-only, run a TorchScript export of the checkpoint instead of the eager model. "
+                             "The export is cached next to the checkpoint. Scripting only supports GeneralizedRCNN. "
+                             "Not with --quantize.")
+    parser.add_argument("--export-check-images", type=int, default=4,
+                        help="Number of validation images the export is checked on against the eager model")
+    parser.add_argument("--quantize", default="none", choices=["none", "int8"],
+                        help="With --eval-only, run a post-training int8 quantized model (through D2Go, CPU only). Not "
+                             "with --export-model, the int8 model is a TorchScript export of its own")
+    parser.add_argument("--quant-calib-images", type=int, default=100,
+                        help="Number of car_damage_train images the int8 model is calibrated on")
+    parser.add_argument("--quant-backend", default="fbgemm", choices=["fbgemm", "qnnpack"],
+                        help="Quantized kernels, fbgemm for x86 servers and qnnpack for ARM/mobile")
+    parser.add_argument("--quant-report", action="store_true",
+                        help="Compare latency, size and AP of the float and int8 models on --eval-dataset")
+    parser.add_argument("--streaming-eval", action="store_true",
+                        help="Match predictions against ground truth as they arrive during evaluation, so memory does "
+                             "not grow with the size of the validation set.")
+    parser.add_argument("--stream-predictions", action="store_true",
+                        help="With --streaming-eval, also write the predictions to a jsonl file per rank.")
+    parser.add_argument("--precision", default=None, choices=["fp32", "mixed", "fp16", "bf16"],
+                        help="Training precision of the detectron2 and AdelaiDet trainers. mixed is fp16 autocast with "
+                             "loss scaling on GPU and bfloat16 autocast on CPU. bf16 (and so mixed on CPU) needs "
+                             "torch 1.10 or later, the pinned torch 1.9 only has fp16 autocast on GPU. Defaults to "
+                             "SOLVER.AMP.ENABLED of the config (mixed if it is set, fp32 otherwise)")
+    parser.add_argument("--sync-checkpoint", action="store_true",
+                        help="Save checkpoints in the training loop, instead of copying them to host memory and "
+                             "writing them in the background")
+    parser.add_argument("--keep-last", type=int, default=3,
+                        help="Number of most recent periodic checkpoints that are kept, locally and in the bucket. "
+                             "0 keeps all of them.")
+    parser.add_argument("--keep-best", type=int, default=1,
+                        help="Number of periodic checkpoints with the best --best-metric that are kept as well")
+    parser.add_argument("--best-metric", default="segm/AP",
+                        help="Validation metric of --keep-best, higher is better, e.g. segm/AP or bbox/AP")
+    parser.add_argument("--early-stop-metric", default="",
+                        help="Stop training when this validation metric stops improving, e.g. validation_loss "
+                             "(lower is better) or segm/AP (higher is better). The best model is saved as model_best")
+    parser.add_argument("--patience", type=int, default=5,
+                        help="Evaluations without improvement of --early-stop-metric before training stops")
+    parser.add_argument("--min-delta", type=float, default=0.0,
+                        help="Smallest change of --early-stop-metric that counts as an improvement")
+    parser.add_argument("--max-hours", type=float, default=0.0,
+                        help="Wall-clock budget of the training in hours, training stops before it runs out. 0 is none")
+    parser.add_argument("--max-gpu-hours", type=float, default=0.0,
+                        help="Budget in hours times the number of training processes of the job (GPUs). 0 is none")
+    parser.add_argument("--phase-timing", action="store_true",
+                        help="Time the data loading, forward, backward, optimizer step, checkpointing and hooks of "
+                             "every iteration, as percentiles in the metrics and per iteration in phase_times.jsonl")
+    parser.add_argument("--starvation-threshold", type=float, default=0.05,
+                        help="With --phase-timing, seconds of waiting on the data loader after which an iteration "
+                             "counts as starved")
+    parser.add_argument("--profile-window", type=int, nargs=2, default=None, metavar=("START", "END"),
+                        help="Capture a torch.profiler trace of the iterations START up to END, to profiler/ in the "
+                             "output folder")
+    parser.add_argument("--profile-on-demand", action="store_true",
+                        help="Capture a trace of --profile-steps iterations when a training process gets SIGUSR1 or "
+                             "when the file profile_trigger is created in the output folder")
+    parser.add_argument("--profile-steps", type=int, default=10, help="Iterations of an on demand trace")
+    parser.add_argument("--memory-tracking", action="store_true",
+                        help="Report the RSS/PSS/USS of the training process and its data loader workers as memory/ "
+                             "metrics every 20 iterations")
+    parser.add_argument("--shared-dataset", action="store_true",
+                        help="Keep the training dataset dicts in one serialized read-only buffer per machine, shared "
+                             "by all training processes and data loader workers, instead of a list per process")
     #######################################################################################################
     # ADD HYPERTUNE ARGUMENTS HERE FOR HYPERPARAMETER TUNING (for example --lr)
     parser.add_argument("--batchsize", default=2)
+    parser.add_argument("--accumulation-steps", type=int, default=1,
+                        help="Split every batch of --batchsize images in this many micro-batches, whose gradients are "
+                             "summed before the optimizer step. Needs memory for one micro-batch only")
+    parser.add_argument("--scale-schedule", action="store_true",
+                        help="Scale the learning rate and iterations of the config linearly from its "
+                             "SOLVER.IMS_PER_BATCH to --batchsize")
+    parser.add_argument("--report-metrics", nargs='+', default=["total_loss"],
+                        help="Metrics that are reported to the metric sinks, e.g. total_loss validation_loss")
+    parser.add_argument("--metric-sinks", nargs='+', default=["hypertune"],
+                        choices=["hypertune", "jsonl", "tensorboard"],
+                        help="Where the reported metrics are written to, hypertune is needed for hyperparameter tuning")
     #######################################################################################################
     # FILTER ARGUMENTS
     parser.add_argument("--filter", action='store_true', help="Set to true if filtering is required")
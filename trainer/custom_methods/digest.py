@@ -0,0 +1,20 @@
+import hashlib
+
+
+def file_digest(file_path: str, algorithm: str = "sha256", chunk_size: int = 1 << 20) -> str:
+    """
+    @param file_path: file to hash, read in chunks so large checkpoints are not loaded in memory
+    @return: hex digest of the contents
+    """
+    digest = hashlib.new(algorithm)
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bytes_digest(data: bytes, algorithm: str = "sha256") -> str:
+    """
+    @return: hex digest of data
+    """
+    return hashlib.new(algorithm, data).hexdigest()
@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import time
+
+import torch
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.export import TracingAdapter, scripting_with_instances
+from detectron2.modeling import build_model
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Boxes, Instances
+
+from .digest import file_digest
+
+logger = logging.getLogger(__name__)
+
+# fields of the outputs of GeneralizedRCNN, needed to script the Instances class
+RCNN_SCRIPTING_FIELDS = {
+    "proposal_boxes": Boxes,
+    "objectness_logits": torch.Tensor,
+    "pred_boxes": Boxes,
+    "scores": torch.Tensor,
+    "pred_classes": torch.Tensor,
+    "pred_masks": torch.Tensor,
+}
+
+
+class ExportedModel:
+    """
+    Wraps a TorchScript export so it can be called like the eager model: it takes a list of model inputs and returns
+    a list of {"instances": Instances}, rescaled to the original image size. Exports take one image at a time, so
+    the images of a batch are run one after the other.
+    """
+
+    def __init__(self, ts_model, mode, outputs_schema=None):
+        """
+        @param ts_model: traced or scripted module
+        @param mode: "tracing" or "scripting"
+        @param outputs_schema: schema of the TracingAdapter, to rebuild the outputs of a traced model
+        """
+        self.ts_model = ts_model
+        self.mode = mode
+        self.outputs_schema = outputs_schema
+
+    def __call__(self, inputs):
+        outputs = []
+        for model_input in inputs:
+            image = model_input["image"]
+            if self.mode == "tracing":
+                instances = self.outputs_schema(self.ts_model(image))[0]["instances"]
+            else:
+                scripted = self.ts_model([{"image": image}])[0]["instances"]
+                instances = Instances(tuple(image.shape[-2:]))
+                for name in RCNN_SCRIPTING_FIELDS:
+                    if scripted.has(name):
+                        instances.set(name, getattr(scripted, name))
+            # exports only see the image, so they predict at the resized size
+            height = model_input.get("height", image.shape[-2])
+            width = model_input.get("width", image.shape[-1])
+            outputs.append({"instances": detector_postprocess(instances, height, width)})
+        return outputs
+
+
+def export_paths(weights_path, mode, device):
+    """
+    @return: paths of the exported model, its output schema and its meta file, next to the checkpoint
+    """
+    base = os.path.splitext(weights_path)[0] + ".{}.{}".format(mode, device)
+    return base + ".ts", base + ".schema.pth", base + ".json"
+
+
+def export_model(model, sample_input, mode):
+    """
+    @param model: eager model in eval mode
+    @param sample_input: a single preprocessed model input, only its image is used
+    @param mode: "tracing" (D2 and AdelaiDet meta-architectures) or "scripting" (GeneralizedRCNN only)
+    @return: ExportedModel
+    """
+    # the transfer to the model device is part of the traced graph, so trace with the cpu image
+    image = sample_input["image"]
+    if mode == "tracing":
+        adapter = TracingAdapter(model, [{"image": image}])
+        with torch.no_grad():
+            ts_model = torch.jit.trace(adapter, adapter.flattened_inputs)
+        return ExportedModel(ts_model, mode, adapter.outputs_schema)
+    if mode == "scripting":
+        if type(model).__name__ != "GeneralizedRCNN":
+            raise ValueError("Scripting is only supported for GeneralizedRCNN, use tracing for "
+                             + type(model).__name__)
+        return ExportedModel(scripting_with_instances(model, RCNN_SCRIPTING_FIELDS), mode)
+    raise ValueError("Unknown export mode: {}".format(mode))
+
+
+def outputs_match(expected, actual, atol=1e-2):
+    """
+    Compares the outputs of the eager model with those of the export, image by image.
+    """
+    for expected_output, actual_output in zip(expected, actual):
+        a, b = expected_output["instances"].to("cpu"), actual_output["instances"].to("cpu")
+        if len(a) != len(b):
+            return False
+        if len(a) == 0:
+            continue
+        if not torch.equal(a.pred_classes, b.pred_classes):
+            return False
+        if not torch.allclose(a.scores, b.scores, atol=atol):
+            return False
+        if not torch.allclose(a.pred_boxes.tensor, b.pred_boxes.tensor, atol=max(atol * 100, 1.0)):
+            return False
+        if a.has("pred_masks") and b.has("pred_masks"):
+            disagreement = (a.pred_masks != b.pred_masks).float().mean().item()
+            if disagreement > atol:
+                return False
+    return True
+
+
+def load_export(cfg, mode, bucket=None):
+    """
+    Loads the export of cfg.MODEL.WEIGHTS if one was made before (locally or in the bucket) for the same checkpoint
+    and score threshold.
+
+    @return: the ExportedModel, None if there is no such export
+    """
+    start = time.perf_counter()
+    ts_path, schema_path, meta_path = export_paths(cfg.MODEL.WEIGHTS, mode, cfg.MODEL.DEVICE)
+
+    if bucket is not None and not os.path.isfile(meta_path):
+        try:
+            for path in (meta_path, ts_path, schema_path):
+                bucket.download(path, path)
+        except Exception:
+            # not exported before, or only partly
+            pass
+
+    if os.path.isfile(meta_path) and os.path.isfile(ts_path):
+        with open(meta_path) as file:
+            meta = json.load(file)
+        # the score threshold is part of the exported graph
+        if (meta.get("checkpoint_digest") == file_digest(cfg.MODEL.WEIGHTS)
+                and meta.get("score_thresh") == cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST):
+            ts_model = torch.jit.load(ts_path, map_location=cfg.MODEL.DEVICE)
+            schema = torch.load(schema_path) if os.path.isfile(schema_path) else None
+            logger.info("Loaded {} export of the checkpoint in {:.2f}s".format(mode, time.perf_counter() - start))
+            return ExportedModel(ts_model, mode, schema)
+        logger.info("Export at {} is of another checkpoint or threshold".format(ts_path))
+    return None
+
+
+def load_or_export(cfg, mode, sample_inputs, bucket=None):
+    """
+    Loads the export of cfg.MODEL.WEIGHTS if one was made before (see load_export), otherwise builds the eager model,
+    exports it, checks its outputs against the eager model on sample_inputs and saves it next to the checkpoint (and
+    uploads it, if a bucket is given).
+
+    @param cfg: frozen config with MODEL.WEIGHTS set to a local checkpoint
+    @param mode: "tracing" or "scripting"
+    @param sample_inputs: a few preprocessed model inputs
+    @param bucket: optional StorageBackend to cache the export in
+    @return: tuple of (model, exported), the model is the eager model if the export does not match its outputs
+    """
+    exported = load_export(cfg, mode, bucket)
+    if exported is not None:
+        return exported, True
+
+    start = time.perf_counter()
+    ts_path, schema_path, meta_path = export_paths(cfg.MODEL.WEIGHTS, mode, cfg.MODEL.DEVICE)
+    checkpoint_digest = file_digest(cfg.MODEL.WEIGHTS)
+
+    model = build_model(cfg)
+    model.eval()
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    logger.info("Built eager model in {:.2f}s".format(time.perf_counter() - start))
+
+    try:
+        exported = export_model(model, sample_inputs[0], mode)
+        with torch.no_grad():
+            matches = outputs_match(model(sample_inputs), exported(sample_inputs))
+    except Exception:
+        logger.exception("Could not export the model with {}, using the eager model".format(mode))
+        return model, False
+    if not matches:
+        logger.warning("Outputs of the {} export differ from the eager model, using the eager model".format(mode))
+        return model, False
+
+    exported.ts_model.save(ts_path)
+    if exported.outputs_schema is not None:
+        torch.save(exported.outputs_schema, schema_path)
+    with open(meta_path, "w") as file:
+        json.dump({"checkpoint_digest": checkpoint_digest, "mode": mode, "device": cfg.MODEL.DEVICE,
+                   "meta_architecture": cfg.MODEL.META_ARCHITECTURE,
+                   "score_thresh": cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST}, file)
+    if bucket is not None:
+        for path in (ts_path, schema_path, meta_path):
+            if os.path.isfile(path):
+                bucket.upload(path, path)
+    logger.info("Exported the model with {} and verified it against the eager model".format(mode))
+    return exported, True
@@ -1,98 +1,92 @@
+import json
 import os
+import socket
+import time
 
-from google.cloud import storage
-from google.cloud.storage import Bucket
+from .artifact_cache import ArtifactCache
+from .storage_backend import StorageBackend, get_backend
 
+# object that claims a run folder, see get_available_folder
+RESERVATION_MARKER = ".reserved"
 
-def connect_to_bucket(bucket_name: str) -> Bucket:
+
+def connect_to_bucket(bucket_name: str) -> StorageBackend:
     """
-    @param bucket_name: name of the bucket of the save location
-    @return: bucket object provided by GCP
+    @param bucket_name: name of the bucket of the save location, or file:///some/folder to work offline
+    @return: storage backend of the bucket, the client behind it is created once per process
     """
-    storage_client = storage.Client(project='your-project-name')
-    bucket = storage.Bucket(client=storage_client, name=bucket_name)
-
-    return bucket
+    return get_backend(bucket_name)
 
 
-def get_available_folder(foldername: str, bucket_name: str, delimiter=None) -> str:
+def split_run_name(foldername: str):
     """
-    Looks for all the blobs in the bucket that begin with the prefix and returns the available folder.
-
-    This can be used to list all blobs in a "folder", e.g. "public/".
+    @return: tuple of (base name, first suffix), e.g. ("run", 3) for "run_3" and ("run", 0) for "run"
+    """
+    base, _, suffix = foldername.rpartition("_")
+    if base and suffix.isdigit():
+        return base, int(suffix)
+    return foldername, 0
 
-    The delimiter argument can be used to restrict the results to only the
-    "files" in the given "folder". Without the delimiter, the entire tree under
-    the prefix is returned. For example, given these blobs:
 
-        a/1.txt
-        a/b/2.txt
+def taken_suffixes(bucket: StorageBackend, base: str) -> set:
+    """
+    @return: suffixes N of the existing model_output/<base>_N folders, from a single listing with a delimiter, so only
+             the folders are returned and not everything in them
+    """
+    prefix = "model_output/" + base + "_"
+    names, prefixes = bucket.list(prefix=prefix, delimiter="/")
+    taken = set()
+    for name in names + prefixes:
+        suffix = name[len(prefix):].rstrip("/")
+        if suffix.isdigit():
+            taken.add(int(suffix))
+    return taken
 
-    If you specify prefix ='a/', without a delimiter, you'll get back:
 
-        a/1.txt
-        a/b/2.txt
+def get_available_folder(foldername: str, bucket_name: str, max_attempts: int = 100) -> str:
+    """
+    Finds the first free model_output/<base>_N folder in the bucket, with N at least the number the name ends with
+    (0 if it does not end with one), and reserves it. So "run" gives run_0, or run_4 if run_0 up to run_3 exist.
 
-    However, if you specify prefix='a/' and delimiter='/', you'll get back:
+    The taken suffixes come from one listing of the folders next to each other, and the chosen folder is claimed by
+    creating a marker object in it that may not exist yet. Claiming is atomic in the bucket, so concurrent runs (like
+    hypertune trials that start at the same time) never get the same folder, the loser moves on to the next suffix.
 
-        a/1.txt
+    @return: the reserved folder, e.g. "model_output/run_4"
     """
-
     bucket = connect_to_bucket(bucket_name)
-
-    # define prefix (bucket folder name) which is used by notifier
-    prefix = "model_output/" + foldername
-    available_folder = None
-
-    # this function checks if the last part of the name has a number, in case the input is some config file,
-    # and adds _0 if not if there is already a folder with that name and the last part is not a number,
-    # the same logic applies Note: Client.list_blobs requires at least package version 1.17.0.
-    while not available_folder:
-        # if this works, the folder exists
-        blobs = bucket.list_blobs(prefix=prefix, delimiter=delimiter)
-        blobs = list(blobs)
-        if len(blobs) > 0:
-
-            # split in parts and try to increment, if this fails add "_0" to the name
-            m = foldername.split("_")
-            try:
-                m[-1] = int(m[-1]) + 1
-                m[-1] = str(m[-1])
-                foldername = "_".join(m)
-                prefix = "model_output/" + foldername
-            except:
-                foldername = "_".join(m)
-                foldername += "_0"
-                prefix = "model_output/" + foldername
-            continue
-        else:
-            # check if last part is a number, if not add _0
-            try:
-                int(prefix.split("_")[-1])
-                available_folder = prefix
-            except:
-                available_folder = prefix + "_0"
-
-    return available_folder
+    base, suffix = split_run_name(foldername)
+    taken = taken_suffixes(bucket, base)
+    marker = json.dumps({"run_name": foldername, "host": socket.gethostname(), "pid": os.getpid(),
+                         "time": time.time()}).encode()
+
+    for _ in range(max_attempts):
+        while suffix in taken:
+            suffix += 1
+        folder = "model_output/{}_{}".format(base, suffix)
+        if bucket.create_if_absent(folder + "/" + RESERVATION_MARKER, marker):
+            return folder
+        # another run claimed it between the listing and now
+        taken.add(suffix)
+    raise Exception("Could not reserve a folder for {} in {} attempts".format(foldername, max_attempts))
 
 
 def load_checkpoint(cfg, args):
     """
-    Loads specified checkpoint from specified bucket.
+    Loads specified checkpoint from specified bucket, through the ArtifactCache.
     """
     checkpoint_iteration = args.checkpoint
     bucket = connect_to_bucket(args.bucket)
     # load actual checkpoint
     if not os.path.isdir(cfg.OUTPUT_DIR):
-        os.mkdir(cfg.OUTPUT_DIR)
-    blob = bucket.blob(cfg.OUTPUT_DIR + "/model_" + str(checkpoint_iteration) + ".pth")
-    blob.download_to_filename(cfg.OUTPUT_DIR + "/model_" + str(checkpoint_iteration) + ".pth")
+        os.makedirs(cfg.OUTPUT_DIR)
+    # skipped if the checkpoint is already there and still the same as the one in the bucket
+    ArtifactCache(bucket, workers=args.download_workers).fetch(
+        cfg.OUTPUT_DIR + "/model_" + str(checkpoint_iteration) + ".pth",
+        cfg.OUTPUT_DIR + "/model_" + str(checkpoint_iteration) + ".pth")
     if args.resume:
         # also write last checkpoint file for when --resume statement, model gets checkpoint name from this file
         with open(cfg.OUTPUT_DIR + "/last_checkpoint", "w") as file:
             file.write("model_" + str(checkpoint_iteration) + ".pth")
     # return statement not clean, but useful for inference code
     return checkpoint_iteration, bucket
-
-
-
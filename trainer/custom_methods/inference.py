@@ -1,11 +1,171 @@
+import logging
 import os
 
 import cv2
 from detectron2.data import DatasetCatalog, MetadataCatalog
-from detectron2.engine import DefaultPredictor
 from detectron2.utils.visualizer import Visualizer, ColorMode
 
 from custom_methods import load_checkpoint
+from custom_methods.export_model import load_export, load_or_export
+from custom_methods.inference_engine import BatchedPredictor, InferenceEngine
+from custom_methods.overlay_renderer import render_instances
+from custom_methods.digest import file_digest
+from custom_methods.prediction_cache import PredictionCache, cache_key, raw_output_cfg
+from custom_methods.quantization import load_or_quantize, quantization_report
+from custom_methods.prediction_export import PredictionExporter, should_render
+from custom_methods.storage_backend import TransferPool
+
+logger = logging.getLogger(__name__)
+
+
+def render_prediction(im, instances, metadata, renderer="fast"):
+    """
+    @param im: original image in BGR
+    @param instances: predicted instances on the cpu
+    @param renderer: "fast" for the OpenCV renderer or "visualizer" for detectron2's Visualizer
+    @return: BGR image with the predictions drawn on a grayscale version of the image
+    """
+    if renderer == "fast":
+        return render_instances(im, instances, metadata.get("thing_classes", []), scale=0.8)
+
+    v = Visualizer(im[:, :, ::-1],
+                   metadata=metadata,
+                   scale=0.8,
+                   instance_mode=ColorMode.IMAGE_BW  # remove the colors of unsegmented pixels
+                   )
+    v = v.draw_instance_predictions(instances)
+    return v.get_image()[:, :, ::-1]
+
+
+def prepare_model(cfg, args, bucket, records, check=True):
+    """
+    Predictor of the checkpoint in cfg.MODEL.WEIGHTS, with the export or quantized model of --export-model and
+    --quantize. Those are made once per checkpoint and cached next to it, later calls load them.
+
+    @param records: dataset dicts, the export and batching (with --inference-batch-size over 1) are checked on the
+                    first of them
+    @param check: make and check the export, check batching and write the quantization report (with --quant-report).
+                  Without, only what a call with check made before is loaded, like in the sharded inference workers
+    @return: tuple of (predictor, config of the model, variant), variant is anything that changes the outputs
+             besides the checkpoint and config, for the cache key
+    """
+    model_cfg = cfg
+    if args.prediction_cache:
+        # the threshold is applied by the engine, after the cache
+        model_cfg = raw_output_cfg(cfg, min(args.cache_score_floor, args.score_thresh))
+
+    predictor = BatchedPredictor(model_cfg)
+    # the variant only names the model that runs, the parser rejects --export-model with --quantize
+    variant = ""
+    if args.quantize == "int8":
+        # calibrated on a sample of the train set, the int8 model runs on CPU
+        predictor.model, export_dir = load_or_quantize(model_cfg, "car_damage_train", args.quant_calib_images,
+                                                       args.quant_backend, bucket)
+        variant = "int8_" + args.quant_backend
+        if args.quant_report and check:
+            quantization_report(model_cfg, predictor.model, export_dir, args.eval_dataset)
+            bucket.upload(cfg.OUTPUT_DIR + "/quantization_report.json", cfg.OUTPUT_DIR + "/quantization_report.json")
+    elif args.export_model != "none" and not check:
+        # the eager model if the export did not match it
+        exported = load_export(model_cfg, args.export_model, bucket)
+        if exported is not None:
+            predictor.model = exported
+            variant = args.export_model
+    elif args.export_model != "none":
+        # exported once per checkpoint and checked against the eager model on a few validation images
+        sample_inputs = [predictor.preprocess(cv2.imread(d["file_name"])) for d in records[:args.export_check_images]]
+        predictor.model, exported = load_or_export(model_cfg, args.export_model, sample_inputs, bucket)
+        if exported:
+            variant = args.export_model
+    if args.inference_batch_size > 1 and check:
+        check_batching(predictor, records[:args.inference_batch_size])
+    return predictor, model_cfg, variant
+
+
+def check_batching(predictor, records):
+    """
+    Compares the batched predictions of records with the ones of one image at a time, padding can change detections
+    at the edges of the smaller images of a batch. Logs the difference, with a warning if it is noticeable.
+    """
+    inputs = [predictor.preprocess(cv2.imread(d["file_name"])) for d in records]
+    difference = predictor.compare_batching(inputs)
+    message = "Batched against per-image predictions on {images} images: {count_mismatches} with another number " \
+              "of detections, boxes differ up to {max_box_difference:.2f} pixels, scores up to " \
+              "{max_score_difference:.4f}".format(**difference)
+    if difference["count_mismatches"] or difference["max_box_difference"] > 1.0:
+        logger.warning(message + ". Use --inference-batch-size 1 for the exact per-image results")
+    else:
+        logger.info(message)
+    return difference
+
+
+def build_prediction_cache(cfg, args, model_cfg, variant, bucket):
+    """
+    @return: PredictionCache of the model as returned by prepare_model, None without --prediction-cache
+    """
+    if not args.prediction_cache:
+        return None
+    key = cache_key(model_cfg, file_digest(cfg.MODEL.WEIGHTS), variant)
+    return PredictionCache(args.prediction_cache, key, bucket)
+
+
+def predict_records(cfg, args, predictor, model_cfg, variant, records, prediction_folder, bucket, shard=None):
+    """
+    Runs records through the InferenceEngine and renders, exports and uploads the results to prediction_folder.
+
+    @param shard: index of the worker if the dataset is split over several, the predictions of a worker go to
+                  predictions.shard<index>.jsonl and the prediction cache is not synced down, as the parent does that
+    @return: throughput summary of the engine
+    """
+    metadata = MetadataCatalog.get(args.eval_dataset)
+
+    export = args.export_format == "jsonl"
+    render_fraction = args.render_fraction
+    if render_fraction is None:
+        render_fraction = 0.0 if export else 1.0
+    predictions_name = "predictions.jsonl" if shard is None else "predictions.shard{}.jsonl".format(shard)
+    exporter = PredictionExporter(prediction_folder + "/" + predictions_name, metadata) if export else None
+
+    def write_result(d, im, outputs):
+        instances = outputs["instances"]
+        if exporter is not None:
+            exporter.write(d, instances)
+        if not should_render(d["image_id"], render_fraction):
+            return
+
+        # save original image for easy comparison
+        image_id = str(d["file_name"]).split("/")[-1].split(".")[0]
+        image_extension = "." + str(d["file_name"]).split("/")[-1].split(".")[1]
+        cv2.imwrite(prediction_folder + "/" + image_id + image_extension, im)
+        # outputs are already moved to the cpu by the engine, save predictions
+        rendered = render_prediction(im, instances, metadata, args.renderer)
+        cv2.imwrite(prediction_folder + "/" + image_id + "_pred.jpeg", rendered)
+
+        # save to GCP, in the background
+        transfers.upload(prediction_folder + "/" + image_id + image_extension,
+                         prediction_folder + "/" + image_id + image_extension)
+        transfers.upload(prediction_folder + "/" + image_id + "_pred.jpeg",
+                         prediction_folder + "/" + image_id + "_pred.jpeg")
+
+    cache = build_prediction_cache(cfg, args, model_cfg, variant, bucket)
+    engine = InferenceEngine(predictor,
+                             batch_size=args.inference_batch_size,
+                             decode_workers=args.decode_workers,
+                             output_workers=args.output_workers,
+                             cache=cache,
+                             score_thresh=args.score_thresh if cache is not None else None)
+    with TransferPool(bucket, max_workers=args.transfer_workers) as transfers:
+        if cache is not None and shard is None:
+            cache.sync_down(transfers)
+        # for d in DatasetCatalog.get("car_damage_test"):
+        engine.run(records, write_result)
+        if cache is not None:
+            cache.sync_up(transfers)
+        if exporter is not None:
+            exporter.close()
+            if shard is None:
+                transfers.upload(exporter.file_path, exporter.file_path)
+    return engine.stats.summary()
 
 
 def inference(cfg, args):
@@ -14,50 +174,36 @@ def inference(cfg, args):
     parameter looks for the folder in which the to be evaluated model is saved. It loads a predictor, the latest
     model file and then performs inference. Pictures are saved to the "predictions" folder inside the corresponding
     run.
+
+    Images are read, run through the model in batches and written by the InferenceEngine, which overlaps the three.
+    With --export-format jsonl the predictions are written to predictions.jsonl instead, and only a sample of
+    --render-fraction of the images is rendered.
+
+    With --prediction-cache, the model keeps all detections above --cache-score-floor and those raw outputs are cached
+    per checkpoint and image. --score-thresh is applied afterwards, so images that were seen before with the same
+    checkpoint and config skip the model.
+
+    With --eval-workers above 1 the dataset is split over that many worker processes, see sharded_inference.
     """
     checkpoint_iteration, bucket = load_checkpoint(cfg, args)
 
     # set prediction threshold and model weights
     cfg.defrost()
     cfg.MODEL.WEIGHTS = os.path.join(cfg.OUTPUT_DIR, "model_" + checkpoint_iteration + ".pth")
-    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.7
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.score_thresh
     # cfg.MODEL.FCOS.INFERENCE_TH_TEST = 0.3
     cfg.freeze()
 
-    # inference part
-    predictor = DefaultPredictor(cfg)
     # save images in predictions folder, not required with pushing directly to GCP but cleaner
-    if not os.path.isdir(cfg.OUTPUT_DIR + '/predictions' + str(checkpoint_iteration)):
-        os.mkdir(cfg.OUTPUT_DIR + '/predictions' + str(checkpoint_iteration))
+    prediction_folder = cfg.OUTPUT_DIR + '/predictions' + str(checkpoint_iteration)
+    if not os.path.isdir(prediction_folder):
+        os.mkdir(prediction_folder)
 
-    # for d in DatasetCatalog.get("car_damage_test"):
-    for d in DatasetCatalog.get("car_damage_val"):
-        im = cv2.imread(d["file_name"])
+    if args.eval_workers > 1:
+        # imported here, as the sharded module imports this one for the workers
+        from custom_methods.sharded_inference import sharded_inference
+        return sharded_inference(cfg, args, prediction_folder, bucket)
 
-        # save original image for easy comparison
-        image_id = str(d["file_name"]).split("/")[-1].split(".")[0]
-        image_extension = "." + str(d["file_name"]).split("/")[-1].split(".")[1]
-        cv2.imwrite(cfg.OUTPUT_DIR + '/predictions' + str(checkpoint_iteration) + "/" + image_id + image_extension, im)
-
-        # produce predictions
-        outputs = predictor(im)
-        v = Visualizer(im[:, :, ::-1],
-                       metadata=MetadataCatalog.get("car_damage_val"),
-                       scale=0.8,
-                       instance_mode=ColorMode.IMAGE_BW  # remove the colors of unsegmented pixels
-                       )
-
-        # .to("cpu"), which could be changed for large inference datasets, and save predictions
-        v = v.draw_instance_predictions(outputs["instances"].to("cpu"))
-        cv2.imwrite(cfg.OUTPUT_DIR + '/predictions' + str(checkpoint_iteration) + "/" + image_id + "_pred.jpeg",
-                    v.get_image()[:, :, ::-1])
-
-        # save to GCP
-        blob = bucket.blob(cfg.OUTPUT_DIR + '/predictions' + str(checkpoint_iteration)
-                           + "/" + image_id + image_extension)
-        blob.upload_from_filename(cfg.OUTPUT_DIR + '/predictions' + str(checkpoint_iteration)
-                                  + "/" + image_id + image_extension)
-        blob = bucket.blob(cfg.OUTPUT_DIR + '/predictions' + str(checkpoint_iteration)
-                           + "/" + image_id + "_pred.jpeg")
-        blob.upload_from_filename(cfg.OUTPUT_DIR + '/predictions' + str(checkpoint_iteration)
-                                  + "/" + image_id + "_pred.jpeg")
+    records = DatasetCatalog.get(args.eval_dataset)
+    predictor, model_cfg, variant = prepare_model(cfg, args, bucket, records)
+    return predict_records(cfg, args, predictor, model_cfg, variant, records, prediction_folder, bucket)
@@ -0,0 +1,260 @@
+import logging
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import detectron2.data.transforms as T
+import numpy as np
+import torch
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.modeling import build_model
+
+from .digest import bytes_digest
+
+
+class BatchedPredictor:
+    """
+    The same as detectron2's DefaultPredictor, but with preprocessing split off so it can run in another thread, and
+    a call that takes several images and runs them through the model in a single forward pass.
+
+    Batched images are padded to the largest image in the batch. Only the input padding is zero: after the first
+    convolutions, normalization and the upsampling of the FPN the padded area is not, so detections near the right
+    and bottom edge of the smaller images of a mixed size batch can differ from the ones of one image at a time.
+    compare_batching measures how much, batching is off (batch size 1) by default.
+    """
+
+    def __init__(self, cfg, model=None):
+        """
+        @param cfg: frozen config with MODEL.WEIGHTS set
+        @param model: optional callable that takes a list of model inputs, for example an exported model. If not
+                      given, the model is built from cfg and the weights are loaded on first use.
+        """
+        self.cfg = cfg.clone()
+        self._model = model
+
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+        self.input_format = cfg.INPUT.FORMAT
+        assert self.input_format in ["RGB", "BGR"], self.input_format
+
+    @property
+    def model(self):
+        if self._model is None:
+            model = build_model(self.cfg)
+            model.eval()
+            DetectionCheckpointer(model).load(self.cfg.MODEL.WEIGHTS)
+            self._model = model
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
+    def preprocess(self, original_image):
+        """
+        @param original_image: image of shape (H, W, C) in BGR order, as read by cv2
+        @return: model input dict, as DefaultPredictor builds it
+        """
+        if self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return {"image": image, "height": height, "width": width}
+
+    def predict(self, inputs):
+        """
+        @param inputs: list of preprocessed inputs
+        @return: list of model outputs, one per input
+        """
+        with torch.no_grad():
+            return self.model(inputs)
+
+    def __call__(self, original_images):
+        return self.predict([self.preprocess(image) for image in original_images])
+
+    def compare_batching(self, inputs):
+        """
+        Runs inputs as one batch and one image at a time, and compares the detections of every image.
+
+        @param inputs: list of preprocessed inputs, preferably of different sizes
+        @return: dict with the number of images whose number of detections differs, and the largest difference of a
+                 box coordinate (in pixels) and of a score between detections of the same rank
+        """
+        batched = self.predict(inputs)
+        single = [self.predict([x])[0] for x in inputs]
+        count_mismatches, max_box_difference, max_score_difference = 0, 0.0, 0.0
+        for a, b in zip(batched, single):
+            a, b = a["instances"].to("cpu"), b["instances"].to("cpu")
+            if len(a) != len(b):
+                count_mismatches += 1
+                continue
+            if len(a) == 0:
+                continue
+            a_order, b_order = a.scores.argsort(descending=True), b.scores.argsort(descending=True)
+            max_box_difference = max(max_box_difference, float(
+                (a.pred_boxes.tensor[a_order] - b.pred_boxes.tensor[b_order]).abs().max()))
+            max_score_difference = max(max_score_difference, float(
+                (a.scores[a_order] - b.scores[b_order]).abs().max()))
+        return {"images": len(inputs), "count_mismatches": count_mismatches,
+                "max_box_difference": max_box_difference, "max_score_difference": max_score_difference}
+
+
+class StageStats:
+    """
+    Thread safe bookkeeping of the number of images and the busy time per pipeline stage.
+    """
+
+    def __init__(self, stages):
+        self._lock = threading.Lock()
+        self._images = OrderedDict((stage, 0) for stage in stages)
+        self._busy = OrderedDict((stage, 0.0) for stage in stages)
+        self._start = time.perf_counter()
+
+    def add(self, stage, num_images, seconds):
+        with self._lock:
+            self._images[stage] += num_images
+            self._busy[stage] += seconds
+
+    def summary(self):
+        """
+        @return: dict with per stage images/s of a single worker, and the images/s of the whole pipeline
+        """
+        wall_time = time.perf_counter() - self._start
+        with self._lock:
+            summary = OrderedDict(
+                (stage, self._images[stage] / self._busy[stage] if self._busy[stage] > 0 else float("nan"))
+                for stage in self._images
+            )
+            last_stage = next(reversed(self._images))
+            summary["pipeline"] = self._images[last_stage] / wall_time if wall_time > 0 else float("nan")
+        return summary
+
+
+class InferenceEngine:
+    """
+    Runs inference as a pipeline of three stages. A thread pool reads and preprocesses images ahead of the model, the
+    model gets batches of batch_size images and a second thread pool handles the outputs (rendering, writing and
+    uploading), so the model never waits on I/O. The queues between the stages are bounded, so memory stays the same
+    no matter how many images are processed.
+
+    With a PredictionCache, the decode stage also looks up the image by the hash of its file, and only the images that
+    are not cached go through the model. The raw outputs of those are added to the cache in the output stage.
+    """
+
+    def __init__(self, predictor, batch_size=4, decode_workers=4, output_workers=4, cache=None, score_thresh=None):
+        """
+        @param predictor: BatchedPredictor (or anything with preprocess and predict)
+        @param batch_size: number of images per forward pass
+        @param decode_workers: threads that read and preprocess images
+        @param output_workers: threads that handle the model outputs
+        @param cache: optional PredictionCache of the raw outputs of this model
+        @param score_thresh: optional threshold on the scores, applied to the (cached) outputs before handle_result
+        """
+        self.logger = logging.getLogger(__name__)
+        self.predictor = predictor
+        self.batch_size = max(1, int(batch_size))
+        self.decode_workers = max(1, int(decode_workers))
+        self.output_workers = max(1, int(output_workers))
+        self.cache = cache
+        self.score_thresh = score_thresh
+        self.stats = StageStats(["decode", "model", "output"])
+
+    def _decode(self, record):
+        start = time.perf_counter()
+        image_hash, cached = None, None
+        if self.cache is None:
+            image = cv2.imread(record["file_name"])
+        else:
+            with open(record["file_name"], "rb") as file:
+                data = file.read()
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            image_hash = bytes_digest(data)
+            cached = self.cache.get(image_hash)
+        # cached images do not need a model input
+        model_input = self.predictor.preprocess(image) if cached is None else None
+        self.stats.add("decode", 1, time.perf_counter() - start)
+        return record, image, model_input, image_hash, cached
+
+    def _handle_output(self, handle_result, record, image, outputs, image_hash=None):
+        start = time.perf_counter()
+        if image_hash is not None and "instances" in outputs:
+            self.cache.put(image_hash, outputs["instances"])
+        if self.score_thresh is not None and "instances" in outputs:
+            instances = outputs["instances"]
+            outputs["instances"] = instances[instances.scores >= self.score_thresh]
+        handle_result(record, image, outputs)
+        self.stats.add("output", 1, time.perf_counter() - start)
+
+    def run(self, records, handle_result):
+        """
+        @param records: dataset dicts, only "file_name" is required
+        @param handle_result: called as handle_result(record, image, outputs) in the output pool, with the original
+                              BGR image and the model outputs of that image moved to the cpu
+        """
+        self.stats = StageStats(["decode", "model", "output"])
+        records = iter(records)
+        # a few batches ahead, so the next batch is decoded while the model runs
+        max_prefetch = self.batch_size * 2
+        max_pending_outputs = self.batch_size * 2 + self.output_workers
+
+        with ThreadPoolExecutor(self.decode_workers, thread_name_prefix="decode") as decode_pool, \
+                ThreadPoolExecutor(self.output_workers, thread_name_prefix="output") as output_pool:
+            decoding = deque()
+            pending_outputs = deque()
+
+            def prefetch():
+                while len(decoding) < max_prefetch:
+                    record = next(records, None)
+                    if record is None:
+                        return
+                    decoding.append(decode_pool.submit(self._decode, record))
+
+            prefetch()
+            while decoding:
+                batch = [decoding.popleft().result() for _ in range(min(self.batch_size, len(decoding)))]
+                prefetch()
+
+                misses = [model_input for _, _, model_input, _, cached in batch if cached is None]
+                if misses:
+                    start = time.perf_counter()
+                    outputs = iter([self._to_cpu(output) for output in self.predictor.predict(misses)])
+                    self.stats.add("model", len(misses), time.perf_counter() - start)
+
+                for record, image, _, image_hash, cached in batch:
+                    if cached is None:
+                        # new outputs are added to the cache
+                        output, new_hash = next(outputs), image_hash
+                    else:
+                        output, new_hash = {"instances": cached}, None
+                    pending_outputs.append(output_pool.submit(self._handle_output, handle_result,
+                                                              record, image, output, new_hash))
+                # only block on the outputs if they fall behind too far, this also raises their errors early
+                while len(pending_outputs) > max_pending_outputs or (pending_outputs and pending_outputs[0].done()):
+                    pending_outputs.popleft().result()
+
+            while pending_outputs:
+                pending_outputs.popleft().result()
+
+        self.log_stats()
+        if self.cache is not None:
+            self.cache.log_stats()
+
+    def _to_cpu(self, output):
+        if "instances" in output:
+            output["instances"] = output["instances"].to("cpu")
+        return output
+
+    def log_stats(self):
+        summary = self.stats.summary()
+        self.logger.info(
+            "Inference throughput: " + ", ".join("{} {:.2f} img/s".format(stage, value)
+                                                 for stage, value in summary.items())
+            + " (decode and output per worker, with {} and {} workers)".format(self.decode_workers,
+                                                                                  self.output_workers)
+        )
+        return summary
@@ -0,0 +1,90 @@
+import colorsys
+import math
+
+import cv2
+import numpy as np
+
+
+def class_colors(num_classes):
+    """
+    @return: (num_classes, 3) uint8 array of well separated BGR colors, the same for every image
+    """
+    colors = []
+    for i in range(max(num_classes, 1)):
+        # golden ratio steps over the hue circle, so neighbouring class ids do not get similar colors
+        r, g, b = colorsys.hsv_to_rgb((i * 0.618033988749895) % 1.0, 0.75, 0.95)
+        colors.append((b * 255, g * 255, r * 255))
+    return np.asarray(colors, dtype=np.uint8)
+
+
+def render_instances(image, instances, class_names, scale=0.8, alpha=0.3):
+    """
+    OpenCV/NumPy version of detectron2's Visualizer.draw_instance_predictions with ColorMode.IMAGE_BW: the image is
+    grayscale outside of the predicted masks, masks are alpha-blended in the color of their class with an outline,
+    and every instance gets a box and a "class score%" label. Like the Visualizer, instances are drawn from the
+    largest to the smallest box, so small instances end up on top.
+
+    All masks are composited in one vectorized pass instead of one matplotlib polygon per instance.
+
+    @param image: original image in BGR, (H, W, 3) uint8
+    @param instances: predicted Instances on the cpu
+    @param class_names: thing_classes of the dataset
+    @param scale: scale of the output image, as the Visualizer scale
+    @param alpha: opacity of the masks
+    @return: BGR image with the predictions drawn on it
+    """
+    boxes = instances.pred_boxes.tensor.numpy() if instances.has("pred_boxes") else np.zeros((0, 4))
+    scores = instances.scores.numpy() if instances.has("scores") else None
+    classes = instances.pred_classes.numpy() if instances.has("pred_classes") else np.zeros(len(boxes), np.int64)
+    masks = instances.pred_masks.numpy() if instances.has("pred_masks") else None
+
+    colors = class_colors(len(class_names))[classes % max(len(class_names), 1)]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-areas, kind="mergesort")
+
+    gray = cv2.cvtColor(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+    output = gray
+    if masks is not None and len(masks) > 0:
+        masks = masks[order].astype(bool)
+        covered = masks.any(axis=0)
+        # index (in drawing order) of the last instance that covers every pixel, that is the one on top
+        top = len(masks) - 1 - np.argmax(masks[::-1], axis=0)
+        pixel_colors = colors[order][top[covered]].astype(np.float32)
+
+        output = gray.copy()
+        output[covered] = (image[covered].astype(np.float32) * (1 - alpha) + pixel_colors * alpha).astype(np.uint8)
+
+        for mask, color in zip(masks, colors[order]):
+            contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            cv2.drawContours(output, contours, -1, _darker(color), max(1, int(round(1 / scale))), cv2.LINE_AA)
+
+    height, width = image.shape[:2]
+    # similar to the Visualizer, which bases the font size on the image size
+    font_scale = max(math.sqrt(height * width) / 1200, 0.4) / scale
+    thickness = max(1, int(round(font_scale * 1.5)))
+    for i in order:
+        color = tuple(int(c) for c in colors[i])
+        x0, y0, x1, y1 = [int(round(v)) for v in boxes[i]]
+        cv2.rectangle(output, (x0, y0), (x1, y1), color, thickness, cv2.LINE_AA)
+
+        label = class_names[classes[i]] if classes[i] < len(class_names) else str(classes[i])
+        if scores is not None:
+            label = "{} {:.0f}%".format(label, scores[i] * 100)
+        (text_width, text_height), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+        text_y = max(y0, text_height + baseline)
+        cv2.rectangle(output, (x0, text_y - text_height - baseline), (x0 + text_width, text_y), (0, 0, 0), -1)
+        cv2.putText(output, label, (x0, text_y - baseline), cv2.FONT_HERSHEY_SIMPLEX, font_scale,
+                    _lighter(colors[i]), thickness, cv2.LINE_AA)
+
+    if scale != 1.0:
+        output = cv2.resize(output, (int(round(width * scale)), int(round(height * scale))),
+                            interpolation=cv2.INTER_AREA)
+    return output
+
+
+def _darker(color):
+    return tuple(int(c * 0.6) for c in color)
+
+
+def _lighter(color):
+    return tuple(int(min(255, c * 0.3 + 255 * 0.7)) for c in color)
@@ -0,0 +1,168 @@
+import io
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+from detectron2.structures import Boxes, Instances
+
+from .digest import bytes_digest
+
+logger = logging.getLogger(__name__)
+
+
+def raw_output_cfg(cfg, score_floor):
+    """
+    Copy of cfg of which the score thresholds are lowered to score_floor, so the model keeps (almost) all detections
+    and any higher threshold can be applied afterwards. Filtering afterwards gives the same result as a higher
+    threshold in the model, as NMS only lets higher scoring boxes suppress lower scoring ones.
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = score_floor
+    if "FCOS" in cfg.MODEL:
+        cfg.MODEL.FCOS.INFERENCE_TH_TEST = min(cfg.MODEL.FCOS.INFERENCE_TH_TEST, score_floor)
+    cfg.freeze()
+    return cfg
+
+
+def cache_key(cfg, checkpoint_digest, variant=""):
+    """
+    @param cfg: config the raw outputs are made with, as returned by raw_output_cfg
+    @param checkpoint_digest: digest of the checkpoint
+    @param variant: anything else that changes the outputs, like an export or quantization mode
+    @return: key of the cache folder, everything that changes the model outputs is part of it
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    # the weights are covered by the digest, the output folder does not change predictions
+    cfg.MODEL.WEIGHTS = ""
+    cfg.OUTPUT_DIR = ""
+    return checkpoint_digest[:16] + "_" + bytes_digest((cfg.dump() + variant).encode())[:16]
+
+
+class PredictionCache:
+    """
+    Persistent cache of raw model outputs, keyed by checkpoint digest and config (see cache_key) plus the hash of the
+    image file. Every image is an .npz file with boxes, scores, classes and the masks as compressed RLE:
+
+        <root>/<key>/<image hash[:2]>/<image hash>.npz
+
+    If a bucket is given, the entries of this key are downloaded from the bucket at the start, and new entries are
+    uploaded by sync, so the cache persists across jobs. get and put can be called from several threads.
+    """
+
+    def __init__(self, root, key, bucket=None):
+        self.folder = os.path.join(root, key)
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._new_entries = []
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, image_hash):
+        return os.path.join(self.folder, image_hash[:2], image_hash + ".npz")
+
+    def get(self, image_hash):
+        """
+        @return: cached raw Instances of the image, or None
+        """
+        path = self._path(image_hash)
+        if not os.path.isfile(path):
+            with self._lock:
+                self._misses += 1
+            return None
+        with np.load(path) as data:
+            instances = self._to_instances(data)
+        with self._lock:
+            self._hits += 1
+        return instances
+
+    def put(self, image_hash, instances):
+        """
+        @param instances: raw Instances of the image, on the cpu
+        """
+        path = self._path(image_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez(buffer, **self._to_arrays(instances))
+        # write and rename, so a reader never sees half an entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(buffer.getvalue())
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._new_entries.append(path)
+
+    def sync_down(self, transfers):
+        """
+        Downloads the entries of this key from the bucket that are not here yet.
+
+        @param transfers: TransferPool of the bucket
+        """
+        if self.bucket is None:
+            return
+        names, _ = self.bucket.list(prefix=self.folder + "/")
+        for name in names:
+            if not os.path.isfile(name):
+                os.makedirs(os.path.dirname(name), exist_ok=True)
+                transfers.download(name, name)
+        transfers.wait()
+        logger.info("Prediction cache {} has {} entries in the bucket".format(self.folder, len(names)))
+
+    def sync_up(self, transfers):
+        """
+        Uploads the entries that were added in this run to the bucket.
+        """
+        if self.bucket is None:
+            return
+        with self._lock:
+            new_entries, self._new_entries = self._new_entries, []
+        for path in new_entries:
+            transfers.upload(path, path)
+
+    def stats(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return {"hits": self._hits, "misses": self._misses,
+                    "hit_rate": self._hits / total if total else float("nan")}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info("Prediction cache: {hits} hits, {misses} misses ({hit_rate:.1%} hit rate)".format(**stats))
+        return stats
+
+    @staticmethod
+    def _to_arrays(instances):
+        arrays = {
+            "image_size": np.asarray(instances.image_size, dtype=np.int64),
+            "boxes": instances.pred_boxes.tensor.numpy().astype(np.float32),
+            "scores": instances.scores.numpy().astype(np.float32),
+            "classes": instances.pred_classes.numpy().astype(np.int64),
+        }
+        if instances.has("pred_masks"):
+            masks = instances.pred_masks.numpy()
+            rles = mask_util.encode(np.asfortranarray(masks.transpose(1, 2, 0).astype(np.uint8))) if len(masks) else []
+            counts = [rle["counts"] for rle in rles]
+            arrays["mask_counts"] = np.frombuffer(b"".join(counts), dtype=np.uint8)
+            arrays["mask_offsets"] = np.cumsum([0] + [len(c) for c in counts]).astype(np.int64)
+        return arrays
+
+    @staticmethod
+    def _to_instances(data):
+        height, width = (int(v) for v in data["image_size"])
+        instances = Instances((height, width))
+        instances.pred_boxes = Boxes(torch.as_tensor(data["boxes"]))
+        instances.scores = torch.as_tensor(data["scores"])
+        instances.pred_classes = torch.as_tensor(data["classes"])
+        if "mask_counts" in data:
+            counts, offsets = data["mask_counts"].tobytes(), data["mask_offsets"]
+            rles = [{"size": [height, width], "counts": counts[offsets[i]:offsets[i + 1]]}
+                    for i in range(len(offsets) - 1)]
+            masks = mask_util.decode(rles) if rles else np.zeros((height, width, 0), dtype=np.uint8)
+            instances.pred_masks = torch.as_tensor(masks.transpose(2, 0, 1).astype(bool))
+        return instances
@@ -0,0 +1,130 @@
+import json
+import threading
+import zlib
+
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+from detectron2.evaluation.coco_evaluation import instances_to_coco_json
+from detectron2.structures import Boxes, BoxMode, Instances
+
+
+class PredictionExporter:
+    """
+    Streams predictions to a jsonl file, one line per image:
+
+        {"image_id": 3, "file_name": "...", "height": 480, "width": 640, "results": [...]}
+
+    where results are the predictions of that image in COCO results format (bbox in XYWH, score, category_id in the
+    ids of the dataset json and compressed RLE segmentation), so they can be scored with pycocotools directly.
+    write can be called from several threads.
+    """
+
+    def __init__(self, file_path, metadata):
+        """
+        @param file_path: path of the jsonl file, overwritten if it exists
+        @param metadata: metadata of the dataset, used to map the contiguous ids back to the dataset ids
+        """
+        self.file_path = file_path
+        self._reverse_id_mapping = None
+        if hasattr(metadata, "thing_dataset_id_to_contiguous_id"):
+            self._reverse_id_mapping = {v: k for k, v in metadata.thing_dataset_id_to_contiguous_id.items()}
+        self._lock = threading.Lock()
+        self._file = open(file_path, "w")
+
+    def write(self, record, instances):
+        """
+        @param record: dataset dict of the image
+        @param instances: predicted Instances of the image, on the cpu
+        """
+        line = prediction_line(record, instances, self._reverse_id_mapping)
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def coco_results(instances, image_id, reverse_id_mapping=None):
+    """
+    @return: list of predictions of one image in COCO results format, with the category ids of the dataset json
+    """
+    results = instances_to_coco_json(instances, image_id)
+    if reverse_id_mapping is not None:
+        for result in results:
+            result["category_id"] = reverse_id_mapping[result["category_id"]]
+    return results
+
+
+def prediction_line(record, instances, reverse_id_mapping=None):
+    """
+    @return: a single jsonl line with the COCO results of one image
+    """
+    return json.dumps({
+        "image_id": record["image_id"],
+        "file_name": record["file_name"],
+        "height": record["height"],
+        "width": record["width"],
+        "results": coco_results(instances, record["image_id"], reverse_id_mapping),
+    }) + "\n"
+
+
+def should_render(image_id, fraction):
+    """
+    Deterministic sample of the images, so the same images are rendered for every run and checkpoint.
+
+    @param fraction: part of the images to select, between 0 and 1
+    """
+    if fraction >= 1:
+        return True
+    if fraction <= 0:
+        return False
+    return zlib.crc32(str(image_id).encode()) % 10000 < fraction * 10000
+
+
+def read_predictions(file_path):
+    """
+    @return: generator over the lines of an exported jsonl file
+    """
+    with open(file_path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def line_to_instances(line, dataset_id_to_contiguous_id=None):
+    """
+    Rebuilds the Instances of one exported image, for example to render them.
+
+    @param line: a single line of an exported file, as read by read_predictions
+    @param dataset_id_to_contiguous_id: mapping from the dataset category ids to the contiguous ids of the model
+    """
+    results = line["results"]
+    height, width = line["height"], line["width"]
+    instances = Instances((height, width))
+
+    boxes = np.asarray([result["bbox"] for result in results], dtype=np.float32).reshape(-1, 4)
+    instances.pred_boxes = Boxes(torch.as_tensor(BoxMode.convert(boxes, BoxMode.XYWH_ABS, BoxMode.XYXY_ABS)))
+    instances.scores = torch.as_tensor([result["score"] for result in results], dtype=torch.float32)
+    classes = [result["category_id"] for result in results]
+    if dataset_id_to_contiguous_id is not None:
+        classes = [dataset_id_to_contiguous_id[c] for c in classes]
+    instances.pred_classes = torch.as_tensor(classes, dtype=torch.int64)
+
+    if results and "segmentation" in results[0]:
+        masks = [mask_util.decode(_rle_bytes(result["segmentation"])) for result in results]
+        instances.pred_masks = torch.as_tensor(np.stack(masks).astype(bool))
+    return instances
+
+
+def _rle_bytes(rle):
+    # the counts are stored as text in json, pycocotools wants bytes
+    if isinstance(rle["counts"], str):
+        rle = {"size": rle["size"], "counts": rle["counts"].encode("ascii")}
+    return rle
@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+import torch
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.data import DatasetCatalog, DatasetMapper, build_detection_test_loader
+from detectron2.evaluation import COCOEvaluator, inference_on_dataset
+from detectron2.modeling import build_model
+
+from .digest import file_digest
+
+logger = logging.getLogger(__name__)
+
+
+class PredictorModule(torch.nn.Module):
+    """
+    Lets an exported D2Go predictor be used where detectron2 expects a model, e.g. in inference_on_dataset.
+    """
+
+    def __init__(self, predictor):
+        super().__init__()
+        self.predictor = predictor
+
+    def forward(self, inputs):
+        return self.predictor(inputs)
+
+
+def calibration_loader(cfg, dataset_name, num_images, seed=0):
+    """
+    @return: test loader over a random (but fixed) sample of num_images images of dataset_name
+    """
+    dataset = DatasetCatalog.get(dataset_name)
+    sample = random.Random(seed).sample(dataset, min(num_images, len(dataset)))
+    return build_detection_test_loader(dataset=sample, mapper=DatasetMapper(cfg, is_train=False))
+
+
+def _d2go_runner_and_cfg(cfg, backend, num_calibration_images):
+    # d2go is only needed here, so it is imported when a quantized model is asked for
+    from d2go.runner import GeneralizedRCNNRunner
+
+    runner = GeneralizedRCNNRunner()
+    quant_cfg = runner.get_default_cfg()
+    # the d2go config is a superset of the detectron2 one, so D2 RCNN configs merge into it as well
+    quant_cfg.merge_from_other_cfg(cfg)
+    quant_cfg.MODEL.DEVICE = "cpu"
+    quant_cfg.QUANTIZATION.BACKEND = backend
+    quant_cfg.QUANTIZATION.PTQ.CALIBRATION_NUM_IMAGES = num_calibration_images
+    quant_cfg.freeze()
+    return runner, quant_cfg
+
+
+def load_or_quantize(cfg, calibration_dataset="car_damage_train", num_calibration_images=100,
+                     backend="fbgemm", bucket=None):
+    """
+    Post-training int8 quantization of cfg.MODEL.WEIGHTS through D2Go. The model is calibrated on a sample of
+    calibration_dataset, converted to int8 and exported as TorchScript to int8_<checkpoint> next to the checkpoint.
+    An export of the same checkpoint is loaded instead of quantizing again, also from the bucket if given.
+
+    D2Go handles the GeneralizedRCNN models, with FBNet as well as ResNet backbones. Int8 models only run on CPU.
+
+    @return: tuple of (model, export folder), the model takes a list of model inputs like the eager model
+    """
+    from mobile_cv.predictor.api import create_predictor
+
+    # model_0009999.pth gets int8_0009999_fbgemm/ next to it
+    weights_dir, weights_name = os.path.split(os.path.splitext(cfg.MODEL.WEIGHTS)[0])
+    export_dir = os.path.join(weights_dir, weights_name.replace("model_", "int8_", 1) + "_" + backend)
+    meta_path = export_dir + ".json"
+    checkpoint_digest = file_digest(cfg.MODEL.WEIGHTS)
+
+    if bucket is not None and not os.path.isfile(meta_path):
+        try:
+            bucket.download(meta_path, meta_path)
+            names, _ = bucket.list(prefix=export_dir + "/")
+            for name in names:
+                os.makedirs(os.path.dirname(name), exist_ok=True)
+                bucket.download(name, name)
+        except Exception:
+            # not quantized before
+            pass
+
+    if os.path.isfile(meta_path):
+        with open(meta_path) as file:
+            meta = json.load(file)
+        # the score threshold is part of the exported predictor
+        if (meta.get("checkpoint_digest") == checkpoint_digest
+                and meta.get("score_thresh") == cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST):
+            logger.info("Loading int8 model from {}".format(meta["predictor_path"]))
+            return PredictorModule(create_predictor(meta["predictor_path"])), export_dir
+
+    from d2go.export.api import convert_and_export_predictor
+
+    runner, quant_cfg = _d2go_runner_and_cfg(cfg, backend, num_calibration_images)
+    model = runner.build_model(quant_cfg, eval_only=True)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+
+    start = time.perf_counter()
+    loader = calibration_loader(quant_cfg, calibration_dataset, num_calibration_images)
+    predictor_path = convert_and_export_predictor(quant_cfg, model, "torchscript_int8", export_dir, loader)
+    logger.info("Calibrated on {} images of {} and exported the int8 model in {:.1f}s".format(
+        num_calibration_images, calibration_dataset, time.perf_counter() - start))
+
+    with open(meta_path, "w") as file:
+        json.dump({"checkpoint_digest": checkpoint_digest, "predictor_path": predictor_path, "backend": backend,
+                   "calibration_dataset": calibration_dataset, "calibration_images": num_calibration_images,
+                   "score_thresh": cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST}, file)
+    if bucket is not None:
+        for directory, _, files in os.walk(export_dir):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                bucket.upload(path, path)
+        bucket.upload(meta_path, meta_path)
+    return PredictorModule(create_predictor(predictor_path)), export_dir
+
+
+def _folder_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(directory, file_name))
+               for directory, _, files in os.walk(path) for file_name in files)
+
+
+def _latency(model, loader, num_images):
+    """
+    @return: mean seconds per image, over at most num_images images after a warm up
+    """
+    times = []
+    with torch.no_grad():
+        for idx, inputs in enumerate(loader):
+            if idx > num_images:
+                break
+            start = time.perf_counter()
+            model(inputs)
+            if idx > 0:
+                times.append(time.perf_counter() - start)
+    return sum(times) / max(len(times), 1)
+
+
+def quantization_report(cfg, int8_model, export_dir, dataset_name="car_damage_val", num_latency_images=50):
+    """
+    Compares the float model with the int8 model on CPU: latency per image, model size and COCO AP on dataset_name.
+
+    @return: dict with the report, which is also written to quantization_report.json in cfg.OUTPUT_DIR
+    """
+    float_cfg = cfg.clone()
+    float_cfg.defrost()
+    float_cfg.MODEL.DEVICE = "cpu"
+    float_cfg.freeze()
+    float_model = build_model(float_cfg)
+    DetectionCheckpointer(float_model).load(cfg.MODEL.WEIGHTS)
+    float_model.eval()
+
+    # size of the weights only, the checkpoint can also hold optimizer state
+    with tempfile.NamedTemporaryFile(suffix=".pth") as weights_file:
+        torch.save(float_model.state_dict(), weights_file.name)
+        float_size = os.path.getsize(weights_file.name)
+
+    loader = build_detection_test_loader(float_cfg, dataset_name)
+    report = {"dataset": dataset_name, "threads": torch.get_num_threads()}
+    for name, model, size in (("float", float_model, float_size), ("int8", int8_model, _folder_size(export_dir))):
+        results = inference_on_dataset(model, loader, COCOEvaluator(dataset_name, output_dir=None))
+        report[name] = {
+            "latency_ms": _latency(model, loader, num_latency_images) * 1000,
+            "size_mb": size / 1e6,
+            "results": results,
+        }
+    for task in report["float"]["results"]:
+        if task in report["int8"]["results"]:
+            report["{}_AP_change".format(task)] = (report["int8"]["results"][task]["AP"]
+                                                    - report["float"]["results"][task]["AP"])
+
+    logger.info("Quantization: latency {:.1f} -> {:.1f} ms/img, size {:.1f} -> {:.1f} MB, ".format(
+        report["float"]["latency_ms"], report["int8"]["latency_ms"],
+        report["float"]["size_mb"], report["int8"]["size_mb"])
+        + ", ".join("{} {:+.2f}".format(key, value) for key, value in report.items() if key.endswith("_AP_change")))
+    with open(os.path.join(cfg.OUTPUT_DIR, "quantization_report.json"), "w") as file:
+        json.dump(report, file, indent=2)
+    return report
@@ -0,0 +1,194 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from .prediction_export import coco_results
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def percentile(values, q):
+    """
+    @return: q-th percentile (0-100) of values, nearest rank, nan if there are none
+    """
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class MicroBatcher:
+    """
+    Groups concurrent requests into micro-batches for the model. A batch is run as soon as it has max_batch_size
+    images, or when the oldest request in it has waited max_wait_ms, whichever comes first, so under low load a
+    request waits at most max_wait_ms extra and under high load the model gets full batches.
+
+    Images are preprocessed in the thread of the request, only the forward pass runs in the batching thread.
+    """
+
+    def __init__(self, predictor, max_batch_size=8, max_wait_ms=20.0, max_queue_size=256, window=1000):
+        """
+        @param predictor: BatchedPredictor
+        @param max_batch_size: most images per forward pass
+        @param max_wait_ms: latency budget for filling a batch
+        @param max_queue_size: requests beyond this are refused instead of queued
+        @param window: number of recent requests the latency percentiles are computed over
+        """
+        self.predictor = predictor
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue(maxsize=max_queue_size)
+
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._batch_sizes = deque(maxlen=window)
+        self._served = 0
+        self._refused = 0
+        self._start = time.perf_counter()
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="MicroBatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """
+        @param image: BGR image
+        @return: future of the model output of this image
+        """
+        future = Future()
+        try:
+            self._queue.put_nowait((self.predictor.preprocess(image), future, time.perf_counter()))
+        except queue.Full:
+            with self._stats_lock:
+                self._refused += 1
+            raise QueueFullError("Too many requests in the queue")
+        return future
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = first[2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                outputs = self.predictor.predict([model_input for model_input, _, _ in batch])
+            except Exception as e:
+                logger.exception("Prediction failed")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            done = time.perf_counter()
+            for (_, future, enqueued), output in zip(batch, outputs):
+                if "instances" in output:
+                    output["instances"] = output["instances"].to("cpu")
+                future.set_result(output)
+            with self._stats_lock:
+                self._latencies.extend(done - enqueued for _, _, enqueued in batch)
+                self._batch_sizes.append(len(batch))
+                self._served += len(batch)
+
+    def stats(self):
+        """
+        @return: dict with queue depth, latency percentiles (ms, queueing included), mean batch size and throughput
+        """
+        with self._stats_lock:
+            latencies = list(self._latencies)
+            batch_sizes = list(self._batch_sizes)
+            served, refused = self._served, self._refused
+        return {
+            "queue_depth": self._queue.qsize(),
+            "served": served,
+            "refused": refused,
+            "latency_p50_ms": percentile(latencies, 50) * 1000,
+            "latency_p90_ms": percentile(latencies, 90) * 1000,
+            "latency_p99_ms": percentile(latencies, 99) * 1000,
+            "mean_batch_size": float(np.mean(batch_sizes)) if batch_sizes else float("nan"),
+            "images_per_second": served / (time.perf_counter() - self._start),
+        }
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+def build_server(batcher, metadata, host="0.0.0.0", port=8080, timeout=60.0):
+    """
+    HTTP server with three endpoints:
+
+        POST /predict  body is an encoded image (jpeg, png, ...), returns {"results": [...]} in COCO results format
+        GET  /stats    queue depth and latency percentiles of the batcher
+        GET  /health   200 once the model is loaded
+
+    Every request is handled in its own thread, the batcher groups them for the model.
+    """
+    reverse_id_mapping = None
+    if hasattr(metadata, "thing_dataset_id_to_contiguous_id"):
+        reverse_id_mapping = {v: k for k, v in metadata.thing_dataset_id_to_contiguous_id.items()}
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, batcher.stats())
+            elif self.path == "/health":
+                self._reply(200, {"status": "ok"})
+            else:
+                self._reply(404, {"error": "unknown path " + self.path})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._reply(404, {"error": "unknown path " + self.path})
+                return
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                self._reply(400, {"error": "body is not an image"})
+                return
+            try:
+                output = batcher.submit(image).result(timeout=timeout)
+            except QueueFullError as e:
+                self._reply(503, {"error": str(e)})
+                return
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+                return
+            self._reply(200, {"results": coco_results(output["instances"], None, reverse_id_mapping)})
+
+        def log_message(self, format, *args):
+            # every request would otherwise be printed
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.daemon_threads = True
+    return server
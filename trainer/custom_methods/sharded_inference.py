@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.multiprocessing as mp
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data.datasets import register_coco_instances
+from detectron2.utils.logger import setup_logger
+
+from .gcp_data_connection import connect_to_bucket
+from .inference import build_prediction_cache, prepare_model, predict_records
+from .storage_backend import TransferPool
+
+logger = logging.getLogger(__name__)
+
+
+def shard_records(records, shard, num_shards):
+    """
+    @return: every num_shards-th record starting at shard, so every shard gets a mix of the whole dataset
+    """
+    return records[shard::num_shards]
+
+
+def dataset_registrations(names):
+    """
+    Spawned workers start with an empty DatasetCatalog, so the COCO datasets are registered again from these.
+
+    @return: list of (name, json file, image root) of the registered COCO datasets in names
+    """
+    registrations = []
+    for name in names:
+        metadata = MetadataCatalog.get(name)
+        if hasattr(metadata, "json_file"):
+            registrations.append((name, metadata.json_file, metadata.image_root))
+    return registrations
+
+
+def merge_shards(shard_paths, output_path, records):
+    """
+    Merges the jsonl shards of the workers into one file, in the order of records, so the result does not depend on
+    which worker finished first.
+
+    @return: number of merged lines
+    """
+    lines = {}
+    for path in shard_paths:
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    lines[json.loads(line)["image_id"]] = line.rstrip("\n")
+    with open(output_path, "w") as file:
+        for record in records:
+            if record["image_id"] in lines:
+                file.write(lines[record["image_id"]] + "\n")
+    return len(lines)
+
+
+def _worker(shard, cfg, args, num_shards, registrations, prediction_folder):
+    setup_logger(distributed_rank=shard)
+    setup_logger(distributed_rank=shard, name="custom_methods")
+    for name, json_file, image_root in registrations:
+        register_coco_instances(name, {}, json_file, image_root)
+
+    if cfg.MODEL.DEVICE.startswith("cuda") and torch.cuda.is_available():
+        # one device per worker, round robin if there are more workers than devices
+        torch.cuda.set_device(shard % torch.cuda.device_count())
+    else:
+        # split the cores, otherwise every worker starts a thread per core
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_shards))
+
+    start = time.perf_counter()
+    bucket = connect_to_bucket(args.bucket)
+    records = DatasetCatalog.get(args.eval_dataset)
+    # made and checked by the parent, only loaded here
+    predictor, model_cfg, variant = prepare_model(cfg, args, bucket, records, check=False)
+    own_records = shard_records(records, shard, num_shards)
+    summary = predict_records(cfg, args, predictor, model_cfg, variant, own_records, prediction_folder, bucket,
+                              shard=shard)
+    summary["images"] = len(own_records)
+    summary["seconds"] = time.perf_counter() - start
+    with open(os.path.join(prediction_folder, "inference_stats.shard{}.json".format(shard)), "w") as file:
+        json.dump(summary, file)
+
+
+def sharded_inference(cfg, args, prediction_folder, bucket):
+    """
+    Splits args.eval_dataset over --eval-workers processes, on one GPU each or on an equal part of the CPU cores. The
+    workers are spawned, not launched, so there is no process group to tear down at exit. Every worker writes its own
+    predictions.shard<i>.jsonl, which are merged in dataset order into predictions.jsonl at the end.
+
+    Exports and quantized models are made and checked here first, as well as batching, so the workers only load them
+    from the cache next to the checkpoint. The same goes for the prediction cache, which is synced down once.
+
+    @return: dict with the images/s of the whole run and of each worker
+    """
+    num_shards = args.eval_workers
+    records = DatasetCatalog.get(args.eval_dataset)
+    # the model itself is only built here if it has to be exported or quantized, or batching is checked
+    predictor, model_cfg, variant = prepare_model(cfg, args, bucket, records)
+    del predictor
+    cache = build_prediction_cache(cfg, args, model_cfg, variant, bucket)
+    if cache is not None:
+        with TransferPool(bucket, max_workers=args.transfer_workers) as transfers:
+            cache.sync_down(transfers)
+
+    registrations = dataset_registrations([args.eval_dataset, "car_damage_train"])
+    logger.info("Running inference on {} images with {} workers".format(len(records), num_shards))
+    start = time.perf_counter()
+    mp.start_processes(_worker, args=(cfg, args, num_shards, registrations, prediction_folder),
+                       nprocs=num_shards, join=True, start_method="spawn")
+    seconds = time.perf_counter() - start
+
+    summary = {"workers": num_shards, "images": len(records), "seconds": seconds,
+               "images_per_second": len(records) / seconds}
+    for shard in range(num_shards):
+        stats_path = os.path.join(prediction_folder, "inference_stats.shard{}.json".format(shard))
+        with open(stats_path) as file:
+            summary["shard{}".format(shard)] = json.load(file)
+        os.remove(stats_path)
+    logger.info("Sharded inference: {} images in {:.1f}s, {:.2f} img/s over {} workers".format(
+        len(records), seconds, summary["images_per_second"], num_shards))
+
+    if args.export_format == "jsonl":
+        shard_paths = [os.path.join(prediction_folder, "predictions.shard{}.jsonl".format(shard))
+                       for shard in range(num_shards)]
+        output_path = os.path.join(prediction_folder, "predictions.jsonl")
+        merged = merge_shards(shard_paths, output_path, records)
+        for path in shard_paths:
+            os.remove(path)
+        logger.info("Merged predictions of {} images into {}".format(merged, output_path))
+        with TransferPool(bucket, max_workers=1) as transfers:
+            transfers.upload(output_path, output_path)
+    return summary
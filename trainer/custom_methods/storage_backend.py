@@ -0,0 +1,404 @@
+import base64
+import hashlib
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED, FIRST_EXCEPTION
+
+logger = logging.getLogger(__name__)
+
+# one client per process, shared by all threads of that process (clients should not be carried over a fork)
+_clients = {}
+_backends = {}
+_lock = threading.Lock()
+
+
+class StorageBackend:
+    """
+    Interface of the storage runs are saved to and loaded from. Remote paths are relative to the root of the bucket,
+    e.g. "model_output/run_0/model_final.pth", which is the same as the local path relative to the working directory.
+    """
+
+    def upload(self, local_path: str, remote_path: str):
+        raise NotImplementedError
+
+    def download(self, remote_path: str, local_path: str):
+        raise NotImplementedError
+
+    def list(self, prefix: str, delimiter: str = None):
+        """
+        Lists objects that start with prefix. Without delimiter, the entire tree under the prefix is returned. With
+        a delimiter, names that contain the delimiter after the prefix are collapsed into prefixes (the "folders").
+
+        @return: tuple of (names, prefixes), both sorted lists of strings
+        """
+        raise NotImplementedError
+
+    def exists(self, remote_path: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, remote_path: str):
+        raise NotImplementedError
+
+    def stat(self, remote_path: str):
+        """
+        @return: dict with the size, md5 (base64, as GCS reports it, None if unknown) and generation (changes with every
+                 write) of the object, None if it does not exist
+        """
+        raise NotImplementedError
+
+    def read_range(self, remote_path: str, start: int, end: int, generation=None) -> bytes:
+        """
+        @return: bytes start up to (not including) end of the object, of the given generation if not None
+        """
+        raise NotImplementedError
+
+    def upload_range(self, local_path: str, remote_path: str, start: int, end: int):
+        """
+        Uploads bytes start up to (not including) end of local_path as its own object, a part of a composite upload.
+        """
+        raise NotImplementedError
+
+    def compose(self, remote_path: str, sources):
+        """
+        Concatenates the objects in sources (in order) into remote_path, in the bucket itself.
+        """
+        raise NotImplementedError
+
+    def create_if_absent(self, remote_path: str, data: bytes) -> bool:
+        """
+        Creates an object with data, only if there is no object at remote_path yet. The check and the create are one
+        atomic operation, so of concurrent callers exactly one succeeds.
+
+        @return: True if this call created the object
+        """
+        raise NotImplementedError
+
+
+class GCSBackend(StorageBackend):
+    """
+    Google Cloud Storage bucket, the client is created once per process and reused.
+    """
+
+    def __init__(self, bucket_name: str, project: str = 'your-project-name', pool_size: int = 32):
+        self.client = _get_gcs_client(project, pool_size)
+        self.bucket = self.client.bucket(bucket_name)
+
+    def upload(self, local_path, remote_path):
+        self.bucket.blob(remote_path).upload_from_filename(local_path)
+
+    def download(self, remote_path, local_path):
+        self.bucket.blob(remote_path).download_to_filename(local_path)
+
+    def list(self, prefix, delimiter=None):
+        # Note: Client.list_blobs requires at least package version 1.17.0.
+        iterator = self.client.list_blobs(self.bucket, prefix=prefix, delimiter=delimiter)
+        names = [blob.name for blob in iterator]
+        # prefixes are only filled in once all pages are consumed
+        return sorted(names), sorted(iterator.prefixes)
+
+    def exists(self, remote_path):
+        return self.bucket.blob(remote_path).exists()
+
+    def delete(self, remote_path):
+        self.bucket.blob(remote_path).delete()
+
+    def stat(self, remote_path):
+        blob = self.bucket.get_blob(remote_path)
+        if blob is None:
+            return None
+        return {"size": blob.size, "md5": blob.md5_hash, "generation": blob.generation}
+
+    def read_range(self, remote_path, start, end, generation=None):
+        # the end of a GCS range is inclusive
+        return self.bucket.blob(remote_path, generation=generation).download_as_bytes(start=start, end=end - 1)
+
+    def upload_range(self, local_path, remote_path, start, end):
+        with open(local_path, "rb") as file:
+            file.seek(start)
+            self.bucket.blob(remote_path).upload_from_string(file.read(end - start))
+
+    def compose(self, remote_path, sources):
+        # GCS composes up to 32 objects at once, composite objects have a crc32c but no md5
+        self.bucket.blob(remote_path).compose([self.bucket.blob(source) for source in sources])
+
+    def create_if_absent(self, remote_path, data):
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            # generation 0 means the object may not exist yet, GCS checks this server side
+            self.bucket.blob(remote_path).upload_from_string(data, if_generation_match=0)
+        except PreconditionFailed:
+            return False
+        return True
+
+
+class LocalBackend(StorageBackend):
+    """
+    Stand-in for a bucket on the local filesystem, with the same interface, so everything that talks to the bucket
+    can be run and benchmarked offline. latency (in seconds) is added to every request to mimic network round trips.
+    """
+
+    def __init__(self, root: str, latency: float = 0.0):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, remote_path):
+        return os.path.join(self.root, remote_path)
+
+    def _request(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def upload(self, local_path, remote_path):
+        self._request()
+        target = self._path(remote_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # write next to the target and rename, so readers never see half a file (objects are atomic in GCS too)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".upload_")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file, open(local_path, "rb") as source:
+                shutil.copyfileobj(source, tmp_file)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def download(self, remote_path, local_path):
+        self._request()
+        shutil.copyfile(self._path(remote_path), local_path)
+
+    def list(self, prefix, delimiter=None):
+        self._request()
+        base_dir = self._path(os.path.dirname(prefix))
+        if not os.path.isdir(base_dir):
+            return [], []
+        relative_base = os.path.relpath(base_dir, self.root)
+        relative_base = "" if relative_base == "." else relative_base + "/"
+
+        names, prefixes = [], set()
+        if delimiter == "/":
+            # only the entries of a single folder are needed
+            for entry in os.scandir(base_dir):
+                name = relative_base + entry.name
+                if entry.name.startswith(".upload_") or not name.startswith(prefix):
+                    continue
+                if entry.is_dir():
+                    prefixes.add(name + "/")
+                else:
+                    names.append(name)
+            return sorted(names), sorted(prefixes)
+
+        for directory, _, files in os.walk(base_dir):
+            for file_name in files:
+                if file_name.startswith(".upload_"):
+                    continue
+                name = os.path.relpath(os.path.join(directory, file_name), self.root).replace(os.sep, "/")
+                if not name.startswith(prefix):
+                    continue
+                remainder = name[len(prefix):]
+                if delimiter and delimiter in remainder:
+                    prefixes.add(prefix + remainder.split(delimiter)[0] + delimiter)
+                else:
+                    names.append(name)
+        return sorted(names), sorted(prefixes)
+
+    def exists(self, remote_path):
+        self._request()
+        return os.path.isfile(self._path(remote_path))
+
+    def delete(self, remote_path):
+        self._request()
+        os.remove(self._path(remote_path))
+
+    def stat(self, remote_path):
+        self._request()
+        path = self._path(remote_path)
+        if not os.path.isfile(path):
+            return None
+        digest = hashlib.md5()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        # uploads replace the file, so the modification time serves as generation
+        return {"size": os.path.getsize(path), "md5": base64.b64encode(digest.digest()).decode(),
+                "generation": os.stat(path).st_mtime_ns}
+
+    def read_range(self, remote_path, start, end, generation=None):
+        self._request()
+        with open(self._path(remote_path), "rb") as file:
+            file.seek(start)
+            return file.read(end - start)
+
+    def upload_range(self, local_path, remote_path, start, end):
+        self._request()
+        target = self._path(remote_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(local_path, "rb") as source, open(target, "wb") as file:
+            source.seek(start)
+            file.write(source.read(end - start))
+
+    def compose(self, remote_path, sources):
+        self._request()
+        target = self._path(remote_path)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".upload_")
+        with os.fdopen(fd, "wb") as file:
+            for source in sources:
+                with open(self._path(source), "rb") as part:
+                    shutil.copyfileobj(part, file)
+        os.replace(tmp_path, target)
+
+    def create_if_absent(self, remote_path, data):
+        self._request()
+        target = self._path(remote_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            fd = os.open(target, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        return True
+
+
+def _get_gcs_client(project, pool_size):
+    with _lock:
+        key = (os.getpid(), project)
+        if key not in _clients:
+            from google.cloud import storage
+            client = storage.Client(project=project)
+            try:
+                # the default connection pool of 10 is smaller than the transfer pools
+                import requests
+                adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                client._http.mount("https://", adapter)
+            except Exception:
+                logger.warning("Could not resize the connection pool of the storage client.")
+            _clients[key] = client
+        return _clients[key]
+
+
+def get_backend(bucket_name: str) -> StorageBackend:
+    """
+    @param bucket_name: name of a GCS bucket, or file:///some/folder for the local stand-in, which can mimic network
+                        round trips with file:///some/folder?latency=0.05
+    @return: the backend for this bucket, shared within the process
+    """
+    with _lock:
+        key = (os.getpid(), bucket_name)
+        backend = _backends.get(key)
+    if backend is None:
+        if bucket_name.startswith("file://"):
+            root, _, latency = bucket_name[len("file://"):].partition("?latency=")
+            backend = LocalBackend(root, float(latency or 0.0))
+        else:
+            backend = GCSBackend(bucket_name)
+        with _lock:
+            backend = _backends.setdefault(key, backend)
+    return backend
+
+
+class TransferPool:
+    """
+    Bounded pool of concurrent transfers. Failed transfers are retried with exponential backoff and jitter, errors of
+    the last attempt are raised by wait.
+    """
+
+    def __init__(self, backend: StorageBackend, max_workers: int = 8, max_retries: int = 5,
+                 backoff: float = 0.5, max_backoff: float = 30.0):
+        self.backend = backend
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._executor = ThreadPoolExecutor(max(1, int(max_workers)), thread_name_prefix="transfer")
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+
+    def upload(self, local_path: str, remote_path: str):
+        return self.submit(self.backend.upload, local_path, remote_path)
+
+    def download(self, remote_path: str, local_path: str):
+        return self.submit(self.backend.download, remote_path, local_path)
+
+    def submit(self, fn, *args):
+        """
+        Runs fn(*args) in the pool with retries.
+
+        @return: future of the result
+        """
+        future = self._executor.submit(self._with_retries, fn, *args)
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        # finished transfers without an error do not have to be kept around
+        if future.exception() is None:
+            with self._futures_lock:
+                self._futures.discard(future)
+
+    def _with_retries(self, fn, *args):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return fn(*args)
+            except (FileNotFoundError, IsADirectoryError, ValueError):
+                # retrying does not fix these
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning("Transfer {}{} failed ({}), retrying in {:.1f}s".format(
+                    getattr(fn, "__name__", "transfer"), args, e, delay))
+                time.sleep(delay)
+
+    def wait(self, timeout: float = None):
+        """
+        Waits for all submitted transfers and raises the first error, if any.
+
+        @return: number of transfers that did not finish within the timeout
+        """
+        with self._futures_lock:
+            futures = list(self._futures)
+        done, not_done = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+        for future in done:
+            with self._futures_lock:
+                self._futures.discard(future)
+            if future.exception() is not None:
+                raise future.exception()
+        return len(not_done)
+
+    def wait_all(self, timeout: float = None):
+        """
+        Waits for all submitted transfers, also after one of them failed, without raising.
+
+        @return: tuple of (errors of the failed transfers, number of transfers that did not finish within the timeout)
+        """
+        with self._futures_lock:
+            futures = list(self._futures)
+        done, not_done = wait(futures, timeout=timeout, return_when=ALL_COMPLETED)
+        errors = []
+        for future in done:
+            with self._futures_lock:
+                self._futures.discard(future)
+            if future.exception() is not None:
+                errors.append(future.exception())
+        return errors, len(not_done)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.wait()
+        self.shutdown()
@@ -1,13 +1,59 @@
 # __init__.py
 
-from .trainers import COCOTrainer, AdetCOCOTrainer
-from .loss_metrics import LossMetricWriter, LossEvalHook
-from .blendmask_mapper import BlendmaskMapperWithBasis
+import importlib
+
+from .trainers import COCOTrainer
+from .loss_metrics import LossMetricWriter, LossEvalHook, MetricSink, build_metric_sinks
+from .streaming_evaluator import StreamingCOCOEvaluator
+from .artifact_upload import ArtifactUploader, ArtifactUploadHook
+from .architectures import Architecture, get_architecture, register_architecture
+from .startup_profile import StartupProfiler, StartupProfileHook, profiler
+from .mixed_precision import MixedPrecisionTrainer
+from .accumulation import AccumulationTrainer, scale_schedule
+from .early_stopping import EarlyStoppingHook
+from .phase_timing import PhaseTimingHook
+from .trace_capture import TraceCaptureHook
+from .loader_memory import LoaderMemoryHook, loader_memory
+from .shared_dataset import SharedDatasetList, shared_train_dataset
+
+# these import AdelaiDet, so they are only imported when used
+_LAZY = {
+    "AdetCOCOTrainer": ".adet_trainer",
+    "BlendmaskMapperWithBasis": ".blendmask_mapper",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        return getattr(importlib.import_module(_LAZY[name], __name__), name)
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
 
 __all__ = [
     "LossMetricWriter",
     "COCOTrainer",
     "AdetCOCOTrainer",
     "LossEvalHook",
-    "BlendmaskMapperWithBasis"
-]
\ No newline at end of file
+    "MetricSink",
+    "build_metric_sinks",
+    "BlendmaskMapperWithBasis",
+    "StreamingCOCOEvaluator",
+    "ArtifactUploader",
+    "ArtifactUploadHook",
+    "Architecture",
+    "get_architecture",
+    "register_architecture",
+    "StartupProfiler",
+    "StartupProfileHook",
+    "profiler",
+    "MixedPrecisionTrainer",
+    "AccumulationTrainer",
+    "scale_schedule",
+    "EarlyStoppingHook",
+    "PhaseTimingHook",
+    "TraceCaptureHook",
+    "LoaderMemoryHook",
+    "loader_memory",
+    "SharedDatasetList",
+    "shared_train_dataset"
+]
@@ -0,0 +1,120 @@
+import contextlib
+import logging
+import time
+
+import torch
+from detectron2.utils.events import get_event_storage
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.parallel import DistributedDataParallel
+
+from .mixed_precision import MixedPrecisionTrainer, FP32_MODULES
+
+logger = logging.getLogger(__name__)
+
+
+def micro_batch_cfg(cfg, accumulation_steps):
+    """
+    @return: cfg with SOLVER.IMS_PER_BATCH the size of one micro-batch, for the data loader
+    """
+    if accumulation_steps <= 1:
+        return cfg
+    if cfg.SOLVER.IMS_PER_BATCH % accumulation_steps != 0:
+        raise ValueError("The batch of {} images can not be split in {} micro-batches".format(
+            cfg.SOLVER.IMS_PER_BATCH, accumulation_steps))
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.SOLVER.IMS_PER_BATCH //= accumulation_steps
+    cfg.freeze()
+    return cfg
+
+
+def scale_schedule(cfg, reference_batch):
+    """
+    Linear scaling rule from the batch the schedule of the config is made for to SOLVER.IMS_PER_BATCH: the learning
+    rate grows with the batch, and the iterations (steps, warmup, checkpoint and eval period) shrink with it, so the
+    run sees the same number of images. Like DefaultTrainer.auto_scale_workers, but for the batch instead of the GPUs.
+    """
+    factor = cfg.SOLVER.IMS_PER_BATCH / reference_batch
+    if factor == 1:
+        return cfg
+    cfg.SOLVER.BASE_LR *= factor
+    cfg.SOLVER.MAX_ITER = int(round(cfg.SOLVER.MAX_ITER / factor))
+    cfg.SOLVER.WARMUP_ITERS = int(round(cfg.SOLVER.WARMUP_ITERS / factor))
+    cfg.SOLVER.STEPS = tuple(int(round(step / factor)) for step in cfg.SOLVER.STEPS)
+    cfg.SOLVER.CHECKPOINT_PERIOD = max(1, int(round(cfg.SOLVER.CHECKPOINT_PERIOD / factor)))
+    cfg.TEST.EVAL_PERIOD = max(1, int(round(cfg.TEST.EVAL_PERIOD / factor)))
+    logger.info("Scaled the schedule from a batch of {} to {}: lr {}, {} iterations, steps {}".format(
+        reference_batch, cfg.SOLVER.IMS_PER_BATCH, cfg.SOLVER.BASE_LR, cfg.SOLVER.MAX_ITER, cfg.SOLVER.STEPS))
+    return cfg
+
+
+def scale_bn_momentum(model, accumulation_steps):
+    """
+    BatchNorm updates its running statistics once per micro-batch, so accumulation_steps times per iteration. Their
+    momentum is lowered so the running statistics average over as many iterations as without accumulation.
+
+    @return: number of BatchNorm layers
+    """
+    count = 0
+    for module in model.modules():
+        if isinstance(module, _BatchNorm) and module.momentum is not None:
+            module.momentum = 1 - (1 - module.momentum) ** (1 / accumulation_steps)
+            count += 1
+    return count
+
+
+class AccumulationTrainer(MixedPrecisionTrainer):
+    """
+    Splits every iteration in accumulation_steps micro-batches of the data loader (which is built for the size of a
+    micro-batch), and steps the optimizer once on the sum of their gradients. The losses are divided by the number of
+    micro-batches, so the gradient is that of the whole batch and the solver schedule stays the one of the batch.
+    Gradients are only all-reduced after the last micro-batch. Works in every precision of the MixedPrecisionTrainer.
+
+    The throughput of the whole batch is reported as effective_images_per_second.
+    """
+
+    @classmethod
+    def from_trainer(cls, trainer, precision, fp32_modules=FP32_MODULES, accumulation_steps=1, micro_batch_size=1):
+        new = super().from_trainer(trainer, precision, fp32_modules)
+        new.accumulation_steps = accumulation_steps
+        new.micro_batch_size = micro_batch_size
+        num_bn = scale_bn_momentum(new.model, accumulation_steps)
+        logger.info("Accumulating {} micro-batches of {} images per iteration, {} BatchNorm momenta scaled".format(
+            accumulation_steps, micro_batch_size, num_bn))
+        return new
+
+    def no_sync(self):
+        if isinstance(self.model, DistributedDataParallel):
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
+    def run_step(self):
+        assert self.model.training, "[AccumulationTrainer] model was changed to eval mode!"
+        start = time.perf_counter()
+        data_time = 0.0
+        loss_sums = {}
+        self.optimizer.zero_grad()
+        for step in range(self.accumulation_steps):
+            data_start = time.perf_counter()
+            data = next(self._data_loader_iter)
+            data_time += time.perf_counter() - data_start
+
+            last = step == self.accumulation_steps - 1
+            with contextlib.ExitStack() as stack:
+                if not last:
+                    stack.enter_context(self.no_sync())
+                with self.autocast():
+                    loss_dict = self.model(data)
+                    if isinstance(loss_dict, torch.Tensor):
+                        loss_dict = {"total_loss": loss_dict}
+                    losses = sum(loss_dict.values()) / self.accumulation_steps
+                self.grad_scaler.scale(losses).backward()
+            for name, value in loss_dict.items():
+                loss_sums[name] = loss_sums.get(name, 0) + value.detach() / self.accumulation_steps
+
+        self._write_metrics(loss_sums, data_time)
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
+        get_event_storage().put_scalar(
+            "effective_images_per_second",
+            self.accumulation_steps * self.micro_batch_size / (time.perf_counter() - start))
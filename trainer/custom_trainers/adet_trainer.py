@@ -0,0 +1,86 @@
+import detectron2.data.transforms as T
+from adet.checkpoint import AdetCheckpointer
+from adet.layers import BezierAlign, DefROIAlign, IOULoss
+from detectron2.data import build_detection_train_loader
+from detectron2.engine import DefaultTrainer
+
+from .accumulation import micro_batch_cfg
+from .async_checkpoint import AsyncCheckpointMixin
+from .blendmask_mapper import BlendmaskMapperWithBasis
+from .mixed_precision import FP32_MODULES
+from .shared_dataset import shared_train_dataset
+from .trainers import COCOTrainer
+
+
+class AsyncAdetCheckpointer(AsyncCheckpointMixin, AdetCheckpointer):
+    def __init__(self, model, save_dir="", *, retention=None, save_to_disk=None, **checkpointables):
+        super().__init__(model, save_dir, save_to_disk=save_to_disk, **checkpointables)
+        self.init_async(retention)
+
+
+class AdetCOCOTrainer(COCOTrainer):
+    """
+    We use the "DefaultTrainer" which contains pre-defined default logic for
+    standard training workflow. As in "train_net", the build evaluator is implemented to do
+    evaluation at specified points (TEST.EVAL_PERIOD) during training.
+    """
+
+    foldername = ""
+    async_checkpointer_class = AsyncAdetCheckpointer
+    # the AdelaiDet kernels have no half versions, and the box areas of the IoU loss of FCOS (the proposal generator
+    # of BlendMask) overflow in fp16
+    fp32_modules = FP32_MODULES + (BezierAlign, DefROIAlign, IOULoss)
+
+    @staticmethod
+    def set_foldername(cls, foldername):
+        cls.foldername = foldername
+
+    # Not sure if needed, but implemented in Adet train_net
+    def resume_or_load(self, resume=True):
+        if not isinstance(self.checkpointer, AdetCheckpointer):
+            # support loading a few other backbones
+            self.checkpointer = AdetCheckpointer(
+                self.model,
+                self.cfg.OUTPUT_DIR,
+                optimizer=self.optimizer,
+                scheduler=self.scheduler,
+            )
+        super().resume_or_load(resume=resume)
+
+    @classmethod
+    def build_train_loader(cls, cfg):
+        # account for randomly rotated images
+        # more augs can be added by using this strategy
+        augs = [T.RandomRotation([-60.0, 60.0])]
+        cfg = micro_batch_cfg(cfg, cls.accumulation_steps)
+
+        if "Blend" in cfg.MODEL.META_ARCHITECTURE:
+            mapper = BlendmaskMapperWithBasis(cfg, is_train=True, augmentations=augs,
+                                              foldername=cls.foldername)
+        else:
+            mapper = None
+        dataset = shared_train_dataset(cfg) if cls.shared_dataset else None
+        return build_detection_train_loader(cfg, mapper=mapper, dataset=dataset)
+
+    # for now validation loss during training does not work
+    def build_hooks(self):
+        checkpoint_hooks = self.use_async_checkpointer()
+        hooks = DefaultTrainer.build_hooks(self) + checkpoint_hooks
+
+        # use same augs as in build_train_loader
+        # augs = [T.RandomRotation([-60.0, 60.0])]
+        # hooks = super().build_hooks()
+        # cfg = self.cfg.clone()
+        #
+        # cfg.defrost()
+        # hooks.insert(-1, LossEvalHook(
+        #     cfg.TEST.EVAL_PERIOD,
+        #     self.model,
+        #     build_detection_test_loader(
+        #         self.cfg,
+        #         self.cfg.DATASETS.TEST[0],
+        #         BlendmaskMapperWithBasis(cfg, is_train=True, augmentations=augs,
+        #                                  foldername=self.foldername)
+        #     )
+        # ))
+        return self.add_optional_hooks(hooks)
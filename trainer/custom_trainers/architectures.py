@@ -0,0 +1,144 @@
+from .startup_profile import profiler
+
+_ARCHITECTURES = {}
+_LOADED = {}
+
+
+def register_architecture(*names):
+    """
+    Registers an Architecture under its --architecture names, the first one is its own name. Nothing of its backend
+    is imported until the architecture is used.
+    """
+    def decorator(cls):
+        cls.name = names[0]
+        for name in names:
+            _ARCHITECTURES[name] = cls
+        return cls
+    return decorator
+
+
+def get_architecture(name):
+    """
+    @param name: value of --architecture, case insensitive
+    @return: the Architecture, with its backend imported
+    """
+    key = name.lower()
+    if key not in _ARCHITECTURES:
+        raise ValueError("Unknown architecture {}, choose from {}".format(
+            name, ", ".join(sorted(set(cls.name for cls in _ARCHITECTURES.values())))))
+    cls = _ARCHITECTURES[key]
+    if cls not in _LOADED:
+        architecture = cls()
+        with profiler.phase("import_" + cls.name):
+            architecture.load()
+        _LOADED[cls] = architecture
+    return _LOADED[cls]
+
+
+class Architecture:
+    """
+    Training backend of an --architecture: its default config, trainer and training loop. load imports the backend,
+    the other methods only use what it imported.
+    """
+
+    name = ""
+    # whether the training loop runs detectron2 hooks, the d2go loop does not
+    uses_hooks = True
+    # whether the dataset always needs preprocessing, like the .npz files of Blendmask
+    needs_preprocess = False
+
+    def load(self):
+        raise NotImplementedError
+
+    def default_cfg(self):
+        """
+        @return: default config, runner (or None if the architecture has none)
+        """
+        raise NotImplementedError
+
+    def adjust_cfg(self, cfg, args):
+        """
+        Settings of the architecture on top of the config file and command line options.
+        """
+        pass
+
+    def build_trainer(self, cfg, args, runner):
+        raise NotImplementedError
+
+    def train(self, trainer, cfg, args):
+        with profiler.phase("checkpoint_load"):
+            trainer.resume_or_load(resume=args.resume)
+        if args.resume and args.iterations:
+            # resume takes old settings, so add iterations that we want to run. the trainer took max_iter when it was
+            # built, so it is set there as well
+            cfg.defrost()
+            cfg.SOLVER.MAX_ITER += int(args.iterations)
+            trainer.max_iter = cfg.SOLVER.MAX_ITER
+        return trainer.train()
+
+
+@register_architecture("detectron2", "d2", "")
+class Detectron2Architecture(Architecture):
+    def load(self):
+        from detectron2.config import get_cfg
+        from .trainers import COCOTrainer
+        self._get_cfg = get_cfg
+        self._trainer_class = COCOTrainer
+
+    def default_cfg(self):
+        return self._get_cfg(), None
+
+    def build_trainer(self, cfg, args, runner):
+        return self._trainer_class(cfg)
+
+
+@register_architecture("adet")
+class AdetArchitecture(Architecture):
+    # adet should (as far as I've tested) also just run mask-rcnn, but I keep it separate just in case
+    needs_preprocess = True
+
+    def load(self):
+        from adet.config import get_cfg
+        from .adet_trainer import AdetCOCOTrainer
+        self._get_cfg = get_cfg
+        self._trainer_class = AdetCOCOTrainer
+
+    def default_cfg(self):
+        return self._get_cfg(), None
+
+    def adjust_cfg(self, cfg, args):
+        # if a single gpu is used this needs to be set (SyncBN), error otherwise. BatchNorm statistics of micro-batches
+        # of a few images are too noisy, so with accumulation GroupNorm is used instead
+        if args.num_gpus == 1:
+            cfg.MODEL.BASIS_MODULE.NORM = "GN" if args.accumulation_steps > 1 else "BN"
+
+    def build_trainer(self, cfg, args, runner):
+        self._trainer_class.foldername = args.dataset.split('/')[-1] + "images"
+        return self._trainer_class(cfg)
+
+
+@register_architecture("d2go")
+class D2GoArchitecture(Architecture):
+    uses_hooks = False
+
+    def load(self):
+        from d2go.runner import GeneralizedRCNNRunner
+        from d2go.setup import setup_after_launch
+        self._runner_class = GeneralizedRCNNRunner
+        self._setup_after_launch = setup_after_launch
+
+    def default_cfg(self):
+        runner = self._runner_class()
+        # as cfg is grabbed from the runner in this architecture
+        return runner.get_default_cfg(), runner
+
+    def build_trainer(self, cfg, args, runner):
+        return runner
+
+    def train(self, trainer, cfg, args):
+        self._setup_after_launch(cfg, cfg.OUTPUT_DIR, trainer)  # some d2go magic required, crash if removed
+        with profiler.phase("model_build"):
+            model = trainer.build_model(cfg)
+        # the d2go loop has no hooks, so its profile ends where training starts
+        profiler.report(cfg.OUTPUT_DIR, total_name="time_to_train")
+        return trainer.do_train(cfg, model, resume=args.resume)
@@ -0,0 +1,237 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from detectron2.engine import HookBase, PeriodicCheckpointer
+
+from custom_methods.storage_backend import TransferPool
+
+logger = logging.getLogger(__name__)
+
+
+def file_signature(path):
+    """
+    @return: (size, modification time) of path, None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class ArtifactUploader:
+    """
+    Uploads files of a run to the bucket in a background pool, under the same path as locally. A file is uploaded at
+    most once per version: enqueueing a file that is being uploaded only marks it to be uploaded again afterwards if it
+    changed, and a file that did not change since its last upload is skipped.
+
+    Files above composite_threshold bytes are uploaded as composite_parts parallel parts, which are composed into the
+    object in the bucket (a parallel composite upload, like gsutil does for large files).
+    """
+
+    def __init__(self, backend, max_workers=8, composite_threshold=100 * 1024 * 1024, composite_parts=8):
+        self.backend = backend
+        self.composite_threshold = composite_threshold
+        self.composite_parts = max(1, min(32, int(composite_parts)))
+        self._transfers = TransferPool(backend, max_workers=max_workers)
+        self._part_pool = ThreadPoolExecutor(self.composite_parts, thread_name_prefix="upload_part")
+        self._lock = threading.Lock()
+        self._uploaded = {}
+        self._pending = set()
+        self._dirty = set()
+        self._removed = set()
+        self._watched = {}
+        self._watch_folder = None
+        self._stop_watching = threading.Event()
+        self._watcher = None
+        self.num_uploads = 0
+        self.num_skipped = 0
+
+    def enqueue(self, path):
+        """
+        Uploads path in the background, unless the same version was uploaded already.
+        """
+        with self._lock:
+            self._removed.discard(path)
+            if path in self._pending:
+                # uploaded again once the current upload is done, if it changed by then
+                self._dirty.add(path)
+                return
+            signature = file_signature(path)
+            if signature is None or self._uploaded.get(path) == signature:
+                self.num_skipped += 1
+                return
+            self._pending.add(path)
+        self._transfers.submit(self._upload, path)
+
+    def enqueue_changed(self, folder, skip_extensions=()):
+        """
+        Enqueues the files in folder that changed since the last call, hidden files (temporary files) are skipped.
+        """
+        for directory, _, files in os.walk(folder):
+            for file_name in files:
+                if file_name.startswith(".") or file_name.endswith(tuple(skip_extensions)):
+                    continue
+                path = os.path.join(directory, file_name)
+                signature = file_signature(path)
+                if signature is not None and self._watched.get(path) != signature:
+                    self._watched[path] = signature
+                    self.enqueue(path)
+
+    def start_watching(self, folder, period=60.0):
+        """
+        Enqueues the changed files of folder every period seconds from a background thread, for training loops that
+        have no hooks.
+        """
+        def watch():
+            while not self._stop_watching.wait(period):
+                self.enqueue_changed(folder)
+
+        self._watch_folder = folder
+        self._watcher = threading.Thread(target=watch, name="ArtifactWatcher", daemon=True)
+        self._watcher.start()
+
+    def remove(self, path):
+        """
+        Deletes path from the bucket in the background, after its upload if that is still running.
+        """
+        with self._lock:
+            self._removed.add(path)
+            if path in self._pending:
+                # deleted by the upload once it is done
+                return
+        self._transfers.submit(self._delete, path)
+
+    def _delete(self, path):
+        with self._lock:
+            self._uploaded.pop(path, None)
+        if self.backend.exists(path):
+            self.backend.delete(path)
+
+    def _upload(self, path):
+        try:
+            while True:
+                with self._lock:
+                    self._dirty.discard(path)
+                signature = file_signature(path)
+                if signature is not None:
+                    if signature[0] > self.composite_threshold:
+                        self._upload_composite(path, signature[0])
+                    else:
+                        self.backend.upload(path, path)
+                # done, unless the file changed during the upload, decided under the lock so a remove is not missed
+                with self._lock:
+                    if signature is not None:
+                        self._uploaded[path] = signature
+                        self.num_uploads += 1
+                    removed = path in self._removed
+                    if signature is None or removed or path not in self._dirty or file_signature(path) == signature:
+                        self._pending.discard(path)
+                        self._dirty.discard(path)
+                        break
+        except BaseException:
+            with self._lock:
+                self._pending.discard(path)
+                self._dirty.discard(path)
+            raise
+        if removed:
+            self._delete(path)
+
+    def _upload_composite(self, path, size):
+        part_size = -(-size // self.composite_parts)
+        parts = ["{}.part{}".format(path, i) for i in range(self.composite_parts)]
+        futures = [self._part_pool.submit(self.backend.upload_range, path, part, i * part_size,
+                                          min(size, (i + 1) * part_size))
+                   for i, part in enumerate(parts)]
+        for future in futures:
+            future.result()
+        self.backend.compose(path, parts)
+        for part in parts:
+            self.backend.delete(part)
+
+    def flush(self, timeout=None):
+        """
+        Waits for the enqueued uploads.
+
+        @return: number of uploads that did not finish within the timeout
+        """
+        return self._transfers.wait(timeout)
+
+    def close(self, timeout=None):
+        """
+        Stops watching, enqueues the last changes of the watched folder and waits at most timeout seconds for the
+        uploads. Uploads that are still running after that are left to the daemon threads. Failed uploads are logged,
+        not raised: close runs at the end of the job, also after an error in training, which it should not hide.
+
+        @return: tuple of (number of uploads that failed after their retries, number of uploads that did not finish)
+        """
+        errors, not_done = [], 0
+        try:
+            if self._watcher is not None:
+                self._stop_watching.set()
+                self._watcher.join()
+                self.enqueue_changed(self._watch_folder)
+            errors, not_done = self._transfers.wait_all(timeout)
+            for error in errors:
+                logger.error("Upload failed: {!r}".format(error))
+            if errors:
+                logger.error("{} uploads failed, those files are not in the bucket".format(len(errors)))
+            if not_done:
+                logger.warning("{} uploads did not finish within {}s".format(not_done, timeout))
+            logger.info("Uploaded {} files, skipped {} unchanged ones".format(self.num_uploads, self.num_skipped))
+        finally:
+            self._transfers.shutdown(wait=not_done == 0)
+            self._part_pool.shutdown(wait=not_done == 0)
+        return len(errors), not_done
+
+
+class ArtifactUploadHook(HookBase):
+    """
+    Uploads the artifacts of a run as soon as they are finished: checkpoints (and last_checkpoint) right after the
+    checkpointer saved them, and the files of the writers (metrics.json, events, log) when they changed, checked every
+    scan_period iterations after the writers ran. Register it after the writers, on the main process only.
+    """
+
+    def __init__(self, uploader, output_dir, scan_period=20):
+        self._uploader = uploader
+        self._output_dir = output_dir
+        self._scan_period = scan_period
+
+    def before_train(self):
+        # the periodic checkpointer can hold another checkpointer than the trainer, e.g. with the AdetCheckpointer
+        checkpointers = [self.trainer.checkpointer] + [hook.checkpointer for hook in self.trainer._hooks
+                                                       if isinstance(hook, PeriodicCheckpointer)]
+        wrapped = set()
+        for checkpointer in checkpointers:
+            if id(checkpointer) not in wrapped:
+                wrapped.add(id(checkpointer))
+                self._wrap_save(checkpointer)
+
+    def _wrap_save(self, checkpointer):
+        uploader = self._uploader
+        if hasattr(checkpointer, "add_save_callback"):
+            # asynchronous checkpointer, the file is only there once it is written in the background
+            checkpointer.add_save_callback(uploader.enqueue)
+            checkpointer.add_save_callback(
+                lambda path: uploader.enqueue(os.path.join(checkpointer.save_dir, "last_checkpoint")))
+            # checkpoints removed by the retention policy are removed from the bucket as well
+            checkpointer.add_delete_callback(uploader.remove)
+            return
+        save = checkpointer.save
+
+        def save_and_upload(name, **kwargs):
+            save(name, **kwargs)
+            uploader.enqueue(os.path.join(checkpointer.save_dir, "{}.pth".format(name)))
+            uploader.enqueue(os.path.join(checkpointer.save_dir, "last_checkpoint"))
+
+        checkpointer.save = save_and_upload
+
+    def after_step(self):
+        if (self.trainer.iter + 1) % self._scan_period == 0:
+            # checkpoints are enqueued by the checkpointer
+            self._uploader.enqueue_changed(self._output_dir, skip_extensions=(".pth",))
+
+    def after_train(self):
+        self._uploader.enqueue_changed(self._output_dir, skip_extensions=(".pth",))
@@ -0,0 +1,190 @@
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.engine import HookBase
+from detectron2.utils.events import get_event_storage
+
+logger = logging.getLogger(__name__)
+
+PERIODIC_CHECKPOINT = re.compile(r"^model_(\d+)$")
+
+
+def copy_to_host(obj):
+    """
+    @return: copy of a (nested) state dict with every tensor copied to the cpu, so training can go on while it is saved
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, copy_to_host(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_host(value) for value in obj)
+    return obj
+
+
+class CheckpointRetention:
+    """
+    Decides which periodic checkpoints (model_<iteration>) are kept: the last keep_last ones and the keep_best ones
+    with the best validation metric. Other checkpoints, like model_final, are always kept. 0 keeps all of them.
+    """
+
+    def __init__(self, keep_last=3, keep_best=1, metric="segm/AP", mode="max"):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.metric = metric
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._saved = []
+        self._scores = {}
+
+    def record_save(self, name):
+        m = PERIODIC_CHECKPOINT.match(name)
+        if m:
+            with self._lock:
+                self._saved.append(int(m.group(1)))
+
+    def record_metric(self, iteration, value):
+        with self._lock:
+            self._scores[iteration] = value
+
+    def to_delete(self):
+        """
+        @return: names of the checkpoints that fall outside the policy, they are forgotten by the policy as well
+        """
+        if self.keep_last <= 0:
+            return []
+        with self._lock:
+            keep = set(self._saved[-self.keep_last:])
+            scored = [it for it in self._saved if it in self._scores]
+            scored.sort(key=lambda it: self._scores[it], reverse=self.mode == "max")
+            keep.update(scored[:self.keep_best])
+            delete = [it for it in self._saved if it not in keep]
+            self._saved = [it for it in self._saved if it in keep]
+        return ["model_{:07d}".format(it) for it in delete]
+
+
+class AsyncCheckpointMixin:
+    """
+    Turns a checkpointer into one that does not block training while saving. save only copies the state to host memory
+    (that part is the stall of the training loop, reported as checkpoint/stall_seconds) and a background thread
+    serializes it to a temporary file that is renamed into place, so a checkpoint on disk is always complete. At most
+    one save is in flight, a next save waits for the previous one, so host memory holds at most one extra copy.
+
+    Callbacks added with add_save_callback are called with the path of every checkpoint once it is in place, and
+    the ones of add_delete_callback with the path of every checkpoint the retention policy removes. Checkpoints saved
+    with tag_last=False, like model_best, are not written to last_checkpoint, so resuming does not pick them.
+    """
+
+    def init_async(self, retention=None):
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="checkpoint")
+        self._pending = None
+        self._save_callbacks = []
+        self._delete_callbacks = []
+
+    def add_save_callback(self, callback):
+        self._save_callbacks.append(callback)
+
+    def add_delete_callback(self, callback):
+        self._delete_callbacks.append(callback)
+
+    def save(self, name, tag_last=True, **kwargs):
+        if not self.save_dir or not self.save_to_disk:
+            return
+        start = time.perf_counter()
+        # errors of the previous save are raised here, at the latest
+        self.wait()
+        data = {"model": copy_to_host(self.model.state_dict())}
+        for key, obj in self.checkpointables.items():
+            data[key] = copy_to_host(obj.state_dict())
+        data.update(kwargs)
+        stall = time.perf_counter() - start
+        try:
+            get_event_storage().put_scalar("checkpoint/stall_seconds", stall, smoothing_hint=False)
+        except AssertionError:
+            # saved outside of training
+            pass
+        self._pending = self._executor.submit(self._write, name, data, stall, tag_last)
+
+    def _write(self, name, data, stall, tag_last=True):
+        start = time.perf_counter()
+        basename = "{}.pth".format(name)
+        save_file = os.path.join(self.save_dir, basename)
+        tmp_file = os.path.join(self.save_dir, "." + basename + ".tmp")
+        try:
+            with open(tmp_file, "wb") as f:
+                torch.save(data, f)
+            os.replace(tmp_file, save_file)
+        except BaseException:
+            # e.g. a full disk, no half written file is left behind
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        if tag_last:
+            self.tag_last_checkpoint(basename)
+        logger.info("Saved checkpoint to {}, training stalled {:.2f}s and writing took {:.2f}s".format(
+            save_file, stall, time.perf_counter() - start))
+        for callback in self._save_callbacks:
+            callback(save_file)
+
+        if self.retention is not None:
+            self.retention.record_save(name)
+            self.prune()
+
+    def prune(self):
+        """
+        Deletes the checkpoints that fall outside the retention policy.
+        """
+        for name in self.retention.to_delete():
+            path = os.path.join(self.save_dir, "{}.pth".format(name))
+            if os.path.isfile(path):
+                os.remove(path)
+                logger.info("Removed {} by the retention policy".format(path))
+            for callback in self._delete_callbacks:
+                callback(path)
+
+    def wait(self):
+        """
+        Waits for the checkpoint that is being written, if any.
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+
+class AsyncDetectionCheckpointer(AsyncCheckpointMixin, DetectionCheckpointer):
+    def __init__(self, model, save_dir="", *, retention=None, save_to_disk=None, **checkpointables):
+        super().__init__(model, save_dir, save_to_disk=save_to_disk, **checkpointables)
+        self.init_async(retention)
+
+
+class CheckpointRetentionHook(HookBase):
+    """
+    Passes the validation metric of the retention policy to it, after the evaluation of an iteration, and waits for
+    the last checkpoint to be written at the end of training. Register it after the EvalHook.
+    """
+
+    def __init__(self, checkpointer):
+        self._checkpointer = checkpointer
+
+    def after_step(self):
+        retention = self._checkpointer.retention
+        if retention is None:
+            return
+        latest = self.trainer.storage.latest()
+        if retention.metric in latest:
+            value, iteration = latest[retention.metric]
+            # only evaluations of the iteration of a checkpoint say something about that checkpoint
+            if iteration == self.trainer.iter:
+                retention.record_metric(iteration, value)
+                self._checkpointer.wait()
+                self._checkpointer.prune()
+
+    def after_train(self):
+        self._checkpointer.wait()
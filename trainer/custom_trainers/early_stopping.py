@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import time
+
+from detectron2.engine import HookBase
+from detectron2.utils import comm
+
+from .async_checkpoint import AsyncCheckpointMixin
+
+logger = logging.getLogger(__name__)
+
+
+def save_untagged(checkpointer, name, **kwargs):
+    """
+    Saves a checkpoint without making it the last_checkpoint, which resuming loads: the asynchronous checkpointer skips
+    the tag, for the others the previous tag is put back.
+    """
+    if isinstance(checkpointer, AsyncCheckpointMixin):
+        checkpointer.save(name, tag_last=False, **kwargs)
+        return
+    if not checkpointer.save_dir or not checkpointer.save_to_disk:
+        return
+    previous = checkpointer.get_checkpoint_file() if checkpointer.has_checkpoint() else None
+    checkpointer.save(name, **kwargs)
+    if previous:
+        checkpointer.tag_last_checkpoint(os.path.basename(previous))
+    else:
+        # there was no checkpoint to resume from
+        os.remove(os.path.join(checkpointer.save_dir, "last_checkpoint"))
+
+
+def metric_mode(metric):
+    """
+    @return: max for AP metrics, where higher is better, min for losses
+    """
+    return "max" if "AP" in metric else "min"
+
+
+class EarlyStoppingHook(HookBase):
+    """
+    Stops training when the validation metric stopped improving or when the compute budget runs out, instead of always
+    running up to SOLVER.MAX_ITER.
+
+    Plateau: every evaluation of metric (validation_loss of the LossEvalHook, or segm/AP of the EvalHook) that is not
+    min_delta better than the best one so far counts against patience, a better one resets it. The best model is saved
+    as model_best, which is uploaded like every other checkpoint but not tagged as the last checkpoint to resume from.
+    Budget: max_hours of wall-clock time or max_gpu_hours (wall-clock time times the number of processes of the job)
+    since the start of training. Training stops at the last check before the budget would run out.
+
+    The main process decides, every check_period iterations and at every evaluation, and shares the decision with the
+    other processes, so they all stop at the same iteration. On a stop model_final is saved, so the run can be resumed.
+    Why and when training ended is written to early_stopping.json in the output folder. It ends training through
+    stop_requested of the COCOTrainer, after the current iteration. Register it after the evaluation hooks, on all
+    processes.
+    """
+
+    def __init__(self, output_dir, metric="", mode=None, patience=5, min_delta=0.0, max_hours=0.0, max_gpu_hours=0.0,
+                 eval_period=0, check_period=20):
+        self._output_dir = output_dir
+        self._metric = metric
+        self._mode = mode or metric_mode(metric)
+        self._patience = patience
+        self._min_delta = min_delta
+        self._max_hours = max_hours
+        self._max_gpu_hours = max_gpu_hours
+        self._eval_period = eval_period
+        self._check_period = check_period
+
+        self.best_value = None
+        self.best_iteration = None
+        self.evaluations = 0
+        self.bad_evaluations = 0
+        self.reason = None
+        self._start = None
+        self._start_iter = 0
+        self._new_value = None
+
+    def before_train(self):
+        self._start = time.perf_counter()
+        self._start_iter = self.trainer.iter
+
+    def _hours(self):
+        return (time.perf_counter() - self._start) / 3600
+
+    def _improved(self, value):
+        if self.best_value is None:
+            return True
+        if self._mode == "max":
+            return value > self.best_value + self._min_delta
+        return value < self.best_value - self._min_delta
+
+    def _track_metric(self):
+        """
+        Takes the value of the metric if it was evaluated at this iteration.
+
+        @return: whether it is the best one so far
+        """
+        if not self._metric:
+            return False
+        latest = self.trainer.storage.latest()
+        if self._metric not in latest:
+            return False
+        value, iteration = latest[self._metric]
+        if iteration != self.trainer.iter:
+            return False
+        self.evaluations += 1
+        if self._improved(value):
+            self.best_value, self.best_iteration = float(value), iteration
+            self.bad_evaluations = 0
+            return True
+        self.bad_evaluations += 1
+        return False
+
+    def _stop_reason(self):
+        if self._metric and self.bad_evaluations >= self._patience > 0:
+            return "plateau"
+        hours = self._hours()
+        iterations = self.trainer.iter + 1 - self._start_iter
+        # the budget may not run out before the next check
+        margin = hours / iterations * self._check_period
+        if self._max_hours > 0 and hours + margin >= self._max_hours:
+            return "time_budget"
+        if self._max_gpu_hours > 0 and (hours + margin) * comm.get_world_size() >= self._max_gpu_hours:
+            return "gpu_budget"
+        return None
+
+    def after_step(self):
+        next_iter = self.trainer.iter + 1
+        improved = comm.is_main_process() and self._track_metric()
+        if improved:
+            save_untagged(self.trainer.checkpointer, "model_best", iteration=self.trainer.iter)
+            logger.info("Best {} so far: {:.4f} at iteration {}, saved model_best".format(
+                self._metric, self.best_value, self.trainer.iter))
+
+        at_eval = self._eval_period > 0 and next_iter % self._eval_period == 0
+        if next_iter % self._check_period != 0 and not at_eval:
+            return
+        # the same iterations on every process, only the main one has all the metrics
+        reason = self._stop_reason() if comm.is_main_process() else None
+        reason = comm.all_gather(reason)[0]
+        if reason is not None and next_iter < self.trainer.max_iter:
+            self.reason = reason
+            logger.info("Stopping training at iteration {}: {}".format(self.trainer.iter, reason))
+            self.trainer.checkpointer.save("model_final", iteration=self.trainer.iter)
+            # the loop of the COCOTrainer ends after this iteration
+            self.trainer.stop_requested = True
+
+    def after_train(self):
+        if not comm.is_main_process():
+            return
+        hours = self._hours()
+        summary = {
+            "reason": self.reason or "max_iter",
+            "iteration": self.trainer.iter,
+            "max_iter": self.trainer.max_iter,
+            "metric": self._metric,
+            "mode": self._mode,
+            "best_value": self.best_value,
+            "best_iteration": self.best_iteration,
+            "evaluations": self.evaluations,
+            "evaluations_without_improvement": self.bad_evaluations,
+            "patience": self._patience,
+            "min_delta": self._min_delta,
+            "hours": hours,
+            "gpu_hours": hours * comm.get_world_size(),
+            "max_hours": self._max_hours,
+            "max_gpu_hours": self._max_gpu_hours,
+        }
+        with open(os.path.join(self._output_dir, "early_stopping.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        logger.info("Training ended at iteration {} ({}), {:.2f} hours, best {} {} at iteration {}".format(
+            self.trainer.iter, summary["reason"], hours, self._metric, self.best_value, self.best_iteration))
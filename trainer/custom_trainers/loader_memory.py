@@ -0,0 +1,121 @@
+import logging
+import os
+
+from detectron2.engine import HookBase
+
+logger = logging.getLogger(__name__)
+
+MB = 2 ** 20
+
+
+def process_memory(pid):
+    """
+    Memory of a process from /proc (Linux): rss (resident), pss (resident with shared pages divided over the processes
+    that share them) and uss (the pages only this process has, what it would free on exit). Copy-on-write pages of a
+    forked data loader worker count as shared until they are written, and move to its uss after.
+
+    @return: dict with rss, pss and uss in bytes, None if the process is gone
+    """
+    values = {"rss": 0, "pss": 0, "uss": 0}
+    # smaps_rollup sums smaps in the kernel, much faster on processes with many mappings (since linux 4.14)
+    for file_name in ("smaps_rollup", "smaps"):
+        try:
+            with open("/proc/{}/{}".format(pid, file_name)) as f:
+                for line in f:
+                    key, _, rest = line.partition(":")
+                    if key in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+                        kilobytes = int(rest.split()[0])
+                        name = {"Rss": "rss", "Pss": "pss"}.get(key, "uss")
+                        values[name] += kilobytes * 1024
+            return values
+        except FileNotFoundError:
+            if not os.path.exists("/proc/{}".format(pid)):
+                return None
+        except (ProcessLookupError, PermissionError):
+            return None
+    return None
+
+
+def child_pids(pid):
+    """
+    @return: pids of the direct children of a process, like the workers of its data loaders
+    """
+    children = set()
+    task_dir = "/proc/{}/task".format(pid)
+    try:
+        for task in os.listdir(task_dir):
+            with open(os.path.join(task_dir, task, "children")) as f:
+                children.update(int(child) for child in f.read().split())
+        return sorted(children)
+    except (FileNotFoundError, PermissionError):
+        pass
+    # kernels without /proc/<pid>/task/<tid>/children, the parent is the 4th field of stat
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/{}/stat".format(entry)) as f:
+                    # the name (2nd field) can have spaces, so split after it
+                    fields = f.read().rpartition(")")[2].split()
+                if int(fields[1]) == pid:
+                    children.add(int(entry))
+            except (FileNotFoundError, ProcessLookupError, IndexError):
+                continue
+    return sorted(children)
+
+
+def available_memory():
+    """
+    @return: MemAvailable of the machine in bytes
+    """
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def loader_memory(pid=None):
+    """
+    @return: memory of a training process and of its children (the data loader workers) in MB, see process_memory
+    """
+    pid = pid or os.getpid()
+    main = process_memory(pid) or {"rss": 0, "pss": 0, "uss": 0}
+    workers = [memory for memory in (process_memory(child) for child in child_pids(pid)) if memory is not None]
+    result = {"main_rss_mb": main["rss"] / MB, "main_uss_mb": main["uss"] / MB, "workers": len(workers)}
+    for key in ("rss", "pss", "uss"):
+        values = [worker[key] / MB for worker in workers] or [0.0]
+        result["worker_{}_mb".format(key)] = sum(values) / len(values)
+        result["worker_{}_max_mb".format(key)] = max(values)
+    result["total_pss_mb"] = (main["pss"] + sum(worker["pss"] for worker in workers)) / MB
+    result["machine_available_mb"] = available_memory() / MB
+    return result
+
+
+class LoaderMemoryHook(HookBase):
+    """
+    Puts the memory of the training process and its data loader workers in the EventStorage every period iterations,
+    as memory/<name> (see loader_memory). worker_uss_mb growing over a run means the workers copy pages of the
+    dataset they share with the training process. total_pss_mb is the memory the process tree really takes, shared
+    pages counted once.
+    """
+
+    def __init__(self, period=20):
+        self._period = period
+        self._first = None
+
+    def after_step(self):
+        if (self.trainer.iter + 1) % self._period != 0:
+            return
+        try:
+            memory = loader_memory()
+        except OSError:
+            # no /proc, not linux
+            logger.warning("Memory tracking needs /proc, it is turned off")
+            self._period = float("inf")
+            return
+        if self._first is None:
+            self._first = memory
+        for name, value in memory.items():
+            self.trainer.storage.put_scalar("memory/" + name, value, smoothing_hint=False)
+        self.trainer.storage.put_scalar("memory/worker_uss_growth_mb",
+                                        memory["worker_uss_mb"] - self._first["worker_uss_mb"], smoothing_hint=False)
@@ -1,6 +1,11 @@
 import datetime
+import json
 import logging
+import os
+import queue
+import threading
 import time
+from collections import OrderedDict
 
 import detectron2.utils.comm as comm
 import hypertune
@@ -11,26 +16,179 @@ from detectron2.utils.events import get_event_storage, EventWriter
 from detectron2.utils.logger import log_every_n_seconds
 
 
+class MetricSink:
+    """
+    Destination of the reported metrics. write receives a batch of (name, value, iteration) records, sorted by
+    iteration, and is only called from the background thread of the LossMetricWriter.
+    """
+
+    def write(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HypertuneSink(MetricSink):
+    """
+    Reports to CloudML Hypertune. Hypertune rewrites its metrics file on every report, so of every batch only the
+    latest value of each metric is reported.
+    """
+
+    def __init__(self):
+        self.hpt = hypertune.HyperTune()
+
+    def write(self, records):
+        latest = {}
+        for name, value, iteration in records:
+            latest[name] = (value, iteration)
+        for name, (value, iteration) in latest.items():
+            self.hpt.report_hyperparameter_tuning_metric(
+                hyperparameter_metric_tag=name,
+                metric_value=value,
+                global_step=iteration
+            )
+
+
+class JSONLSink(MetricSink):
+    """
+    Appends one line per iteration to a local file, e.g. {"iteration": 19, "total_loss": 1.23}.
+    """
+
+    def __init__(self, file_path):
+        self._file = open(file_path, "a")
+
+    def write(self, records):
+        lines = OrderedDict()
+        for name, value, iteration in records:
+            lines.setdefault(iteration, {"iteration": iteration})[name] = value
+        self._file.write("".join(json.dumps(line) + "\n" for line in lines.values()))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TensorboardSink(MetricSink):
+    """
+    Writes the reported metrics to TensorBoard under "reported/", next to what detectron2 itself writes.
+    """
+
+    def __init__(self, log_dir):
+        from torch.utils.tensorboard import SummaryWriter
+        self._writer = SummaryWriter(log_dir)
+
+    def write(self, records):
+        for name, value, iteration in records:
+            self._writer.add_scalar("reported/" + name, value, iteration)
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+
+def build_metric_sinks(names, output_dir):
+    """
+    @param names: any of "hypertune", "jsonl" and "tensorboard"
+    @param output_dir: folder of the run, where the local sinks write to
+    @return: list of sinks for the LossMetricWriter
+    """
+    sinks = []
+    for name in names:
+        if name == "hypertune":
+            sinks.append(HypertuneSink())
+        elif name == "jsonl":
+            sinks.append(JSONLSink(os.path.join(output_dir, "reported_metrics.jsonl")))
+        elif name == "tensorboard":
+            sinks.append(TensorboardSink(output_dir))
+        else:
+            raise ValueError("Unknown metric sink: {}".format(name))
+    return sinks
+
+
 class LossMetricWriter(EventWriter):
     """
-    Reports a single loss metric to CloudML Hyptertune to accommodate hyperparameter training. This is done every 20
-    iterations, which is equal to the hardcoded writer period.
+    Reports metrics to CloudML Hyptertune (and other sinks) to accommodate hyperparameter training. write is called
+    by the PeriodicWriter from the training loop, so it only takes a snapshot of the metrics that have a new value
+    and puts it on a queue. A background thread drains the queue every flush_period seconds, drops duplicates and
+    hands the batch to the sinks, so a slow sink never blocks an iteration.
+
+    Metrics that detectron2 marks for smoothing (like total_loss) are reported as the median over window_size
+    iterations, others (like validation_loss from the LossEvalHook) are reported as is, once per new value.
     """
 
-    def __init__(self, window_size: int = 20):
+    def __init__(self, window_size: int = 20, metrics=("total_loss",), sinks=None, flush_period: float = 5.0,
+                 max_queue_size: int = 1000):
         self.logger = logging.getLogger(__name__)
         self._window_size = window_size
-        self.hpt = hypertune.HyperTune()
+        self._metrics = tuple(metrics)
+        self._sinks = sinks if sinks is not None else [HypertuneSink()]
+        self._flush_period = flush_period
+        self._last_reported = {}
+        self._dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="LossMetricWriter", daemon=True)
+        self._thread.start()
 
     def write(self):
         storage = get_event_storage()
-        loss = storage.histories().get("total_loss")
-        if loss is not None:
-            self.hpt.report_hyperparameter_tuning_metric(
-                hyperparameter_metric_tag='total_loss',
-                metric_value=loss.median(self._window_size),
-                global_step=storage.iter
-            )
+        histories = storage.histories()
+        smoothing_hints = storage.smoothing_hints()
+        records = []
+        for name in self._metrics:
+            history = histories.get(name)
+            if history is None:
+                continue
+            value, iteration = history.values()[-1]
+            if self._last_reported.get(name) == iteration:
+                continue
+            self._last_reported[name] = iteration
+            if smoothing_hints.get(name, True):
+                value = history.median(self._window_size)
+            records.append((name, float(value), int(iteration)))
+
+        if records:
+            try:
+                self._queue.put_nowait(records)
+            except queue.Full:
+                # sinks cannot keep up, rather lose a report than stall training
+                self._dropped += 1
+                if self._dropped == 1:
+                    self.logger.warning("Metric queue is full, dropping reports.")
+
+    def close(self):
+        self._closed.set()
+        self._thread.join(timeout=max(self._flush_period * 2, 10))
+        # whatever the thread did not get to anymore
+        self._drain()
+        for sink in self._sinks:
+            sink.close()
+
+    def _run(self):
+        while not self._closed.wait(self._flush_period):
+            self._drain()
+
+    def _drain(self):
+        coalesced = {}
+        while True:
+            try:
+                records = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            for name, value, iteration in records:
+                coalesced[(name, iteration)] = value
+        if not coalesced:
+            return
+
+        batch = sorted(((name, value, iteration) for (name, iteration), value in coalesced.items()),
+                       key=lambda record: record[2])
+        for sink in self._sinks:
+            try:
+                sink.write(batch)
+            except Exception:
+                self.logger.exception("Failed to write metrics to {}".format(type(sink).__name__))
 
 
 class LossEvalHook(HookBase):
@@ -77,7 +235,7 @@ class LossEvalHook(HookBase):
             loss_batch = self._get_loss(inputs)
             losses.append(loss_batch)
         mean_loss = np.mean(losses)
-        self.trainer.storage.put_scalar('validation_loss', mean_loss)
+        self.trainer.storage.put_scalar('validation_loss', mean_loss, smoothing_hint=False)
         comm.synchronize()
 
         return losses
@@ -0,0 +1,145 @@
+import contextlib
+import logging
+import time
+
+import torch
+from detectron2.engine import SimpleTrainer
+from detectron2.layers import DeformConv, ModulatedDeformConv
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ("fp32", "mixed", "fp16", "bf16")
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+# layers with kernels that only take fp32, they run outside of autocast
+FP32_MODULES = (DeformConv, ModulatedDeformConv)
+
+
+def resolve_precision(precision, device):
+    """
+    @param precision: one of PRECISIONS, mixed picks fp16 on GPU and bf16 on CPU
+    @param device: device of the model, like cfg.MODEL.DEVICE
+    @return: fp32, fp16 or bf16
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision {}, choose from {}".format(precision, ", ".join(PRECISIONS)))
+    device_type = str(device).split(":")[0]
+    if precision == "mixed":
+        return "fp16" if device_type == "cuda" else "bf16"
+    if precision == "fp16" and device_type != "cuda":
+        raise ValueError("fp16 autocast needs a GPU, use bf16 (or mixed) on {}".format(device_type))
+    if not autocast_available(device_type, DTYPES[precision]):
+        # fail before the model is built, not at the first iteration
+        raise ValueError("{} autocast on {} needs torch 1.10 or later, this is torch {}. Use fp32 or train on a "
+                         "GPU in fp16".format(precision, device_type, torch.__version__))
+    return precision
+
+
+def autocast_available(device_type, dtype):
+    """
+    @return: whether this torch has autocast for dtype on device_type, torch before 1.10 (like the pinned 1.9 nightly)
+        only has it on GPU, for fp16
+    """
+    return dtype == torch.float32 or hasattr(torch, "autocast") or (device_type == "cuda" and dtype == torch.float16)
+
+
+def autocast(device_type, dtype, enabled=True):
+    if dtype == torch.float32:
+        # nothing to cast to, autocast would warn about the dtype
+        return contextlib.nullcontext()
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type, dtype=dtype, enabled=enabled)
+    if autocast_available(device_type, dtype):
+        return torch.cuda.amp.autocast(enabled=enabled)
+    raise RuntimeError("{} autocast on {} needs torch 1.10 or later".format(dtype, device_type))
+
+
+def keep_fp32(model, module_types, device_type, dtype):
+    """
+    Runs the modules of module_types in model outside of autocast, with their floating point inputs cast back to fp32.
+
+    @return: number of modules
+    """
+    count = 0
+    for module in model.modules():
+        if isinstance(module, module_types):
+            forward = module.forward
+
+            def fp32_forward(*inputs, _forward=forward, **kwargs):
+                inputs = [x.float() if torch.is_tensor(x) and x.is_floating_point() else x for x in inputs]
+                with autocast(device_type, dtype, enabled=False):
+                    return _forward(*inputs, **kwargs)
+
+            module.forward = fp32_forward
+            count += 1
+    return count
+
+
+class MixedPrecisionTrainer(SimpleTrainer):
+    """
+    SimpleTrainer that runs the forward pass and the losses under autocast: fp16 on GPU (the tensor cores of a T4),
+    with a GradScaler against underflow of the gradients, or bfloat16, which needs no loss scaling and also runs on
+    CPU. The weights and the optimizer stay fp32, so checkpoints are the same in every precision. The state of the
+    GradScaler is saved with the trainer and only loaded if there is one, so a run can be resumed in either precision.
+    With fp32 it is a plain SimpleTrainer, for subclasses that change the step in every precision.
+    """
+
+    def __init__(self, model, data_loader, optimizer, precision="fp16", fp32_modules=FP32_MODULES):
+        super().__init__(model, data_loader, optimizer)
+        self.init_precision(precision, fp32_modules)
+
+    @classmethod
+    def from_trainer(cls, trainer, precision, fp32_modules=FP32_MODULES):
+        """
+        @return: mixed precision version of a SimpleTrainer, it takes over the model, optimizer and data loader iterator
+            (a new iterator would start the data loader workers again)
+        """
+        new = cls.__new__(cls)
+        new.__dict__.update(trainer.__dict__)
+        new.init_precision(precision, fp32_modules)
+        return new
+
+    def init_precision(self, precision, fp32_modules=FP32_MODULES):
+        if precision not in DTYPES:
+            raise ValueError("MixedPrecisionTrainer runs fp32, fp16 or bf16, not {}".format(precision))
+        self.precision = precision
+        self.dtype = DTYPES[precision]
+        self.autocast_enabled = precision != "fp32"
+        self.device_type = next(self.model.parameters()).device.type
+        self.grad_scaler = torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+        if self.autocast_enabled:
+            num_fp32 = keep_fp32(self.model, fp32_modules, self.device_type, self.dtype) if fp32_modules else 0
+            logger.info("Training in {} on {}, {} layers stay fp32".format(precision, self.device_type, num_fp32))
+
+    def autocast(self):
+        return autocast(self.device_type, self.dtype, enabled=self.autocast_enabled)
+
+    def run_step(self):
+        assert self.model.training, "[MixedPrecisionTrainer] model was changed to eval mode!"
+        start = time.perf_counter()
+        data = next(self._data_loader_iter)
+        data_time = time.perf_counter() - start
+
+        with self.autocast():
+            loss_dict = self.model(data)
+            if isinstance(loss_dict, torch.Tensor):
+                losses = loss_dict
+                loss_dict = {"total_loss": loss_dict}
+            else:
+                losses = sum(loss_dict.values())
+
+        self.optimizer.zero_grad()
+        self.grad_scaler.scale(losses).backward()
+        self._write_metrics(loss_dict, data_time)
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
+
+    def state_dict(self):
+        ret = super().state_dict()
+        ret["grad_scaler"] = self.grad_scaler.state_dict()
+        return ret
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        # absent in checkpoints of fp32 runs, and empty for bf16 runs
+        if state_dict.get("grad_scaler") and self.grad_scaler.is_enabled():
+            self.grad_scaler.load_state_dict(state_dict["grad_scaler"])
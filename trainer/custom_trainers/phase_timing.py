@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+from detectron2.engine import HookBase, PeriodicCheckpointer
+from detectron2.utils import comm
+from detectron2.utils.logger import log_every_n_seconds
+
+from .async_checkpoint import CheckpointRetentionHook
+
+logger = logging.getLogger(__name__)
+
+STEP_PHASES = ("data", "forward", "backward", "metrics", "optimizer")
+# hooks that only save and prune checkpoints, the other hooks are timed as hooks
+CHECKPOINT_HOOKS = (PeriodicCheckpointer, CheckpointRetentionHook)
+PERCENTILES = (50, 90, 99)
+
+
+class TimedIterator:
+    """
+    Iterator that adds the time every next takes to the data phase of the PhaseTimingHook.
+    """
+
+    def __init__(self, iterator, timing):
+        self._iterator = iterator
+        self._timing = timing
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self._timing.add("data", time.perf_counter() - start)
+
+
+class PhaseTimingHook(HookBase):
+    """
+    Splits the time of every iteration in phases: waiting on the data loader, forward, backward, the logging of the
+    losses (metrics, which syncs the losses of all processes), the optimizer step, checkpointing and the other hooks,
+    like the LossEvalHook. Backward is what remains of the training step after the other step phases, so it includes
+    zero_grad. The phases are measured by wrapping the data loader iterator, model.forward, optimizer.step and the
+    hooks, so it works with every trainer. On GPU the phases are synchronized, to time the kernels and not only their
+    launch, which costs a little throughput.
+
+    Every period iterations the percentiles over the last window iterations go to the EventStorage (and so to
+    TensorBoard and metrics.json) as time/<phase>_p50 etc. Every iteration is written to phase_times.jsonl in the
+    output folder. Iterations that waited longer than starvation_threshold seconds on the data loader are marked as
+    starved and logged, their share of the window is time/starved_fraction.
+
+    An iteration is recorded at the start of the next one, when its hooks are done as well, so register it first.
+    """
+
+    def __init__(self, output_dir, starvation_threshold=0.05, window=100, period=20, sync_cuda=None):
+        self._output_dir = output_dir
+        self._threshold = starvation_threshold
+        self._period = period
+        self._sync_cuda = torch.cuda.is_available() if sync_cuda is None else sync_cuda
+        self._history = OrderedDict()
+        self._window = window
+        self._starved = deque(maxlen=window)
+        self._current = {}
+        self._iteration = None
+        self._start = None
+        self._in_step = False
+        self._file = None
+        self.num_starved = 0
+
+    def _sync(self):
+        if self._sync_cuda:
+            torch.cuda.synchronize()
+
+    def add(self, phase, seconds):
+        if self._in_step or not phase.startswith(STEP_PHASES):
+            self._current[phase] = self._current.get(phase, 0.0) + seconds
+
+    def _timed(self, function, phase):
+        def timed(*args, **kwargs):
+            if not self._in_step:
+                # e.g. the forward of the LossEvalHook, that one is part of the hook
+                return function(*args, **kwargs)
+            self._sync()
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._sync()
+                self.add(phase, time.perf_counter() - start)
+        return timed
+
+    def _timed_step(self, run_step):
+        def timed_step():
+            self._in_step = True
+            self._sync()
+            start = time.perf_counter()
+            try:
+                run_step()
+            finally:
+                self._sync()
+                self._in_step = False
+                step = time.perf_counter() - start
+                others = sum(self._current.get(phase, 0.0) for phase in STEP_PHASES if phase != "backward")
+                self._current["backward"] = max(0.0, step - others)
+                self._current["step"] = step
+        return timed_step
+
+    def _timed_hook(self, method, phase):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+        return timed
+
+    def before_train(self):
+        inner = self.trainer._trainer
+        if "_data_loader_iter" in vars(inner):
+            inner._data_loader_iter = TimedIterator(inner._data_loader_iter, self)
+        else:
+            # newer detectron2 makes the iterator when it is first used
+            inner._data_loader_iter_obj = TimedIterator(iter(inner.data_loader), self)
+        inner.model.forward = self._timed(inner.model.forward, "forward")
+        inner.optimizer.step = self._timed(inner.optimizer.step, "optimizer")
+        inner._write_metrics = self._timed(inner._write_metrics, "metrics")
+        inner.run_step = self._timed_step(inner.run_step)
+
+        for hook in self.trainer._hooks:
+            if hook is self:
+                continue
+            phase = "checkpoint" if isinstance(hook, CHECKPOINT_HOOKS) else "hooks/" + type(hook).__name__
+            hook.before_step = self._timed_hook(hook.before_step, phase)
+            hook.after_step = self._timed_hook(hook.after_step, phase)
+
+        if comm.is_main_process():
+            self._file = open(os.path.join(self._output_dir, "phase_times.jsonl"), "a")
+
+    def before_step(self):
+        if self._iteration is not None:
+            self._record()
+        self._iteration = self.trainer.iter
+        self._current = {}
+        self._start = time.perf_counter()
+
+    def _record(self):
+        times = self._current
+        times["total"] = time.perf_counter() - self._start
+        times["hooks"] = sum(value for phase, value in times.items() if phase.startswith("hooks/"))
+        starved = times.get("data", 0.0) > self._threshold
+        self._starved.append(starved)
+        if starved:
+            self.num_starved += 1
+            log_every_n_seconds(logging.WARNING, "Iteration {} waited {:.3f}s on the data loader ({} starved so far), "
+                                "more data loader workers may help".format(
+                                    self._iteration, times["data"], self.num_starved), n=60)
+        for phase, value in times.items():
+            self._history.setdefault(phase, deque(maxlen=self._window)).append(value)
+
+        if self._file is not None:
+            record = {"iteration": self._iteration, "starved": starved}
+            record.update((phase, round(value, 6)) for phase, value in times.items())
+            self._file.write(json.dumps(record) + "\n")
+
+        if (self._iteration + 1) % self._period == 0:
+            self._put_percentiles()
+
+    def _put_percentiles(self):
+        storage = self.trainer.storage
+        for phase, values in self._history.items():
+            for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                storage.put_scalar("time/{}_p{}".format(phase, q), float(value), smoothing_hint=False)
+        storage.put_scalar("time/starved_fraction", sum(self._starved) / len(self._starved), smoothing_hint=False)
+        if self._file is not None:
+            self._file.flush()
+
+    def after_train(self):
+        if self._iteration is not None and "step" in self._current:
+            self._record()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._history.get("total"):
+            summary = ", ".join("{} {:.3f}s".format(phase, float(np.median(values)))
+                                for phase, values in self._history.items())
+            logger.info("Median time per iteration: {}. {} iterations starved on data (over {:.3f}s)".format(
+                summary, self.num_starved, self._threshold))
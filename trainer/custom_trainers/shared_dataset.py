@@ -0,0 +1,125 @@
+import logging
+import mmap
+import os
+import pickle
+import socket
+import tempfile
+import uuid
+
+import numpy as np
+import torch.utils.data
+from detectron2.data import get_detection_dataset_dicts
+from detectron2.utils import comm
+
+logger = logging.getLogger(__name__)
+
+
+def shared_directory(size):
+    """
+    @return: /dev/shm if the dataset fits in it (it is small in docker by default), the temporary folder otherwise,
+        whose page cache is shared between processes as well
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        stat = os.statvfs("/dev/shm")
+        # leave room for the tensors the data loader workers pass through it
+        if size < stat.f_bavail * stat.f_frsize / 2:
+            return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def write_serialized(dataset_dicts):
+    """
+    Pickles every dataset dict into one file: the number of dicts, the end offset of every dict and the pickles.
+
+    @return: path of the file
+    """
+    buffers = [pickle.dumps(d, protocol=pickle.HIGHEST_PROTOCOL) for d in dataset_dicts]
+    addresses = np.cumsum([len(b) for b in buffers], dtype=np.int64)
+    size = 8 * (len(buffers) + 1) + (int(addresses[-1]) if len(buffers) else 0)
+    path = os.path.join(shared_directory(size), "dataset_{}_{}".format(os.getpid(), uuid.uuid4().hex[:8]))
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(np.int64(len(buffers)).tobytes())
+        f.write(addresses.tobytes())
+        for b in buffers:
+            f.write(b)
+    os.replace(tmp_file, path)
+    return path
+
+
+class SharedDatasetList(torch.utils.data.Dataset):
+    """
+    Dataset of dataset dicts (with their polygon or RLE payloads) that live in one serialized buffer per machine,
+    instead of a copy in every training process, which every process loads as a list of Python objects first. The
+    buffer is a read-only memory map of a file that the first process of the machine writes. The other processes of
+    the machine and all data loader workers map the same pages and never write to them, so there is one copy per
+    machine and no copy-on-write: reading a Python object changes its reference count, which copies the whole page
+    into the worker that read it.
+
+    Every item is unpickled when it is read, so the mapper (and its deepcopy) works on a fresh dict of its own. The
+    file is removed once every process has mapped it, so nothing is left behind after a crash. Data loader workers
+    get the map by fork (the default on linux), it can not be pickled for spawned workers.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count = int(np.frombuffer(self._buffer, dtype=np.int64, count=1)[0])
+        self._addresses = np.frombuffer(self._buffer, dtype=np.int64, count=count, offset=8)
+        self._offset = 8 * (count + 1)
+        self.nbytes = len(self._buffer)
+
+    @classmethod
+    def create(cls, load_dataset_dicts):
+        """
+        The first process of every machine loads the dataset dicts and writes them, the others only map the file.
+
+        @param load_dataset_dicts: function that returns the dataset dicts
+        """
+        local_rank = comm.get_local_rank()
+        path = write_serialized(load_dataset_dicts()) if local_rank == 0 else None
+        # the path of the first process of this machine, all processes of the job take part
+        host = socket.gethostname()
+        paths = comm.all_gather((host, local_rank, path))
+        path = next(p for h, rank, p in paths if h == host and rank == 0)
+        dataset = cls(path)
+        comm.synchronize()
+        if local_rank == 0:
+            # the pages stay until the last process unmaps them
+            os.remove(path)
+            logger.info("Serialized {} dataset dicts into a shared buffer of {:.1f} MB".format(
+                len(dataset), dataset.nbytes / 2 ** 20))
+        return dataset
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start = int(self._addresses[idx - 1]) if idx > 0 else 0
+        end = int(self._addresses[idx])
+        return pickle.loads(memoryview(self._buffer)[self._offset + start:self._offset + end])
+
+    def __iter__(self):
+        # the samplers that weigh images (RepeatFactorTrainingSampler) go over all dicts
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __reduce__(self):
+        raise TypeError("SharedDatasetList is shared with data loader workers by fork, it can not be pickled")
+
+
+def shared_train_dataset(cfg):
+    """
+    @return: the training dataset of cfg in a SharedDatasetList, with the same filtering as
+        build_detection_train_loader
+    """
+    return SharedDatasetList.create(lambda: get_detection_dataset_dicts(
+        cfg.DATASETS.TRAIN,
+        filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+        min_keypoints=cfg.MODEL.ROI_KEYPOINT_HEAD.MIN_KEYPOINTS_PER_IMAGE if cfg.MODEL.KEYPOINT_ON else 0,
+        proposal_files=cfg.DATASETS.PROPOSAL_FILES_TRAIN if cfg.MODEL.LOAD_PROPOSALS else None,
+    ))
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from detectron2.engine import HookBase
+from detectron2.utils import comm
+
+logger = logging.getLogger(__name__)
+
+
+class StartupProfiler:
+    """
+    Wall time of the phases of the startup of a job, up to its first training iteration. Phases can be nested, a nested
+    phase is named <outer>/<inner>. It does nothing until it is enabled, so the phases can stay in the code.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.start = time.perf_counter()
+        self.phases = OrderedDict()
+        self.last_end = self.start
+        self._stack = []
+        self._reported = False
+
+    def enable(self, start=None):
+        """
+        @param start: perf_counter value the job started at, e.g. before the imports of the entry point
+        """
+        self.enabled = True
+        if start is not None:
+            self.start = start
+            self.last_end = start
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._stack.append(name)
+        key = "/".join(self._stack)
+        # listed in the order the phases start, outer before inner
+        self.phases.setdefault(key, 0.0)
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            self.record(key, time.perf_counter() - begin)
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        if "/" not in name:
+            self.last_end = time.perf_counter()
+
+    def since_last_phase(self):
+        return time.perf_counter() - self.last_end
+
+    def report(self, output_dir=None, total_name="time_to_first_iteration"):
+        """
+        Logs the phases and writes them to startup_profile.json in output_dir (from the main process), once per job.
+
+        @return: seconds per phase, plus the time that is in no phase (other) and the total under total_name
+        """
+        if not self.enabled or self._reported:
+            return None
+        self._reported = True
+        total = time.perf_counter() - self.start
+        result = OrderedDict(self.phases)
+        result["other"] = max(0.0, total - sum(seconds for name, seconds in self.phases.items() if "/" not in name))
+        result[total_name] = total
+
+        lines = ["Startup profile, {} {:.2f}s:".format(total_name, total)]
+        for name, seconds in result.items():
+            if name != total_name:
+                depth = name.count("/")
+                lines.append("  {:<40} {:8.2f}s {:6.1%}".format("  " * depth + name.split("/")[-1], seconds,
+                                                                 seconds / max(total, 1e-9)))
+        logger.info("\n".join(lines))
+        if output_dir and comm.is_main_process():
+            with open(os.path.join(output_dir, "startup_profile.json"), "w") as f:
+                json.dump(result, f, indent=2)
+        return result
+
+
+# one per process, enabled by --profile-startup
+profiler = StartupProfiler()
+
+
+class StartupProfileHook(HookBase):
+    """
+    Ends the startup profile after the first training iteration. The time from the last phase up to then (the
+    before_train of the hooks, starting the data loader workers and the first step) is recorded as first_iteration.
+    The profile is logged, written to startup_profile.json and put in the event storage as startup/<phase>, so the
+    writers keep track of it over runs.
+    """
+
+    def __init__(self, output_dir, startup_profiler=profiler):
+        self._profiler = startup_profiler
+        self._output_dir = output_dir
+
+    def after_step(self):
+        if self.trainer.iter != self.trainer.start_iter or not self._profiler.enabled:
+            return
+        self._profiler.record("first_iteration", self._profiler.since_last_phase())
+        result = self._profiler.report(self._output_dir)
+        if result:
+            self.trainer.storage.put_scalars(smoothing_hint=False,
+                                             **{"startup/" + name: seconds for name, seconds in result.items()})
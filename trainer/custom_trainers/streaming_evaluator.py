@@ -0,0 +1,302 @@
+import copy
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import detectron2.utils.comm as comm
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data.datasets import load_coco_json
+from detectron2.evaluation import DatasetEvaluator
+from detectron2.evaluation.coco_evaluation import instances_to_coco_json
+from detectron2.structures import BoxMode
+
+
+class StreamingCOCOEvaluator(DatasetEvaluator):
+    """
+    Alternative for the COCOEvaluator that does not keep the predictions around. Every image is matched against its
+    ground truth as soon as its predictions arrive, using the same greedy matching as pycocotools' COCOeval, and only
+    the outcome is kept: true and false positive counts binned by score in fixed size histograms. Those are summed
+    over the ranks in evaluate, so memory and the gather do not grow with the size of the validation set.
+
+    Binning the scores means detections with almost the same score are ranked together, with the default 1000 bins
+    the AP differs from COCOeval in the rounding only. Predictions can optionally be streamed to a jsonl file per rank.
+    """
+
+    IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+    RECALL_THRESHOLDS = np.linspace(0.0, 1.0, 101)
+    AREA_RANGES = OrderedDict([
+        ("all", (0, 1e5 ** 2)),
+        ("small", (0, 32 ** 2)),
+        ("medium", (32 ** 2, 96 ** 2)),
+        ("large", (96 ** 2, 1e5 ** 2)),
+    ])
+
+    def __init__(self, dataset_name, tasks=("bbox", "segm"), output_dir=None, stream_predictions=False,
+                 score_bins=1000, max_dets=100):
+        """
+        @param dataset_name: name of a registered dataset in detectron2 format
+        @param tasks: "bbox" and/or "segm"
+        @param output_dir: folder for the streamed predictions, only used if stream_predictions is set
+        @param stream_predictions: write predictions in COCO results format to output_dir as they arrive
+        @param score_bins: number of score histogram bins, more bins means closer to COCOeval
+        @param max_dets: maximum number of detections per image and category, as maxDets in COCOeval
+        """
+        self._logger = logging.getLogger(__name__)
+        self._dataset_name = dataset_name
+        self._tasks = tuple(tasks)
+        self._output_dir = output_dir
+        self._stream_predictions = stream_predictions
+        self._score_bins = score_bins
+        self._max_dets = max_dets
+        self._cpu_device = torch.device("cpu")
+
+        self._metadata = MetadataCatalog.get(dataset_name)
+        self._class_names = self._metadata.thing_classes
+        # the dataset is loaded again, so only a compact copy of the ground truth is kept: arrays per image and the
+        # masks as compressed RLE, the parsed dicts and their polygons are dropped after this
+        self._gt = {record["image_id"]: self._compact_gt(record) for record in self._load_records()}
+        self._stream = None
+
+    def reset(self):
+        shape = (len(self.IOU_THRESHOLDS), len(self._class_names), len(self.AREA_RANGES), self._score_bins)
+        self._true_positives = {task: np.zeros(shape, dtype=np.int64) for task in self._tasks}
+        self._false_positives = {task: np.zeros(shape, dtype=np.int64) for task in self._tasks}
+        self._num_gt = {task: np.zeros(shape[1:3], dtype=np.int64) for task in self._tasks}
+        self._num_images = 0
+
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        if self._stream_predictions and self._output_dir:
+            os.makedirs(self._output_dir, exist_ok=True)
+            file_path = os.path.join(self._output_dir, "predictions_rank{}.jsonl".format(comm.get_rank()))
+            self._stream = open(file_path, "w")
+
+    def process(self, inputs, outputs):
+        for input, output in zip(inputs, outputs):
+            if "instances" not in output:
+                continue
+            instances = output["instances"].to(self._cpu_device)
+            self._accumulate(self._gt[input["image_id"]], instances)
+            self._num_images += 1
+
+            if self._stream is not None:
+                results = instances_to_coco_json(instances, input["image_id"])
+                self._to_dataset_ids(results)
+                self._stream.write(json.dumps({"image_id": input["image_id"], "results": results}) + "\n")
+
+    def evaluate(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+        # fixed size arrays, so this gather is cheap no matter how many images were processed
+        comm.synchronize()
+        states = comm.gather(
+            (self._true_positives, self._false_positives, self._num_gt, self._num_images), dst=0
+        )
+        if not comm.is_main_process():
+            return {}
+
+        num_images = sum(state[3] for state in states)
+        if num_images == 0:
+            self._logger.warning("[StreamingCOCOEvaluator] Did not receive valid predictions.")
+            return {}
+        self._logger.info("Matched predictions of {} images against ground truth.".format(num_images))
+
+        results = OrderedDict()
+        for task in self._tasks:
+            true_positives = sum(state[0][task] for state in states)
+            false_positives = sum(state[1][task] for state in states)
+            num_gt = sum(state[2][task] for state in states)
+            results[task] = self._summarize(task, true_positives, false_positives, num_gt)
+        return copy.deepcopy(results)
+
+    def _to_dataset_ids(self, results):
+        # same mapping back to the original category ids as the COCOEvaluator does
+        if hasattr(self._metadata, "thing_dataset_id_to_contiguous_id"):
+            reverse_id_mapping = {v: k for k, v in self._metadata.thing_dataset_id_to_contiguous_id.items()}
+            for result in results:
+                result["category_id"] = reverse_id_mapping[result["category_id"]]
+
+    def _load_records(self):
+        """
+        @return: the dataset dicts, for a COCO json dataset loaded with the area of every annotation, which
+            load_coco_json (and so the registered loader) drops by default
+        """
+        json_file = self._metadata.get("json_file", None)
+        if json_file is None:
+            return DatasetCatalog.get(self._dataset_name)
+        return load_coco_json(json_file, self._metadata.get("image_root", ""), self._dataset_name,
+                              extra_annotation_keys=["area"])
+
+    def _compact_gt(self, record):
+        """
+        @return: ground truth of an image as classes, crowd flags, XYWH boxes and areas arrays and a list of RLEs
+        """
+        height, width = record["height"], record["width"]
+        annotations = record.get("annotations", [])
+
+        classes = np.asarray([ann["category_id"] for ann in annotations], dtype=np.int64)
+        crowd = np.asarray([ann.get("iscrowd", 0) for ann in annotations], dtype=bool)
+        boxes = np.asarray([BoxMode.convert(ann["bbox"], ann["bbox_mode"], BoxMode.XYWH_ABS)
+                            for ann in annotations], dtype=np.float64).reshape(-1, 4)
+        rles = [self._annotation_to_rle(ann, height, width) for ann in annotations]
+        # COCOeval uses the area of the json for both tasks, the mask or box area only without one
+        area = np.asarray([ann["area"] if "area" in ann
+                           else (mask_util.area(rle) if rle is not None else box[2] * box[3])
+                           for ann, rle, box in zip(annotations, rles, boxes)], dtype=np.float64)
+        if "segm" not in self._tasks:
+            # the masks are only needed for their area
+            rles = [None] * len(rles)
+        return classes, crowd, boxes, area, rles
+
+    def _accumulate(self, gt, instances):
+        gt_classes, gt_crowd, gt_boxes, gt_area, gt_rles = gt
+
+        dt_scores = instances.scores.numpy().astype(np.float64)
+        dt_classes = instances.pred_classes.numpy().astype(np.int64)
+        dt_boxes = BoxMode.convert(instances.pred_boxes.tensor.numpy(), BoxMode.XYXY_ABS, BoxMode.XYWH_ABS)
+        dt_boxes = dt_boxes.astype(np.float64).reshape(-1, 4)
+
+        for task in self._tasks:
+            if task == "segm":
+                if not instances.has("pred_masks"):
+                    continue
+                masks = instances.pred_masks.numpy()
+                dt_objects = [mask_util.encode(np.asfortranarray(mask[:, :, None], dtype=np.uint8))[0]
+                              for mask in masks]
+                dt_area = np.asarray([mask_util.area(rle) for rle in dt_objects], dtype=np.float64)
+                gt_objects = gt_rles
+            else:
+                dt_objects = list(dt_boxes)
+                dt_area = dt_boxes[:, 2] * dt_boxes[:, 3]
+                gt_objects = list(gt_boxes)
+
+            for category in np.unique(np.concatenate([gt_classes, dt_classes])):
+                gt_index = np.nonzero(gt_classes == category)[0]
+                dt_index = np.nonzero(dt_classes == category)[0]
+                # highest scores first and only the top max_dets, as COCOeval
+                dt_index = dt_index[np.argsort(-dt_scores[dt_index], kind="mergesort")][:self._max_dets]
+                self._match(
+                    task, int(category),
+                    [dt_objects[i] for i in dt_index], dt_scores[dt_index], dt_area[dt_index],
+                    [gt_objects[i] for i in gt_index], gt_crowd[gt_index], gt_area[gt_index],
+                )
+
+    def _annotation_to_rle(self, ann, height, width):
+        segm = ann.get("segmentation")
+        if segm is None:
+            return None
+        if isinstance(segm, list):
+            # polygon, a single object might consist of multiple parts
+            return mask_util.merge(mask_util.frPyObjects(segm, height, width))
+        if isinstance(segm["counts"], list):
+            # uncompressed RLE
+            return mask_util.frPyObjects(segm, height, width)
+        return segm
+
+    def _match(self, task, category, dt_objects, dt_scores, dt_area, gt_objects, gt_crowd, gt_area):
+        """
+        Greedy matching of one image and category, this follows COCOeval.evaluateImg.
+        """
+        num_dt, num_gt = len(dt_objects), len(gt_objects)
+        if num_dt > 0 and num_gt > 0:
+            if task == "bbox":
+                dt_objects, gt_objects = np.asarray(dt_objects), np.asarray(gt_objects)
+            ious = mask_util.iou(dt_objects, gt_objects, [int(c) for c in gt_crowd])
+            ious = np.asarray(ious).reshape(num_dt, num_gt)
+        else:
+            ious = np.zeros((num_dt, num_gt))
+        bins = np.minimum((dt_scores * self._score_bins).astype(np.int64), self._score_bins - 1)
+
+        for a, (area_min, area_max) in enumerate(self.AREA_RANGES.values()):
+            gt_ignore = gt_crowd | (gt_area < area_min) | (gt_area > area_max)
+            self._num_gt[task][category, a] += int(np.count_nonzero(~gt_ignore))
+            if num_dt == 0:
+                continue
+
+            # non-ignored ground truth first, matches with those are preferred
+            gt_order = np.argsort(gt_ignore, kind="mergesort")
+            order_ignore = gt_ignore[gt_order]
+            order_crowd = gt_crowd[gt_order]
+            order_ious = ious[:, gt_order]
+            dt_out_of_range = (dt_area < area_min) | (dt_area > area_max)
+
+            for t, threshold in enumerate(self.IOU_THRESHOLDS):
+                gt_matched = np.zeros(num_gt, dtype=bool)
+                dt_matched = np.zeros(num_dt, dtype=bool)
+                dt_ignore = np.zeros(num_dt, dtype=bool)
+                for d in range(num_dt):
+                    best_iou = min(threshold, 1 - 1e-10)
+                    match = -1
+                    for g in range(num_gt):
+                        # crowd regions can be matched more than once
+                        if gt_matched[g] and not order_crowd[g]:
+                            continue
+                        # already matched to a regular gt, and only ignored ones are left
+                        if match > -1 and not order_ignore[match] and order_ignore[g]:
+                            break
+                        if order_ious[d, g] < best_iou:
+                            continue
+                        best_iou = order_ious[d, g]
+                        match = g
+                    if match == -1:
+                        continue
+                    dt_ignore[d] = order_ignore[match]
+                    dt_matched[d] = True
+                    gt_matched[match] = True
+                # unmatched detections outside the area range do not count as false positives
+                dt_ignore |= ~dt_matched & dt_out_of_range
+
+                np.add.at(self._true_positives[task][t, category, a], bins[dt_matched & ~dt_ignore], 1)
+                np.add.at(self._false_positives[task][t, category, a], bins[~dt_matched & ~dt_ignore], 1)
+
+    def _summarize(self, task, true_positives, false_positives, num_gt):
+        num_thresholds, num_classes, num_areas, _ = true_positives.shape
+        precision = -np.ones((num_thresholds, num_classes, num_areas))
+        for t in range(num_thresholds):
+            for k in range(num_classes):
+                for a in range(num_areas):
+                    if num_gt[k, a] == 0:
+                        continue
+                    # walk from the highest score bin down, skipping empty bins
+                    tp_bins = true_positives[t, k, a][::-1]
+                    fp_bins = false_positives[t, k, a][::-1]
+                    occupied = (tp_bins + fp_bins) > 0
+                    tp = np.cumsum(tp_bins[occupied]).astype(np.float64)
+                    fp = np.cumsum(fp_bins[occupied]).astype(np.float64)
+
+                    recall = tp / num_gt[k, a]
+                    prec = tp / np.maximum(tp + fp, np.spacing(1))
+                    # interpolated precision, as COCOeval.accumulate
+                    prec = np.maximum.accumulate(prec[::-1])[::-1] if len(prec) else prec
+                    indices = np.searchsorted(recall, self.RECALL_THRESHOLDS, side="left")
+                    sampled = np.zeros(len(self.RECALL_THRESHOLDS))
+                    valid = indices < len(prec)
+                    sampled[valid] = prec[indices[valid]]
+                    precision[t, k, a] = sampled.mean()
+
+        def mean_ap(values):
+            values = values[values > -1]
+            return float(values.mean() * 100) if values.size else float("nan")
+
+        area_index = {name: i for i, name in enumerate(self.AREA_RANGES)}
+        results = {
+            "AP": mean_ap(precision[:, :, area_index["all"]]),
+            "AP50": mean_ap(precision[0, :, area_index["all"]]),
+            "AP75": mean_ap(precision[5, :, area_index["all"]]),
+            "APs": mean_ap(precision[:, :, area_index["small"]]),
+            "APm": mean_ap(precision[:, :, area_index["medium"]]),
+            "APl": mean_ap(precision[:, :, area_index["large"]]),
+        }
+        for k, name in enumerate(self._class_names):
+            results["AP-" + name] = mean_ap(precision[:, k, area_index["all"]])
+
+        self._logger.info("Evaluation results for {}: \n".format(task)
+                          + "\n".join("{}: {:.3f}".format(key, value) for key, value in results.items()))
+        return results
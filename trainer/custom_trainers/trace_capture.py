@@ -0,0 +1,125 @@
+import logging
+import os
+import signal
+import threading
+import time
+
+import torch
+from detectron2.engine import HookBase
+from detectron2.utils import comm
+
+logger = logging.getLogger(__name__)
+
+TRIGGER_FILE = "profile_trigger"
+
+
+class TraceCaptureHook(HookBase):
+    """
+    Captures a torch.profiler trace of a number of training iterations: CPU and CUDA (if available) activity, tensor
+    shapes, memory and Python stacks. A capture covers the iterations of window, and can also be started while the
+    job runs, on demand:
+
+    - with the signal (SIGUSR1 by default) to one of the training processes, e.g. kill -USR1 <pid>
+    - by creating the trigger file profile_trigger in the output folder, e.g. with gsutil cp or touch. It is removed
+      when the capture starts, so it can be created again for the next one
+
+    On demand captures take steps iterations. All processes of the job capture the same iterations, the requests are
+    checked every poll_period iterations. Every capture goes to profiler/iter_<first iteration>/ in the output folder:
+    a trace per process as rank<N>.<time>.pt.trace.json, which opens in chrome://tracing and Perfetto and is the run
+    format of the TensorBoard profiler plugin (tensorboard --logdir <output folder>/profiler), and a table of the most
+    expensive operators per process. The ArtifactUploadHook uploads them with the other files of the output folder.
+    """
+
+    def __init__(self, output_dir, window=None, steps=10, on_demand=True, poll_period=20, signum=signal.SIGUSR1):
+        self._output_dir = output_dir
+        self._window = tuple(window) if window else None
+        self._steps = steps
+        self._on_demand = on_demand
+        self._poll_period = poll_period
+        self._signum = signum
+
+        self._requested = threading.Event()
+        self._previous_handler = None
+        self._profile = None
+        self._capture_dir = None
+        self._stop_iter = None
+        self.num_captures = 0
+
+    def _handle_signal(self, signum, frame):
+        # only sets a flag, the capture starts at the next poll of the training loop
+        self._requested.set()
+
+    def before_train(self):
+        if not hasattr(torch, "profiler"):
+            logger.warning("torch.profiler needs torch 1.8.1 or later, no traces are captured")
+            self._window, self._on_demand = None, False
+            return
+        if self._on_demand and threading.current_thread() is threading.main_thread():
+            self._previous_handler = signal.signal(self._signum, self._handle_signal)
+            logger.info("Send signal {} to process {} or create {} to capture a trace of {} iterations".format(
+                self._signum, os.getpid(), os.path.join(self._output_dir, TRIGGER_FILE), self._steps))
+
+    def _trigger_requested(self):
+        path = os.path.join(self._output_dir, TRIGGER_FILE)
+        if not os.path.exists(path):
+            return False
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # removed by another process of this machine
+            pass
+        return True
+
+    def before_step(self):
+        if self._profile is not None:
+            return
+        iteration = self.trainer.iter
+        if self._window and iteration == self._window[0]:
+            self._start(iteration, self._window[1])
+        elif self._on_demand and iteration % self._poll_period == 0:
+            requested = self._requested.is_set()
+            self._requested.clear()
+            if comm.get_local_rank() == 0:
+                requested = self._trigger_requested() or requested
+            # the same iterations on every process, a request to any of them starts all captures
+            if any(comm.all_gather(requested)):
+                self._start(iteration, iteration + self._steps)
+
+    def _start(self, iteration, stop_iter):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._capture_dir = os.path.join(self._output_dir, "profiler", "iter_{}".format(iteration))
+        os.makedirs(self._capture_dir, exist_ok=True)
+        self._stop_iter = stop_iter
+        self._profile = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True,
+                                               with_stack=True)
+        self._profile.__enter__()
+        logger.info("Capturing a trace of iterations {} to {}".format(iteration, stop_iter - 1))
+
+    def after_step(self):
+        if self._profile is not None and self.trainer.iter + 1 >= self._stop_iter:
+            self._stop()
+
+    def _stop(self):
+        profile, self._profile = self._profile, None
+        start = time.perf_counter()
+        profile.__exit__(None, None, None)
+        rank = comm.get_rank()
+        name = "rank{}.{}.pt.trace.json".format(rank, int(time.time() * 1000))
+        # written next to it and renamed, so the uploader never ships half a trace
+        tmp_file = os.path.join(self._capture_dir, "." + name + ".tmp")
+        profile.export_chrome_trace(tmp_file)
+        os.replace(tmp_file, os.path.join(self._capture_dir, name))
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        with open(os.path.join(self._capture_dir, "rank{}_operators.txt".format(rank)), "w") as f:
+            f.write(profile.key_averages().table(sort_by=sort_by, row_limit=50))
+        self.num_captures += 1
+        logger.info("Saved trace to {} in {:.1f}s".format(self._capture_dir, time.perf_counter() - start))
+
+    def after_train(self):
+        if self._profile is not None:
+            self._stop()
+        if self._previous_handler is not None:
+            signal.signal(self._signum, self._previous_handler)
+            self._previous_handler = None
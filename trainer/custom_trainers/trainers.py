@@ -1,14 +1,27 @@
+import logging
 import os
 
 import detectron2.data.transforms as T
-from adet.checkpoint import AdetCheckpointer
 from detectron2.data import DatasetMapper, build_detection_train_loader
 from detectron2.data import build_detection_test_loader
 from detectron2.engine import DefaultTrainer
-from detectron2.evaluation import COCOEvaluator
-
+from detectron2.evaluation import COCOEvaluator, verify_results
+from detectron2.utils import comm
+from detectron2.utils.events import EventStorage
+
+from .accumulation import AccumulationTrainer, micro_batch_cfg
+from .async_checkpoint import AsyncDetectionCheckpointer, CheckpointRetention, CheckpointRetentionHook
+from .early_stopping import EarlyStoppingHook
+from .loader_memory import LoaderMemoryHook
 from .loss_metrics import LossEvalHook
-from .blendmask_mapper import BlendmaskMapperWithBasis
+from .mixed_precision import MixedPrecisionTrainer, resolve_precision, FP32_MODULES
+from .phase_timing import PhaseTimingHook
+from .shared_dataset import shared_train_dataset
+from .startup_profile import profiler
+from .streaming_evaluator import StreamingCOCOEvaluator
+from .trace_capture import TraceCaptureHook
+
+logger = logging.getLogger(__name__)
 
 
 class COCOTrainer(DefaultTrainer):
@@ -18,6 +31,89 @@ class COCOTrainer(DefaultTrainer):
     evaluation at specified points (TEST.EVAL_PERIOD) during training.
     """
 
+    # set from the parser, streaming evaluation keeps memory bounded on large validation sets
+    streaming_eval = False
+    stream_predictions = False
+    # checkpoints are written in the background and only some of them are kept, 0 keeps all
+    async_checkpoint = True
+    keep_last_checkpoints = 3
+    keep_best_checkpoints = 1
+    best_checkpoint_metric = "segm/AP"
+    async_checkpointer_class = AsyncDetectionCheckpointer
+    # fp32, mixed, fp16 or bf16, None takes SOLVER.AMP.ENABLED of the config (mixed if it is set)
+    precision = None
+    fp32_modules = FP32_MODULES
+    # micro-batches per iteration, the data loader gives SOLVER.IMS_PER_BATCH / accumulation_steps images at a time
+    accumulation_steps = 1
+    # stop before SOLVER.MAX_ITER when the metric stops improving or the budget runs out, "" and 0 turn them off
+    early_stop_metric = ""
+    early_stop_patience = 5
+    early_stop_min_delta = 0.0
+    max_hours = 0.0
+    max_gpu_hours = 0.0
+    # time of every phase of an iteration, and iterations that waited longer than the threshold on the data loader
+    phase_timing = False
+    starvation_threshold = 0.05
+    # torch.profiler traces of the iterations [start, end) of profile_window, or on demand by signal or trigger file
+    profile_window = None
+    profile_on_demand = False
+    profile_steps = 10
+    # memory of the training process and its data loader workers, and the dataset dicts in one buffer per machine
+    memory_tracking = False
+    shared_dataset = False
+    # set by a hook (the EarlyStoppingHook) to end training after the current iteration
+    stop_requested = False
+
+    def __init__(self, cfg):
+        precision = resolve_precision(self.precision or ("mixed" if cfg.SOLVER.AMP.ENABLED else "fp32"),
+                                      cfg.MODEL.DEVICE)
+        if cfg.SOLVER.AMP.ENABLED:
+            # the MixedPrecisionTrainer takes the place of detectron2's AMPTrainer, which only runs on GPU
+            cfg = cfg.clone()
+            cfg.defrost()
+            cfg.SOLVER.AMP.ENABLED = False
+            cfg.freeze()
+        super().__init__(cfg)
+        if self.accumulation_steps > 1:
+            self._trainer = AccumulationTrainer.from_trainer(
+                self._trainer, precision, self.fp32_modules, self.accumulation_steps,
+                cfg.SOLVER.IMS_PER_BATCH // self.accumulation_steps)
+        elif precision != "fp32":
+            self._trainer = MixedPrecisionTrainer.from_trainer(self._trainer, precision, self.fp32_modules)
+
+    def train(self):
+        """
+        The loop of DefaultTrainer.train, which also ends after the iteration in which stop_requested was set. A stop
+        is not an error, so the after_train hooks run as after a normal end, at that iteration.
+        """
+        logger.info("Starting training from iteration {}".format(self.start_iter))
+        self.iter = self.start_iter
+        with EventStorage(self.start_iter) as self.storage:
+            try:
+                self.before_train()
+                for self.iter in range(self.start_iter, self.max_iter):
+                    self.before_step()
+                    self.run_step()
+                    self.after_step()
+                    if self.stop_requested:
+                        break
+                self.iter += 1
+            except Exception:
+                logger.exception("Exception during training:")
+                raise
+            finally:
+                self.after_train()
+        if len(self.cfg.TEST.EXPECTED_RESULTS) and comm.is_main_process():
+            assert hasattr(self, "_last_eval_results"), "No evaluation results obtained during training!"
+            verify_results(self.cfg, self._last_eval_results)
+            return self._last_eval_results
+
+    @classmethod
+    def build_model(cls, cfg):
+        # timed apart from the optimizer and data loader with --profile-startup
+        with profiler.phase("model_build"):
+            return super().build_model(cfg)
+
     @classmethod
     def build_evaluator(cls, cfg, dataset_name, output_folder=None):
         """
@@ -25,9 +121,28 @@ class COCOTrainer(DefaultTrainer):
         """
         if output_folder is None:
             output_folder = os.path.join(cfg.OUTPUT_DIR, "training_eval")
+        if cls.streaming_eval:
+            tasks = ("bbox", "segm") if cfg.MODEL.MASK_ON else ("bbox",)
+            return StreamingCOCOEvaluator(dataset_name, tasks=tasks, output_dir=output_folder,
+                                          stream_predictions=cls.stream_predictions)
         return COCOEvaluator(dataset_name, output_dir=output_folder)
 
+    def use_async_checkpointer(self):
+        """
+        Replaces the checkpointer by the asynchronous one with a retention policy, before the hooks get it.
+
+        @return: hooks that go with it
+        """
+        if not self.async_checkpoint:
+            return []
+        retention = CheckpointRetention(self.keep_last_checkpoints, self.keep_best_checkpoints,
+                                        self.best_checkpoint_metric)
+        self.checkpointer = self.async_checkpointer_class(self.model, self.cfg.OUTPUT_DIR, retention=retention,
+                                                          **self.checkpointer.checkpointables)
+        return [CheckpointRetentionHook(self.checkpointer)]
+
     def build_hooks(self):
+        checkpoint_hooks = self.use_async_checkpointer()
         hooks = super().build_hooks()
         cfg = self.cfg.clone()
         cfg.defrost()
@@ -40,6 +155,28 @@ class COCOTrainer(DefaultTrainer):
                 DatasetMapper(self.cfg, True)
             )
         ))
+        # after the evaluation, which gives the metric of the retention policy
+        return self.add_optional_hooks(hooks + checkpoint_hooks)
+
+    def add_optional_hooks(self, hooks):
+        """
+        Adds the hooks that are turned on from the parser to the hooks of build_hooks, which end with the evaluation
+        and checkpoint hooks.
+        """
+        if self.early_stop_metric or self.max_hours > 0 or self.max_gpu_hours > 0:
+            # after the retention hook, so it has the metric before the checkpoints are pruned
+            hooks.append(EarlyStoppingHook(
+                self.cfg.OUTPUT_DIR, metric=self.early_stop_metric, patience=self.early_stop_patience,
+                min_delta=self.early_stop_min_delta, max_hours=self.max_hours, max_gpu_hours=self.max_gpu_hours,
+                eval_period=self.cfg.TEST.EVAL_PERIOD))
+        if self.profile_window or self.profile_on_demand:
+            hooks.append(TraceCaptureHook(self.cfg.OUTPUT_DIR, window=self.profile_window, steps=self.profile_steps,
+                                          on_demand=self.profile_on_demand))
+        if self.memory_tracking:
+            hooks.append(LoaderMemoryHook())
+        if self.phase_timing:
+            # first, so it sees the start of every iteration and times all the other hooks
+            hooks.insert(0, PhaseTimingHook(self.cfg.OUTPUT_DIR, starvation_threshold=self.starvation_threshold))
         return hooks
 
     @classmethod
@@ -54,71 +191,12 @@ class COCOTrainer(DefaultTrainer):
         # account for randomly rotated images
         # more augs can be added by using this strategy
         augs = [T.RandomRotation([-60.0, 60.0])]
+        cfg = micro_batch_cfg(cfg, cls.accumulation_steps)
 
         # just use if we run RCNN training
         if "RCNN" in cfg.MODEL.META_ARCHITECTURE:
             mapper = DatasetMapper(cfg, is_train=True, augmentations=augs)
         else:
             mapper = None
-        return build_detection_train_loader(cfg, mapper=mapper)
-
-
-class AdetCOCOTrainer(COCOTrainer):
-    """
-    We use the "DefaultTrainer" which contains pre-defined default logic for
-    standard training workflow. As in "train_net", the build evaluator is implemented to do
-    evaluation at specified points (TEST.EVAL_PERIOD) during training.
-    """
-
-    foldername = ""
-
-    @staticmethod
-    def set_foldername(cls, foldername):
-        cls.foldername = foldername
-
-    # Not sure if needed, but implemented in Adet train_net
-    def resume_or_load(self, resume=True):
-        if not isinstance(self.checkpointer, AdetCheckpointer):
-            # support loading a few other backbones
-            self.checkpointer = AdetCheckpointer(
-                self.model,
-                self.cfg.OUTPUT_DIR,
-                optimizer=self.optimizer,
-                scheduler=self.scheduler,
-            )
-        super().resume_or_load(resume=resume)
-
-    @classmethod
-    def build_train_loader(cls, cfg):
-        # account for randomly rotated images
-        # more augs can be added by using this strategy
-        augs = [T.RandomRotation([-60.0, 60.0])]
-
-        if "Blend" in cfg.MODEL.META_ARCHITECTURE:
-            mapper = BlendmaskMapperWithBasis(cfg, is_train=True, augmentations=augs,
-                                              foldername=cls.foldername)
-        else:
-            mapper = None
-        return build_detection_train_loader(cfg, mapper=mapper)
-
-    # for now validation loss during training does not work
-    def build_hooks(self):
-        hooks = DefaultTrainer.build_hooks(self)
-
-        # use same augs as in build_train_loader
-        # augs = [T.RandomRotation([-60.0, 60.0])]
-        # hooks = super().build_hooks()
-        # cfg = self.cfg.clone()
-        #
-        # cfg.defrost()
-        # hooks.insert(-1, LossEvalHook(
-        #     cfg.TEST.EVAL_PERIOD,
-        #     self.model,
-        #     build_detection_test_loader(
-        #         self.cfg,
-        #         self.cfg.DATASETS.TEST[0],
-        #         BlendmaskMapperWithBasis(cfg, is_train=True, augmentations=augs,
-        #                                  foldername=self.foldername)
-        #     )
-        # ))
-        return hooks
+        dataset = shared_train_dataset(cfg) if cls.shared_dataset else None
+        return build_detection_train_loader(cfg, mapper=mapper, dataset=dataset)
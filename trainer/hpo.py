@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Local Hyperparameter Search.
+
+Runs trials of run.py as concurrent processes on this machine, with the search space, goal and metric of the
+hyperparameters section of an AI Platform config (see hpo_config.yaml). Bad trials are stopped early with asynchronous
+successive halving (ASHA): every trial first trains --min-iter iterations, and whenever a trial is in the best 1/eta
+of the trials that finished a rung, it is promoted to the next rung, eta times as many iterations. A promoted trial
+resumes from the final checkpoint of its previous rung instead of starting over. The metric is the one LossMetricWriter
+reports, read from the reported_metrics.jsonl of the trial.
+
+Everything after -- is passed to every trial. Parameters with a . in their name are config options (--opts), the
+others are arguments of run.py. To try it out on CPU, on a synthetic dataset:
+
+    PYTHONPATH=trainer:. python trainer/hpo.py --space hpo_config.yaml --synthetic 40 --min-iter 10 --max-iter 90 \
+        -- --config-file configs/mask_rcnn_R_50_FPN_3x.yaml --opts MODEL.WEIGHTS "" \
+        INPUT.MIN_SIZE_TRAIN "(256,)" INPUT.MAX_SIZE_TRAIN 256 DATALOADER.NUM_WORKERS 1
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+import yaml
+
+from data.synthetic import make_dataset
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUN = os.path.join(REPO, "trainer", "run.py")
+
+
+def load_space(path):
+    """
+    @param path: yaml with the hyperparameters of an AI Platform config, either a whole job config like
+        gcloud_config.yaml or only the hyperparameters section
+    @return: the hyperparameters section, with goal, hyperparameterMetricTag and params
+    """
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    space = config.get("trainingInput", config).get("hyperparameters", config)
+    if not space.get("params"):
+        raise ValueError("No hyperparameters params in {}".format(path))
+    return space
+
+
+def sample(params, rng):
+    """
+    @return: random value for every parameter, with the types and scales of AI Platform
+    """
+    values = {}
+    for param in params:
+        kind = param["type"]
+        if kind == "CATEGORICAL":
+            value = rng.choice(param["categoricalValues"])
+        elif kind == "DISCRETE":
+            value = rng.choice(param["discreteValues"])
+        elif kind == "INTEGER":
+            value = rng.randint(int(param["minValue"]), int(param["maxValue"]))
+        elif kind == "DOUBLE":
+            low, high = float(param["minValue"]), float(param["maxValue"])
+            if param.get("scaleType") == "UNIT_LOG_SCALE":
+                value = math.exp(rng.uniform(math.log(low), math.log(high)))
+            else:
+                value = rng.uniform(low, high)
+        else:
+            raise ValueError("Unknown type {} of {}".format(kind, param["parameterName"]))
+        values[param["parameterName"]] = value
+    return values
+
+
+class ASHA:
+    """
+    Asynchronous successive halving. The rungs are min_iter * eta^k iterations, the last one max_iter. A trial that
+    finished rung k is promoted once it is in the best 1/eta of all trials that finished rung k so far, so nothing
+    waits for a whole rung to finish. Failed trials (value None) are never promoted.
+    """
+
+    def __init__(self, min_iter, max_iter, eta=3, goal="MINIMIZE"):
+        self.rungs = []
+        iterations = min_iter
+        while iterations < max_iter:
+            self.rungs.append(iterations)
+            iterations *= eta
+        self.rungs.append(max_iter)
+        self.eta = eta
+        self.sign = 1 if goal == "MINIMIZE" else -1
+        # trial id -> metric, per rung
+        self.results = [{} for _ in self.rungs]
+        self.promoted = [set() for _ in self.rungs]
+
+    def report(self, trial_id, rung, value):
+        self.results[rung][trial_id] = value
+
+    def promotion(self):
+        """
+        @return: (trial id, rung) of the next promotion, highest rungs first, or None
+        """
+        for rung in reversed(range(len(self.rungs) - 1)):
+            finished = {trial_id: value for trial_id, value in self.results[rung].items() if value is not None}
+            ranked = sorted(finished, key=lambda trial_id: self.sign * finished[trial_id])
+            for trial_id in ranked[:len(finished) // self.eta]:
+                if trial_id not in self.promoted[rung]:
+                    self.promoted[rung].add(trial_id)
+                    return trial_id, rung + 1
+        return None
+
+
+class Trial:
+    """
+    A trial runs in a working directory of its own, so its model_output folder only holds its own run.
+    """
+
+    def __init__(self, trial_id, params, study_dir):
+        self.id = trial_id
+        self.params = params
+        self.dir = os.path.join(study_dir, "trial_{}".format(trial_id))
+        self.folder = None
+        os.makedirs(self.dir, exist_ok=True)
+
+    def command(self, iterations, args, passthrough):
+        """
+        @return: run.py command line that trains the trial up to iterations, from its last checkpoint if it has one
+        """
+        run_args, opts = split_opts(passthrough)
+        for name, value in self.params.items():
+            if "." in name:
+                opts += [name, str(value)]
+            else:
+                run_args += ["--" + name.replace("_", "-"), str(value)]
+        command = [sys.executable, RUN] + run_args + [
+            "--run-name", "hpo_trial_{}".format(self.id), "--bucket", args.bucket,
+            "--metric-sinks", "jsonl", "--report-metrics", args.metric]
+        if self.folder is not None:
+            # the final checkpoint of the previous rung, its schedule runs on to the iterations of this rung
+            command += ["--resume", "True", "--eval-name", self.folder, "--checkpoint", "final", "--iterations", "0"]
+        return command + ["--opts"] + opts + ["SOLVER.MAX_ITER", str(iterations)]
+
+    def find_folder(self):
+        outputs = os.path.join(self.dir, "model_output")
+        folders = sorted(os.listdir(outputs)) if os.path.isdir(outputs) else []
+        self.folder = folders[0] if folders else None
+        return self.folder
+
+    def read_metric(self, metric, iterations):
+        """
+        @return: last reported value of metric, or None if the trial did not report it at its last iteration
+        """
+        if self.find_folder() is None:
+            return None
+        path = os.path.join(self.dir, "model_output", self.folder, "reported_metrics.jsonl")
+        value, iteration = None, -1
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if metric in record and record["iteration"] < iterations:
+                        value, iteration = record[metric], record["iteration"]
+        return value if iteration == iterations - 1 else None
+
+
+def split_opts(arguments):
+    """
+    @return: the arguments before --opts and the config options after it
+    """
+    if "--opts" not in arguments:
+        return list(arguments), []
+    index = arguments.index("--opts")
+    return list(arguments[:index]), list(arguments[index + 1:])
+
+
+def search(args, space, passthrough):
+    """
+    Runs the trials, at most args.parallel at the same time, promotions before new trials.
+
+    @return: the trials and the ASHA with their results
+    """
+    asha = ASHA(args.min_iter, args.max_iter, args.eta, space.get("goal", "MINIMIZE"))
+    rng = random.Random(args.seed)
+    threads = max(1, (os.cpu_count() or 1) // args.parallel)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads),
+               PYTHONPATH=os.pathsep.join([os.path.join(REPO, "trainer"), REPO, os.environ.get("PYTHONPATH", "")]))
+    if args.cpu:
+        env["CUDA_VISIBLE_DEVICES"] = ""
+    print("Rungs: {} iterations".format(", ".join(str(r) for r in asha.rungs)))
+
+    trials = {}
+    running = {}
+    while True:
+        while len(running) < args.parallel:
+            job = asha.promotion()
+            if job is None:
+                if len(trials) >= args.trials:
+                    break
+                trial = Trial(len(trials), sample(space["params"], rng), args.study_dir)
+                trials[trial.id] = trial
+                job = (trial.id, 0)
+            trial_id, rung = job
+            trial = trials[trial_id]
+            log = open(os.path.join(trial.dir, "rung_{}.log".format(rung)), "w")
+            process = subprocess.Popen(trial.command(asha.rungs[rung], args, passthrough), cwd=trial.dir, env=env,
+                                       stdout=log, stderr=subprocess.STDOUT)
+            running[trial_id] = (process, log, rung, time.time())
+            print("trial {} rung {} started: {}".format(trial_id, rung, trial.params))
+        if not running:
+            break
+
+        time.sleep(args.poll)
+        for trial_id, (process, log, rung, start) in list(running.items()):
+            if process.poll() is None:
+                continue
+            log.close()
+            del running[trial_id]
+            # run.py prints errors instead of exiting with them, so a trial failed if it did not report the metric
+            value = trials[trial_id].read_metric(args.metric, asha.rungs[rung])
+            asha.report(trial_id, rung, value)
+            print("trial {} rung {} {} in {:.0f}s: {} {}".format(
+                trial_id, rung, "finished" if value is not None else "failed", time.time() - start, args.metric,
+                value))
+    return trials, asha
+
+
+def write_results(trials, asha, args):
+    """
+    Prints the trials from best to worst, highest rung first, and writes them to hpo_results.json in the study folder.
+    """
+    rows = []
+    for trial in trials.values():
+        rungs = [rung for rung in range(len(asha.rungs)) if asha.results[rung].get(trial.id) is not None]
+        rung = rungs[-1] if rungs else -1
+        value = asha.results[rung][trial.id] if rungs else None
+        rows.append({"trial": trial.id, "rung": rung, "iterations": asha.rungs[rung] if rungs else 0,
+                     args.metric: value, "params": trial.params, "folder": trial.folder})
+    rows.sort(key=lambda row: (-row["rung"], row[args.metric] is None,
+                               asha.sign * row[args.metric] if row[args.metric] is not None else 0))
+
+    with open(os.path.join(args.study_dir, "hpo_results.json"), "w") as f:
+        json.dump({"rungs": asha.rungs, "metric": args.metric, "trials": rows}, f, indent=2)
+    print("trial  iterations  {:>12}  params".format(args.metric))
+    for row in rows:
+        value = "failed" if row[args.metric] is None else "{:.4f}".format(row[args.metric])
+        print("{:5d}  {:10d}  {:>12}  {}".format(row["trial"], row["iterations"], value, json.dumps(row["params"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local hyperparameter search over run.py trials with ASHA")
+    parser.add_argument("--space", default="hpo_config.yaml", help="Config with the hyperparameters to search")
+    parser.add_argument("--study-dir", default="hpo_study", help="Working directories, logs and results of the trials")
+    parser.add_argument("--trials", type=int, default=None, help="Number of trials, default maxTrials of --space")
+    parser.add_argument("--parallel", type=int, default=None,
+                        help="Trials that run at the same time, default maxParallelTrials of --space")
+    parser.add_argument("--min-iter", type=int, default=100, help="Iterations of the first rung")
+    parser.add_argument("--max-iter", type=int, default=900, help="Iterations of the last rung")
+    parser.add_argument("--eta", type=int, default=3, help="Only the best 1/eta of a rung is promoted")
+    parser.add_argument("--bucket", default=None,
+                        help="Bucket of the trials, default a local one in the study folder (file://)")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Train on a synthetic dataset of this many images, instead of --dataset of the trials")
+    parser.add_argument("--cpu", action="store_true", help="Hide the GPUs from the trials")
+    parser.add_argument("--poll", type=float, default=2.0, help="Seconds between checks of the running trials")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("passthrough", nargs=argparse.REMAINDER, help="-- followed by the arguments of run.py")
+    args = parser.parse_args()
+
+    space = load_space(args.space)
+    args.metric = space.get("hyperparameterMetricTag", "total_loss")
+    args.trials = args.trials or int(space.get("maxTrials", 9))
+    args.parallel = args.parallel or int(space.get("maxParallelTrials", 1))
+    args.study_dir = os.path.abspath(args.study_dir)
+    os.makedirs(args.study_dir, exist_ok=True)
+    args.bucket = args.bucket or "file://" + os.path.join(args.study_dir, "bucket")
+
+    passthrough = args.passthrough[1:] if args.passthrough[:1] == ["--"] else args.passthrough
+    run_args, opts = split_opts(passthrough)
+    if args.synthetic:
+        dataset = os.path.join(args.study_dir, "dataset")
+        num_classes = make_dataset(dataset, args.synthetic)
+        run_args += ["--dataset", dataset + "/", "--num-classes", str(num_classes)]
+        args.cpu = True
+    if args.cpu:
+        # in front, so the options of the trials still win
+        opts = ["MODEL.DEVICE", "cpu"] + opts
+    passthrough = run_args + ["--opts"] + opts
+
+    trials, asha = search(args, space, passthrough)
+    write_results(trials, asha, args)
+
+
+if __name__ == "__main__":
+    main()
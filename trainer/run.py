@@ -7,152 +7,252 @@ AdelaiDet and D2Go. The argument parser is made in such a way that runs can be s
 on runtime, supporting merging, filtering and dataset selection.
 """
 
+import time
+
+# before the other imports, so --profile-startup includes them
+IMPORT_START = time.perf_counter()
+
 import os
-import subprocess
 import traceback
 
-from d2go.runner import GeneralizedRCNNRunner
-from d2go.setup import setup_after_launch
-from detectron2.config import get_cfg
-from adet.config import get_cfg as adet_cfg
+from detectron2.data import DatasetCatalog
 from detectron2.data.datasets import register_coco_instances
 from detectron2.engine import default_setup, PeriodicWriter, launch
+from detectron2.utils import comm
 
-from custom_methods import inference, load_checkpoint, get_parser, get_available_folder
-from custom_trainers import COCOTrainer, LossMetricWriter, AdetCOCOTrainer
+from custom_methods import inference, sweep, load_checkpoint, get_parser, get_available_folder, connect_to_bucket, \
+    ArtifactCache, resolve_cluster
+from custom_trainers import COCOTrainer, LossMetricWriter, build_metric_sinks, ArtifactUploader, ArtifactUploadHook, \
+    StartupProfileHook, get_architecture, profiler, scale_schedule
 from data import preprocess
 
+IMPORT_SECONDS = time.perf_counter() - IMPORT_START
 
-def setup(args):
+
+def get_base_cfg(args):
     """
-    Create configs and perform basic setups.
+    Config of the architecture, merged with the config file and command line options. This part of the setup is shared
+    with other entry points, like serve.py.
     """
-    if args.architecture.lower() == "d2go":
-        trainer = GeneralizedRCNNRunner()
-        # as cfg is grabbed from trainer in this architecture
-        cfg = trainer.get_default_cfg()
-    # adet should (as far as I've tested) also just run mask-rcnn, but I keep it separate just in case
-    elif args.architecture.lower() == "adet":
-        cfg = adet_cfg()
-        trainer = None
-    else:
-        cfg = get_cfg()
-        trainer = None
-    cfg.merge_from_file(args.config_file)
-    cfg.merge_from_list(args.opts)
+    # only the backend of the architecture that is used is imported
+    architecture = get_architecture(args.architecture)
+    with profiler.phase("config"):
+        cfg, trainer = architecture.default_cfg()
+        cfg.merge_from_file(args.config_file)
+        cfg.merge_from_list(args.opts)
 
     # ADD HYPERTUNE ARGUMENTS HERE FOR HYPERPARAMETER TUNING (for example cfg.SOLVER.learning_rate = args.lr)
+    # the batch of an iteration, with --accumulation-steps it is split in micro-batches
+    reference_batch = cfg.SOLVER.IMS_PER_BATCH
     cfg.SOLVER.IMS_PER_BATCH = int(args.batchsize)
 
     # set eval period for validation during training (epochs = MAX_ITER * BATCH_SIZE / TOTAL_NUM_IMAGES)
     cfg.TEST.EVAL_PERIOD = 500  # easy for now
 
+    # the schedule of the config file is made for its own batch
+    if args.scale_schedule:
+        scale_schedule(cfg, reference_batch)
+
     # set number of classes
     cfg.MODEL.ROI_HEADS.NUM_CLASSES = int(args.num_classes)
 
+    # mixed precision, the custom trainers take the exact precision from --precision (d2go uses its own AMP)
+    if args.precision:
+        cfg.SOLVER.AMP.ENABLED = args.precision != "fp32"
+
+    architecture.adjust_cfg(cfg, args)
+    return cfg, trainer
+
+
+def fetch_pretrained_weights(cfg, args):
+    """
+    Local copy of the model zoo weights of cfg.MODEL.WEIGHTS through the ArtifactCache, which mirrors them to the
+    bucket, so they are not downloaded from the zoo by every job. The first process of every machine downloads, the
+    others find the verified copy.
+    """
+    cache = ArtifactCache(connect_to_bucket(args.bucket), workers=args.download_workers)
+    cache_dir = os.environ.get("FVCORE_CACHE", os.path.expanduser("~/.torch/iopath_cache"))
+    if comm.get_local_rank() != 0:
+        comm.synchronize()
+    try:
+        cfg.MODEL.WEIGHTS = cache.fetch_weights(cfg.MODEL.WEIGHTS, cache_dir)
+    except Exception:
+        # detectron2 can still download them itself
+        print(traceback.format_exc())
+    if comm.get_local_rank() == 0:
+        comm.synchronize()
+
+
+def allocate_output_folder(args):
+    """
+    Output folder of a new run. It is allocated once, by the main process, and shared with the other processes of the
+    job on all machines, which would otherwise each claim a folder of their own.
+    """
+    folder = get_available_folder(args.run_name, args.bucket) if comm.is_main_process() else None
+    return comm.all_gather(folder)[0]
+
+
+def register_datasets(args, architecture):
+    """
+    Prepares and registers the train and val datasets. Preparing (filtering the annotations, the .npz files of
+    Blendmask) writes to the dataset folder of the machine, so only its first process does it while the others wait.
+    """
+    # filter and make .npz files needed for Blendmask
+    if args.filter or architecture.needs_preprocess:
+        if not args.local:
+            # no need to set this manually, as we can overwrite json in container
+            args.input = args.dataset + "train.json"
+            args.output = args.dataset + "train.json"
+            args.y = True  # set this just in case it is missed
+        if comm.get_local_rank() == 0:
+            preprocess(args)
+        comm.synchronize()
+
+    # register dataset so that it can be used train and val images can live in the same folder, as the image id's are
+    # unique so only need to define the correct .json. preprocess registers them already in the process that ran it
+    for split in ("train", "val"):
+        if "car_damage_" + split not in DatasetCatalog.list():
+            register_coco_instances("car_damage_" + split, {}, args.dataset + split + ".json", args.dataset + "images")
+
+
+def setup(args):
+    """
+    Create configs and perform basic setups.
+    """
+    cfg, trainer = get_base_cfg(args)
+
     # Ask for run name if ran locally
     if args.local:
         args.run_name = input("Give output folder a name: ")
 
-    # if a single gpu is used this needs to be set, error otherwise
-    if args.num_gpus == 1 and args.architecture.lower() == "adet":
-        cfg.MODEL.BASIS_MODULE.NORM = "BN"
-
     # checks what type of run is required and loads/sets variables accordingly
     if args.eval_only:
-        if args.checkpoint == "" or args.eval_name == "":
-            raise Exception("No checkpoint or previous run provided, please set with --eval-name and --checkpoint.")
+        if (args.checkpoint == "" and not args.checkpoints) or args.eval_name == "":
+            raise Exception("No checkpoint or previous run provided, please set with --eval-name and --checkpoint "
+                            "(or --checkpoints).")
         cfg.OUTPUT_DIR = "model_output/" + args.eval_name
     elif args.resume:
         if args.checkpoint == "":
             raise Exception("No checkpoint provided, please set with --eval-name and --checkpoint.")
         # loads checkpoint from which we continue, to be set with args.checkpoint
         cfg.OUTPUT_DIR = "model_output/" + args.eval_name
-        load_checkpoint(cfg, args)
+        with profiler.phase("checkpoint_download"):
+            load_checkpoint(cfg, args)
     elif args.reuse_weights == "True":
         if args.checkpoint == "":
             raise Exception("No checkpoint provided, please set with --eval-name and --checkpoint.")
         # load model weights from defined run
         cfg.OUTPUT_DIR = "model_output/" + args.eval_name
-        checkpoint_iteration, bucket = load_checkpoint(cfg, args)
+        with profiler.phase("checkpoint_download"):
+            checkpoint_iteration, bucket = load_checkpoint(cfg, args)
         cfg.MODEL.WEIGHTS = os.path.join(cfg.OUTPUT_DIR, "model_" + checkpoint_iteration + ".pth")
         # if hyperparameter tuning is done, the name does need to be checked and set to new output folder
-        cfg.OUTPUT_DIR = get_available_folder(args.run_name, args.bucket)
+        with profiler.phase("output_folder"):
+            cfg.OUTPUT_DIR = allocate_output_folder(args)
     else:
         # if hyperparameter tuning is done, the name does need to be checked and set to new output folder
-        cfg.OUTPUT_DIR = get_available_folder(args.run_name, args.bucket)
+        with profiler.phase("output_folder"):
+            cfg.OUTPUT_DIR = allocate_output_folder(args)
+        with profiler.phase("pretrained_weights"):
+            fetch_pretrained_weights(cfg, args)
 
     cfg.freeze()
-    default_setup(cfg, args)
+    with profiler.phase("default_setup"):
+        default_setup(cfg, args)
     return cfg, trainer
 
 
 def main(args):
+    uploader = None
     try:
+        if args.profile_startup:
+            profiler.enable(IMPORT_START)
+            profiler.record("imports", IMPORT_SECONDS)
+        architecture = get_architecture(args.architecture)
         cfg, trainer = setup(args)
 
-        # filter and make .npz files needed for Blendmask
-        if args.filter or args.architecture == "adet":
-            if not args.local:
-                # no need to set this manually, as we can overwrite json in container
-                args.input = args.dataset + "train.json"
-                args.output = args.dataset + "train.json"
-                args.y = True  # set this just in case it is missed
-            preprocess(args)
+        with profiler.phase("dataset_registration"):
+            register_datasets(args, architecture)
+
+        # evaluation mode of the custom trainers, set before they are built
+        COCOTrainer.streaming_eval = args.streaming_eval
+        COCOTrainer.stream_predictions = args.stream_predictions
+        # checkpointing of the custom trainers
+        COCOTrainer.async_checkpoint = not args.sync_checkpoint
+        COCOTrainer.keep_last_checkpoints = args.keep_last
+        COCOTrainer.keep_best_checkpoints = args.keep_best
+        COCOTrainer.best_checkpoint_metric = args.best_metric
+        COCOTrainer.precision = args.precision
+        COCOTrainer.accumulation_steps = args.accumulation_steps
+        # early stopping on a plateau of the validation metric or the compute budget
+        COCOTrainer.early_stop_metric = args.early_stop_metric
+        COCOTrainer.early_stop_patience = args.patience
+        COCOTrainer.early_stop_min_delta = args.min_delta
+        COCOTrainer.max_hours = args.max_hours
+        COCOTrainer.max_gpu_hours = args.max_gpu_hours
+        COCOTrainer.phase_timing = args.phase_timing
+        COCOTrainer.starvation_threshold = args.starvation_threshold
+        COCOTrainer.profile_window = args.profile_window
+        COCOTrainer.profile_on_demand = args.profile_on_demand
+        COCOTrainer.profile_steps = args.profile_steps
+        COCOTrainer.memory_tracking = args.memory_tracking
+        COCOTrainer.shared_dataset = args.shared_dataset
 
-        if not args.filter or args.architecture != "adet":
-            # register dataset so that it can be used train and val images can live in the same folder, as the image
-            # id's are unique so only need to define the correct .json
-            register_coco_instances("car_damage_train", {}, args.dataset + "train.json", args.dataset + "images")
-            register_coco_instances("car_damage_val", {}, args.dataset + "val.json", args.dataset + "images")
-
-        # overwrite trainer if not d2go
-        if args.architecture.lower() == "adet" and args.architecture.lower() != "d2go":
-            AdetCOCOTrainer.foldername = args.dataset.split('/')[-1] + "images"
-            trainer = AdetCOCOTrainer(cfg)
-        elif args.architecture.lower() != "d2go":
-            trainer = COCOTrainer(cfg)
-
-        # TODO: add evaluation to this
-        if args.architecture.lower() == "d2go":
-            setup_after_launch(cfg, cfg.OUTPUT_DIR, trainer)  # some d2go magic required, crash if removed
-            model = trainer.build_model(cfg)
-            return trainer.do_train(cfg, model, resume=args.resume)
-
-        # eval logic for adet and d2
+        # the d2go trainer is the runner of the config
+        with profiler.phase("trainer_build"):
+            trainer = architecture.build_trainer(cfg, args, trainer)
+
+        # eval logic for adet, d2 and d2go
         if args.eval_only:
+            profiler.report(cfg.OUTPUT_DIR, total_name="time_to_inference")
+            if args.checkpoints:
+                return sweep(cfg, args)
             return inference(cfg, args)
 
-        # include the hook that reports to CloudML Hypertune
-        writers = [LossMetricWriter()]
-        trainer.register_hooks(
-            [PeriodicWriter(writers)]
-        )
+        # the main process uploads the checkpoints, metrics and logs of the run in the background
+        if comm.is_main_process():
+            uploader = ArtifactUploader(connect_to_bucket(args.bucket), max_workers=args.transfer_workers)
+
+        if not architecture.uses_hooks:
+            if uploader is not None:
+                # no hooks in the d2go training loop, so the output folder is checked every minute
+                uploader.start_watching(cfg.OUTPUT_DIR)
+            return architecture.train(trainer, cfg, args)
+
+        # include the hook that reports to CloudML Hypertune (and other sinks), in the background
+        if comm.is_main_process():
+            writers = [LossMetricWriter(metrics=args.report_metrics,
+                                        sinks=build_metric_sinks(args.metric_sinks, cfg.OUTPUT_DIR))]
+            # the startup profile goes before the writers, so they write it with the first iteration
+            trainer.register_hooks(
+                [StartupProfileHook(cfg.OUTPUT_DIR), PeriodicWriter(writers),
+                 ArtifactUploadHook(uploader, cfg.OUTPUT_DIR)]
+            )
 
-        trainer.resume_or_load(resume=args.resume)
-        if args.resume:
-            # resume takes old settings, so add iterations that we want to run
-            cfg.defrost()
-            cfg.SOLVER.MAX_ITER += int(args.iterations)
-        return trainer.train()
+        return architecture.train(trainer, cfg, args)
     except Exception as e:
         print(traceback.format_exc())
     finally:
-        # kill map watcher at the end of model execution
-        bash_command = "pkill inotifywait"
-        subprocess.run(bash_command, shell=True)
+        # last uploads of the run, bounded so a stuck upload does not keep the job alive
+        if uploader is not None:
+            uploader.close(timeout=args.upload_timeout)
 
 
 if __name__ == "__main__":
     args = get_parser().parse_args()
 
     # start training, if eval only do not use launch because it works properly, but errors out in the end (annoying)
+    # eval only spawns its own workers with --eval-workers instead
     if args.eval_only:
         main(args)
     else:
+        # on AI Platform every machine of the job runs this, with its place in the cluster in the environment
+        resolve_cluster(args)
         launch(
             main,
             args.num_gpus,
-            dist_url="auto",
+            num_machines=args.num_machines,
+            machine_rank=args.machine_rank,
+            dist_url=args.dist_url,
             args=(args,),
         )
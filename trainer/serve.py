@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Local inference service.
+
+Loads a checkpoint once, with the same config setup as run.py, and serves predictions over HTTP. Concurrent requests
+are grouped into micro-batches within a latency budget. For example:
+
+    python trainer/serve.py --config-file ./configs/mask_rcnn_R_50_FPN_3x.yaml --eval-name run_0 \
+        --checkpoint final --port 8080 --opts MODEL.DEVICE cpu
+    curl --data-binary @image.jpg http://localhost:8080/predict
+"""
+
+import logging
+import os
+
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data.datasets import register_coco_instances
+from detectron2.utils.logger import setup_logger
+
+from custom_methods import get_parser, load_checkpoint, BatchedPredictor
+from custom_methods.serving import MicroBatcher, build_server
+from run import get_base_cfg
+
+
+def get_serve_parser():
+    parser = get_parser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--weights", default="",
+                        help="Local checkpoint to serve, instead of downloading --checkpoint of --eval-name")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Most images per forward pass")
+    parser.add_argument("--max-wait-ms", type=float, default=20.0,
+                        help="Latency budget: how long the first request of a batch waits for others")
+    parser.add_argument("--max-queue-size", type=int, default=256, help="Requests beyond this get a 503")
+    return parser
+
+
+def main(args):
+    setup_logger()
+    setup_logger(name="custom_methods")
+    cfg, _ = get_base_cfg(args)
+    if args.weights:
+        cfg.MODEL.WEIGHTS = args.weights
+    else:
+        cfg.OUTPUT_DIR = "model_output/" + args.eval_name
+        checkpoint_iteration, _ = load_checkpoint(cfg, args)
+        cfg.MODEL.WEIGHTS = os.path.join(cfg.OUTPUT_DIR, "model_" + checkpoint_iteration + ".pth")
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.score_thresh
+    cfg.freeze()
+
+    # the validation set is only loaded for the category names and ids
+    register_coco_instances("car_damage_val", {}, args.dataset + "val.json", args.dataset + "images")
+    DatasetCatalog.get("car_damage_val")
+    metadata = MetadataCatalog.get("car_damage_val")
+
+    predictor = BatchedPredictor(cfg)
+    predictor.model  # load before accepting requests
+    batcher = MicroBatcher(predictor, args.max_batch_size, args.max_wait_ms, args.max_queue_size)
+    server = build_server(batcher, metadata, args.host, args.port)
+    logging.getLogger(__name__).info("Serving {} on {}:{}".format(cfg.MODEL.WEIGHTS, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+
+
+if __name__ == "__main__":
+    main(get_serve_parser().parse_args())
@@ -0,0 +1,161 @@
+"""
+Checks and benchmarks the ArtifactCache against a local stand-in of the model zoo: an http server with Range and ETag
+support and a bandwidth cap per connection, like a CDN. Reports the download speed of one stream against parallel
+ranged requests, and checks that a current copy is not downloaded again while a changed remote file or a touched
+local copy is. The same is done for a checkpoint in the local stand-in of the bucket, and for mirroring zoo weights.
+
+    PYTHONPATH=trainer python trainer/tools/benchmark_artifact_cache.py --size-mb 64 --mbps 20 --workers 8
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from custom_methods.artifact_cache import ArtifactCache, HTTPSource
+from custom_methods.storage_backend import LocalBackend
+
+
+def build_server(root, bytes_per_second):
+    class RangeHandler(BaseHTTPRequestHandler):
+        def _headers(self, path):
+            stat = os.stat(path)
+            etag = '"{}-{}"'.format(stat.st_size, stat.st_mtime_ns)
+            return stat.st_size, etag
+
+        def do_HEAD(self):
+            path = os.path.join(root, self.path.lstrip("/"))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            size, etag = self._headers(path)
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.end_headers()
+
+        def do_GET(self):
+            path = os.path.join(root, self.path.lstrip("/"))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            size, etag = self._headers(path)
+            start, end = 0, size
+            byte_range = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            partial = byte_range is not None and (if_range is None or if_range == etag)
+            if partial:
+                first, last = byte_range.split("=")[1].split("-")
+                start, end = int(first), min(int(last) + 1, size)
+            self.send_response(206 if partial else 200)
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            if partial:
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+            self.end_headers()
+            with open(path, "rb") as file:
+                file.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    piece = file.read(min(65536, remaining))
+                    self.wfile.write(piece)
+                    remaining -= len(piece)
+                    # bandwidth cap of this connection
+                    time.sleep(len(piece) / bytes_per_second)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.daemon_threads = True
+    return server
+
+
+def md5(path):
+    with open(path, "rb") as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ArtifactCache against a local stand-in server")
+    parser.add_argument("--size-mb", type=int, default=64, help="Size of the test file")
+    parser.add_argument("--mbps", type=float, default=20.0, help="Bandwidth cap per connection in MB/s")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel range requests")
+    parser.add_argument("--chunk-mb", type=int, default=4, help="Size of a range request")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds per request of the local bucket")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="artifact_cache_")
+    try:
+        server_root = os.path.join(work_dir, "server")
+        os.makedirs(os.path.join(server_root, "zoo"))
+        remote_file = os.path.join(server_root, "zoo", "model_final.pkl")
+        with open(remote_file, "wb") as file:
+            file.write(os.urandom(args.size_mb * 1024 * 1024))
+        server = build_server(server_root, args.mbps * 1e6)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/zoo/model_final.pkl".format(server.server_address[1])
+        chunk_size = args.chunk_mb * 1024 * 1024
+
+        single = ArtifactCache(workers=1, chunk_size=args.size_mb * 1024 * 1024)
+        parallel = ArtifactCache(workers=args.workers, chunk_size=chunk_size)
+        single_path = os.path.join(work_dir, "single", "model_final.pkl")
+        parallel_path = os.path.join(work_dir, "parallel", "model_final.pkl")
+        single_seconds = timed(single.fetch_source, HTTPSource(url), single_path)
+        parallel_seconds = timed(parallel.fetch_source, HTTPSource(url), parallel_path)
+        print("http, one stream:      {:6.2f}s {:7.1f} MB/s".format(single_seconds, args.size_mb / single_seconds))
+        print("http, {:2d} range workers: {:6.2f}s {:7.1f} MB/s".format(args.workers, parallel_seconds,
+                                                                       args.size_mb / parallel_seconds))
+        assert md5(single_path) == md5(parallel_path) == md5(remote_file), "downloads differ from the remote file"
+
+        warm_seconds = timed(parallel.fetch_source, HTTPSource(url), parallel_path)
+        print("http, current copy:    {:6.2f}s (skipped)".format(warm_seconds))
+
+        with open(remote_file, "r+b") as file:
+            file.write(os.urandom(1024))
+        changed_seconds = timed(parallel.fetch_source, HTTPSource(url), parallel_path)
+        assert md5(parallel_path) == md5(remote_file), "changed remote file was not downloaded again"
+        print("http, remote changed:  {:6.2f}s (downloaded again)".format(changed_seconds))
+
+        with open(parallel_path, "r+b") as file:
+            file.write(b"corrupt")
+        touched_seconds = timed(parallel.fetch_source, HTTPSource(url), parallel_path)
+        assert md5(parallel_path) == md5(remote_file), "touched local copy was not downloaded again"
+        print("http, local touched:   {:6.2f}s (downloaded again)".format(touched_seconds))
+
+        bucket = LocalBackend(os.path.join(work_dir, "bucket"), latency=args.latency)
+        checkpoint = "model_output/run_0/model_final.pth"
+        os.makedirs(os.path.join(bucket.root, "model_output", "run_0"))
+        shutil.copyfile(remote_file, os.path.join(bucket.root, checkpoint))
+        cache = ArtifactCache(bucket, workers=args.workers, chunk_size=chunk_size)
+        local_checkpoint = os.path.join(work_dir, "local", checkpoint)
+        cold_seconds = timed(cache.fetch, checkpoint, local_checkpoint)
+        warm_seconds = timed(cache.fetch, checkpoint, local_checkpoint)
+        assert md5(local_checkpoint) == md5(remote_file)
+        print("bucket, checkpoint:    {:6.2f}s, current copy {:6.2f}s (skipped)".format(cold_seconds, warm_seconds))
+
+        zoo_dir = os.path.join(work_dir, "zoo_cache")
+        first_seconds = timed(cache.fetch_weights, url, zoo_dir)
+        shutil.rmtree(zoo_dir)
+        mirror_seconds = timed(cache.fetch_weights, url, zoo_dir)
+        print("zoo weights: {:6.2f}s from the server, {:6.2f}s from the bucket mirror".format(first_seconds,
+                                                                                             mirror_seconds))
+        server.shutdown()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
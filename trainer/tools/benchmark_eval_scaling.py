@@ -0,0 +1,52 @@
+"""
+Scaling of sharded eval-only inference on CPU: images/s with 1 up to N worker processes and the efficiency against
+perfect scaling (N times the images/s of one worker). Takes the same model arguments as run.py, plus a local
+checkpoint. Use a small val.json to keep it short.
+
+    PYTHONPATH=trainer python trainer/tools/benchmark_eval_scaling.py --config-file configs/mask_rcnn_R_50_FPN_3x.yaml \
+        --weights model_output/run_0/model_final.pth --dataset ./data/ --workers 1 2 4 --export-format jsonl
+"""
+
+import os
+import tempfile
+
+from detectron2.data.datasets import register_coco_instances
+from detectron2.utils.logger import setup_logger
+
+from custom_methods import get_parser, connect_to_bucket
+from custom_methods.sharded_inference import sharded_inference
+from run import get_base_cfg
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument("--weights", required=True, help="Local checkpoint")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4], help="Worker counts to measure")
+    args = parser.parse_args()
+    setup_logger(name="custom_methods")
+
+    register_coco_instances(args.eval_dataset, {}, args.dataset + "val.json", args.dataset + "images")
+    cfg, _ = get_base_cfg(args)
+    cfg.MODEL.WEIGHTS = args.weights
+    cfg.MODEL.DEVICE = "cpu"
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.score_thresh
+    cfg.OUTPUT_DIR = tempfile.mkdtemp(prefix="eval_scaling_")
+    cfg.freeze()
+    bucket = connect_to_bucket("file://" + os.path.join(cfg.OUTPUT_DIR, "bucket"))
+
+    results = []
+    for workers in args.workers:
+        args.eval_workers = workers
+        prediction_folder = os.path.join(cfg.OUTPUT_DIR, "predictions_{}".format(workers))
+        os.makedirs(prediction_folder, exist_ok=True)
+        results.append((workers, sharded_inference(cfg, args, prediction_folder, bucket)["images_per_second"]))
+
+    base = results[0][1] / results[0][0]
+    print("cores: {}".format(os.cpu_count()))
+    print("workers  img/s  efficiency")
+    for workers, speed in results:
+        print("{:7d} {:6.2f} {:10.0%}".format(workers, speed, speed / (workers * base)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares the eager model with its TorchScript export on CPU: startup time (building the model and loading the
+checkpoint against loading the export) and images/s on a folder of images.
+
+    PYTHONPATH=trainer python trainer/tools/benchmark_export.py --config-file configs/mask_rcnn_R_50_FPN_3x.yaml \
+        --weights model_output/run_0/model_final.pth --images data/images --num-images 20 --mode tracing
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import cv2
+import torch
+from detectron2.config import get_cfg
+
+from custom_methods.export_model import export_paths, load_or_export
+from custom_methods.inference_engine import BatchedPredictor
+
+
+def build_cfg(args):
+    if args.architecture == "adet":
+        from adet.config import get_cfg as adet_cfg
+        cfg = adet_cfg()
+    else:
+        cfg = get_cfg()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = int(args.num_classes)
+    cfg.MODEL.WEIGHTS = args.weights
+    cfg.MODEL.DEVICE = "cpu"
+    cfg.freeze()
+    return cfg
+
+
+def images_per_second(predictor, inputs, batch_size):
+    start = time.perf_counter()
+    for i in range(0, len(inputs), batch_size):
+        predictor.predict(inputs[i:i + batch_size])
+    return len(inputs) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Eager against exported model on CPU")
+    parser.add_argument("--config-file", required=True)
+    parser.add_argument("--architecture", default="")
+    parser.add_argument("--num-classes", default=7)
+    parser.add_argument("--weights", required=True, help="Local checkpoint")
+    parser.add_argument("--images", required=True, help="Folder of images to run on")
+    parser.add_argument("--num-images", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--mode", default="tracing", choices=["tracing", "scripting"])
+    parser.add_argument("--opts", default=[], nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    cfg = build_cfg(args)
+    predictor = BatchedPredictor(cfg)
+    files = sorted(glob.glob(os.path.join(args.images, "*")))[:args.num_images]
+    inputs = [predictor.preprocess(cv2.imread(file)) for file in files]
+
+    start = time.perf_counter()
+    predictor.model
+    eager_startup = time.perf_counter() - start
+    eager_speed = images_per_second(predictor, inputs, args.batch_size)
+
+    # the first call exports and saves, the second one measures loading the cached export
+    model, exported = load_or_export(cfg, args.mode, inputs[:4])
+    if not exported:
+        print("Export does not match the eager model, see the log")
+        return
+    start = time.perf_counter()
+    model, _ = load_or_export(cfg, args.mode, inputs[:4])
+    export_startup = time.perf_counter() - start
+    export_speed = images_per_second(BatchedPredictor(cfg, model=model), inputs, args.batch_size)
+
+    print("threads: {}, export at {}".format(torch.get_num_threads(), export_paths(cfg.MODEL.WEIGHTS, args.mode,
+                                                                                    "cpu")[0]))
+    print("eager:    startup {:6.2f}s {:6.2f} img/s".format(eager_startup, eager_speed))
+    print("{:9s} startup {:6.2f}s {:6.2f} img/s".format(args.mode + ":", export_startup, export_speed))
+
+
+if __name__ == "__main__":
+    main()
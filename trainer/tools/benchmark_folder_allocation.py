@@ -0,0 +1,60 @@
+"""
+Run folder allocation against the local stand-in of the bucket: a number of processes allocate a folder for the same
+run name at the same time (like hypertune trials starting together), for a growing number of existing runs. Checks
+that every process gets its own folder and reports the time per allocation, which should not grow with the number of
+existing runs. The latency argument adds a delay to every request to mimic network round trips.
+
+    PYTHONPATH=trainer python trainer/tools/benchmark_folder_allocation.py --processes 8 --existing 0 100 1000
+"""
+
+import argparse
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+from custom_methods.gcp_data_connection import RESERVATION_MARKER, get_available_folder
+from custom_methods.storage_backend import LocalBackend
+
+
+def allocate(bucket_name, run_name, start_at):
+    # all processes start at the same moment, to make the race as tight as possible
+    time.sleep(max(0.0, start_at - time.time()))
+    start = time.perf_counter()
+    folder = get_available_folder(run_name, bucket_name)
+    return folder, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent run folder allocation")
+    parser.add_argument("--processes", type=int, default=8, help="Concurrent allocations")
+    parser.add_argument("--existing", type=int, nargs='+', default=[0, 100, 1000], help="Number of existing runs")
+    parser.add_argument("--files-per-run", type=int, default=20, help="Objects in every existing run folder")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added per request of the local backend")
+    args = parser.parse_args()
+
+    for existing in args.existing:
+        root = tempfile.mkdtemp(prefix="allocation_benchmark_")
+        try:
+            backend = LocalBackend(root)
+            for run in range(existing):
+                backend.create_if_absent("model_output/trial_{}/{}".format(run, RESERVATION_MARKER), b"{}")
+                for i in range(args.files_per_run):
+                    backend.create_if_absent("model_output/trial_{}/events_{}".format(run, i), b"")
+
+            bucket_name = "file://{}?latency={}".format(root, args.latency)
+            start_at = time.time() + 1.0
+            with multiprocessing.Pool(args.processes) as pool:
+                results = pool.starmap(allocate, [(bucket_name, "trial", start_at)] * args.processes)
+            folders = [folder for folder, _ in results]
+            seconds = sorted(seconds for _, seconds in results)
+            unique = len(set(folders)) == len(folders)
+            print("{:5d} existing runs: {} folders, {}, {:.3f}s median and {:.3f}s max per allocation".format(
+                existing, len(folders), "all unique" if unique else "DUPLICATES", seconds[len(seconds) // 2],
+                seconds[-1]))
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Memory of the data loader workers of the trainer of --architecture (COCOTrainer for detectron2, AdetCOCOTrainer for
+adet), with the dataset dicts of detectron2 (serialized in every training process) against the shared buffer of
+--shared-dataset, one per machine. Takes the same arguments as run.py, every mode runs in a process of its own.
+Reports the USS (pages only that process has) and PSS (shared pages divided over the processes) per worker after the
+first and the last batches, so growth of the USS of a worker is copy-on-write of what it got from the training
+process. With --synthetic it makes a dataset of that many images, with --polygon-points points per polygon to give
+the annotations a realistic payload.
+
+    PYTHONPATH=trainer:. python trainer/tools/benchmark_loader_memory.py \
+        --config-file configs/mask_rcnn_R_50_FPN_3x.yaml --synthetic 2000 --polygon-points 200 --workers 4 \
+        --batches 300 --opts MODEL.DEVICE cpu
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from custom_methods import get_parser
+from custom_trainers import COCOTrainer, get_architecture, loader_memory
+from data.synthetic import make_dataset
+from run import get_base_cfg, register_datasets
+
+
+def densify_polygons(dataset, points):
+    """
+    Resamples every polygon of the train.json of dataset to points points, like the outlines of real damage.
+    """
+    path = os.path.join(dataset, "train.json")
+    with open(path) as f:
+        coco = json.load(f)
+    for annotation in coco["annotations"]:
+        x, y, w, h = annotation["bbox"]
+        polygon = []
+        for i in range(points):
+            # around the edge of the box
+            t = 4.0 * i / points
+            side, f = int(t), t - int(t)
+            polygon += [[x + f * w, y], [x + w, y + f * h], [x + w - f * w, y + h], [x, y + h - f * h]][side]
+        annotation["segmentation"] = [polygon]
+    with open(path, "w") as f:
+        json.dump(coco, f)
+
+
+def measure(args):
+    architecture = get_architecture(args.architecture)
+    if not architecture.uses_hooks:
+        raise ValueError("{} builds its own data loader, only the custom trainers are measured".format(
+            architecture.name))
+    register_datasets(args, architecture)
+    cfg, _ = get_base_cfg(args)
+    cfg.OUTPUT_DIR = tempfile.mkdtemp(prefix="loader_memory_")
+    cfg.DATALOADER.NUM_WORKERS = args.workers
+    cfg.freeze()
+    # the trainer class of the architecture, without building the model
+    trainer_class = COCOTrainer
+    if architecture.name == "adet":
+        from custom_trainers import AdetCOCOTrainer
+        trainer_class = AdetCOCOTrainer
+        trainer_class.foldername = args.dataset.split('/')[-1] + "images"
+    trainer_class.shared_dataset = args.single == "shared"
+
+    loader = trainer_class.build_train_loader(cfg)
+    samples = []
+    for i, _ in enumerate(loader):
+        if i + 1 in (args.warmup, args.batches):
+            samples.append(loader_memory())
+        if i + 1 >= args.batches:
+            break
+    first, last = samples[0], samples[-1]
+    return {"mode": args.single, "workers": last["workers"], "main_uss_mb": last["main_uss_mb"],
+            "worker_uss_mb": last["worker_uss_mb"], "worker_uss_max_mb": last["worker_uss_max_mb"],
+            "worker_pss_mb": last["worker_pss_mb"], "total_pss_mb": last["total_pss_mb"],
+            "worker_uss_growth_mb": last["worker_uss_mb"] - first["worker_uss_mb"]}
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument("--modes", nargs='+', default=["default", "shared"], choices=["default", "shared"],
+                        help="Storage of the dataset dicts to compare")
+    parser.add_argument("--workers", type=int, default=4, help="Data loader workers")
+    parser.add_argument("--batches", type=int, default=200, help="Batches that are loaded")
+    parser.add_argument("--warmup", type=int, default=10, help="Batch after which the first sample is taken")
+    parser.add_argument("--synthetic", type=int, default=0, help="Make a synthetic dataset of this many images")
+    parser.add_argument("--polygon-points", type=int, default=0,
+                        help="Points per polygon of the synthetic annotations, 0 keeps the rectangles")
+    parser.add_argument("--single", default=None, help="Measure only this mode, in this process")
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(measure(args)))
+        return
+
+    extra = []
+    if args.synthetic:
+        dataset = tempfile.mkdtemp(prefix="loader_memory_data_")
+        num_classes = make_dataset(dataset, args.synthetic)
+        if args.polygon_points:
+            densify_polygons(dataset, args.polygon_points)
+        extra = ["--dataset", dataset + "/", "--num-classes", str(num_classes)]
+
+    results = []
+    for mode in args.modes:
+        # --opts takes the rest of the command line, so --single goes in front
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--single", mode] + extra + sys.argv[1:],
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print("architecture: {}, workers: {}, batches: {}".format(args.architecture or "detectron2", args.workers,
+                                                               args.batches))
+    print("mode      main USS  worker USS  worker max  worker PSS  USS growth  total PSS")
+    for result in results:
+        print("{:<8} {:9.1f} {:11.1f} {:11.1f} {:11.1f} {:11.1f} {:10.1f}".format(
+            result["mode"], result["main_uss_mb"], result["worker_uss_mb"], result["worker_uss_max_mb"],
+            result["worker_pss_mb"], result["worker_uss_growth_mb"], result["total_pss_mb"]))
+
+
+if __name__ == "__main__":
+    main()
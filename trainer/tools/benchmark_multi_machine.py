@@ -0,0 +1,127 @@
+"""
+Simulates multi-machine training on one Linux box: every "machine" is a run.py process group on CPU (gloo), with its
+own working directory and copy of a synthetic dataset, and a CLUSTER_SPEC like AI Platform gives it. Reports the
+iterations/s and images/s for every number of machines, with the same batch per process (weak scaling), and the
+efficiency against perfect scaling.
+
+    PYTHONPATH=trainer:. python trainer/tools/benchmark_multi_machine.py --machines 1 2 4 --procs-per-machine 1 \
+        --iterations 30
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from data.synthetic import make_dataset
+
+REPO = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cluster_spec(num_machines, machine_rank, port):
+    cluster = {"master": ["127.0.0.1:{}".format(port)]}
+    if num_machines > 1:
+        cluster["worker"] = ["127.0.0.1:{}".format(port)] * (num_machines - 1)
+    task = {"type": "master", "index": 0} if machine_rank == 0 else {"type": "worker", "index": machine_rank - 1}
+    return json.dumps({"cluster": cluster, "task": task})
+
+
+def run(work_dir, dataset, num_classes, num_machines, args):
+    """
+    Starts num_machines machines and waits for them.
+
+    @return: median seconds per iteration after warmup
+    """
+    port = free_port()
+    run_name = "scaling_{}".format(num_machines)
+    threads = max(1, (os.cpu_count() or 1) // (num_machines * args.procs_per_machine))
+    processes = []
+    for machine_rank in range(num_machines):
+        machine_dir = os.path.join(work_dir, "{}_machine_{}".format(run_name, machine_rank))
+        # every machine has its own copy of the data, like after the download of train_entrypoint.sh
+        shutil.copytree(dataset, os.path.join(machine_dir, "data"))
+        env = dict(os.environ, CLUSTER_SPEC=cluster_spec(num_machines, machine_rank, port), CUDA_VISIBLE_DEVICES="",
+                   OMP_NUM_THREADS=str(threads), PYTHONPATH=os.path.join(REPO, "trainer") + os.pathsep + REPO)
+        command = [sys.executable, os.path.join(REPO, "trainer", "run.py"),
+                   "--config-file", os.path.join(REPO, args.config_file),
+                   "--run-name", run_name, "--bucket", "file://" + os.path.join(work_dir, "bucket"),
+                   "--dataset", "./data/", "--num-classes", str(num_classes), "--num-gpus", str(args.procs_per_machine),
+                   "--batchsize", str(args.batch_per_proc * num_machines * args.procs_per_machine),
+                   "--metric-sinks", "jsonl", "--sync-checkpoint",
+                   "--opts", "MODEL.DEVICE", "cpu", "MODEL.WEIGHTS", "", "SOLVER.MAX_ITER", str(args.iterations),
+                   "SOLVER.CHECKPOINT_PERIOD", "100000", "DATALOADER.NUM_WORKERS", "1",
+                   "INPUT.MIN_SIZE_TRAIN", "(256,)", "INPUT.MAX_SIZE_TRAIN", "256",
+                   "INPUT.MIN_SIZE_TEST", "256", "INPUT.MAX_SIZE_TEST", "256"]
+        log = open(os.path.join(work_dir, "{}_machine_{}.log".format(run_name, machine_rank)), "w")
+        processes.append((subprocess.Popen(command, cwd=machine_dir, env=env, stdout=log, stderr=subprocess.STDOUT),
+                          log))
+    for process, log in processes:
+        process.wait()
+        log.close()
+
+    # metrics.json is written by the main process, on machine 0
+    metrics = os.path.join(work_dir, "{}_machine_0".format(run_name), "model_output", run_name + "_0", "metrics.json")
+    if not os.path.isfile(metrics):
+        raise RuntimeError("No metrics of {} machines, see the logs in {}".format(num_machines, work_dir))
+    times = []
+    with open(metrics) as f:
+        for line in f:
+            record = json.loads(line)
+            if "time" in record and record.get("iteration", 0) >= args.warmup:
+                times.append(record["time"])
+    if not times:
+        raise RuntimeError("No iteration times after warmup, increase --iterations")
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated multi-machine training on CPU")
+    parser.add_argument("--machines", type=int, nargs='+', default=[1, 2, 4], help="Numbers of machines to measure")
+    parser.add_argument("--procs-per-machine", type=int, default=1, help="Training processes per machine")
+    parser.add_argument("--batch-per-proc", type=int, default=1, help="Images per process per iteration")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=10, help="Iterations that are not measured")
+    parser.add_argument("--num-images", type=int, default=40, help="Images of the synthetic dataset")
+    parser.add_argument("--config-file", default="configs/mask_rcnn_R_50_FPN_3x.yaml")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory with the logs")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="multi_machine_")
+    try:
+        dataset = os.path.join(work_dir, "dataset")
+        num_classes = make_dataset(dataset, args.num_images)
+        results = []
+        for num_machines in args.machines:
+            seconds = run(work_dir, dataset, num_classes, num_machines, args)
+            results.append((num_machines, seconds))
+            print("{} machines: {:.3f}s per iteration".format(num_machines, seconds))
+
+        # with the same batch per process, perfect scaling keeps the time per iteration of the first measurement
+        base_seconds = results[0][1]
+        print("cores: {}, processes per machine: {}, images per process: {}".format(
+            os.cpu_count(), args.procs_per_machine, args.batch_per_proc))
+        print("machines   it/s  images/s  efficiency")
+        for num_machines, seconds in results:
+            images = args.batch_per_proc * num_machines * args.procs_per_machine
+            print("{:8d} {:6.2f} {:9.2f} {:11.0%}".format(num_machines, 1 / seconds, images / seconds,
+                                                          base_seconds / seconds))
+    finally:
+        if args.keep:
+            print("Logs and outputs in {}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Training throughput and memory of fp32 against mixed precision, with the trainer of --architecture on car_damage_train
+of --dataset. Takes the same arguments as run.py. Every precision runs in a process of its own, so its peak memory is
+its own: torch.cuda.max_memory_allocated on GPU, the peak resident memory of the process on CPU.
+
+    PYTHONPATH=trainer python trainer/tools/benchmark_precision.py --config-file configs/mask_rcnn_R_50_FPN_3x.yaml \
+        --dataset ./data/ --precisions fp32 mixed --steps 20 --opts MODEL.DEVICE cpu
+
+mixed on CPU is bf16 autocast, which needs torch 1.10 or later. With the pinned torch 1.9 compare on a GPU.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+from detectron2.data.datasets import register_coco_instances
+from detectron2.utils.events import EventStorage
+
+from custom_methods import get_parser
+from custom_trainers import COCOTrainer, get_architecture
+from run import get_base_cfg
+
+
+def measure(args):
+    register_coco_instances("car_damage_train", {}, args.dataset + "train.json", args.dataset + "images")
+    register_coco_instances("car_damage_val", {}, args.dataset + "val.json", args.dataset + "images")
+    args.precision = args.single
+    cfg, _ = get_base_cfg(args)
+    cfg.OUTPUT_DIR = tempfile.mkdtemp(prefix="precision_")
+    cfg.freeze()
+    architecture = get_architecture(args.architecture)
+    if not architecture.uses_hooks:
+        raise ValueError("{} trains with its own loop, only the custom trainers are measured".format(architecture.name))
+    COCOTrainer.precision = args.single
+    COCOTrainer.async_checkpoint = False
+    trainer = architecture.build_trainer(cfg, args, None)
+    cuda = cfg.MODEL.DEVICE.startswith("cuda")
+
+    with EventStorage(0) as storage:
+        for i in range(args.warmup + args.steps):
+            if i == args.warmup:
+                if cuda:
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats()
+                start = time.perf_counter()
+            storage.iter = i
+            trainer._trainer.iter = i
+            trainer._trainer.run_step()
+        if cuda:
+            torch.cuda.synchronize()
+        seconds = time.perf_counter() - start
+        loss = storage.history("total_loss").latest()
+
+    if cuda:
+        peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        # kilobytes on linux
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"precision": getattr(trainer._trainer, "precision", "fp32"), "iterations_per_second": args.steps / seconds,
+            "images_per_second": args.steps * cfg.SOLVER.IMS_PER_BATCH / seconds, "peak_memory_mb": peak_mb,
+            "total_loss": loss}
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument("--precisions", nargs='+', default=["fp32", "mixed"], help="Precisions to compare")
+    parser.add_argument("--steps", type=int, default=20, help="Measured training steps")
+    parser.add_argument("--warmup", type=int, default=5, help="Steps before measuring")
+    parser.add_argument("--single", default=None, help="Measure only this precision, in this process")
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(measure(args)))
+        return
+
+    results = []
+    for precision in args.precisions:
+        # --opts takes the rest of the command line, so --single goes in front
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--single", precision] + sys.argv[1:],
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    base = results[0]
+    print("precision   it/s  images/s  peak MB  speedup  memory  loss")
+    for result in results:
+        print("{:<9} {:6.2f} {:9.2f} {:8.0f} {:7.2f}x {:6.0%} {:6.3f}".format(
+            result["precision"], result["iterations_per_second"], result["images_per_second"],
+            result["peak_memory_mb"], result["iterations_per_second"] / base["iterations_per_second"],
+            result["peak_memory_mb"] / base["peak_memory_mb"], result["total_loss"]))
+
+
+if __name__ == "__main__":
+    main()
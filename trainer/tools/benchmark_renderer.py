@@ -0,0 +1,80 @@
+"""
+Times the OpenCV renderer against detectron2's Visualizer (ColorMode.IMAGE_BW) per image, on a given image or a
+synthetic one, with a number of synthetic instances. Also prints the mean absolute pixel difference between the two
+outputs, as a rough check that they look the same.
+
+    PYTHONPATH=trainer python trainer/tools/benchmark_renderer.py --image data/images/some_image.jpg --instances 10
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+import torch
+from detectron2.data import MetadataCatalog
+from detectron2.structures import Boxes, Instances
+
+from custom_methods.inference import render_prediction
+
+
+def synthetic_instances(height, width, num_instances, num_classes, seed=0):
+    """
+    Instances with random elliptical masks and their bounding boxes.
+    """
+    rng = np.random.RandomState(seed)
+    masks = np.zeros((num_instances, height, width), dtype=np.uint8)
+    for mask in masks:
+        center = (int(rng.randint(0, width)), int(rng.randint(0, height)))
+        axes = (int(rng.randint(10, width // 4)), int(rng.randint(10, height // 4)))
+        cv2.ellipse(mask, center, axes, float(rng.randint(0, 180)), 0, 360, 1, -1)
+    masks = masks.astype(bool)
+
+    boxes = []
+    for mask in masks:
+        ys, xs = np.nonzero(mask)
+        boxes.append([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1] if len(xs) else [0, 0, 1, 1])
+
+    instances = Instances((height, width))
+    instances.pred_boxes = Boxes(torch.as_tensor(boxes, dtype=torch.float32))
+    instances.scores = torch.as_tensor(rng.uniform(0.7, 1.0, num_instances), dtype=torch.float32)
+    instances.pred_classes = torch.as_tensor(rng.randint(0, num_classes, num_instances), dtype=torch.int64)
+    instances.pred_masks = torch.as_tensor(masks)
+    return instances
+
+
+def time_renderer(image, instances, metadata, renderer, repeats):
+    render_prediction(image, instances, metadata, renderer)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        output = render_prediction(image, instances, metadata, renderer)
+    return (time.perf_counter() - start) / repeats, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per image timing of the prediction renderers")
+    parser.add_argument("--image", default="", help="Image to draw on, a random 1024x768 image if not given")
+    parser.add_argument("--instances", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.image:
+        image = cv2.imread(args.image)
+    else:
+        image = np.random.RandomState(0).randint(0, 256, (768, 1024, 3)).astype(np.uint8)
+    metadata = MetadataCatalog.get("renderer_benchmark")
+    metadata.set(thing_classes=["dent", "scratch", "rust", "shatter", "crack", "other", "missing"])
+    instances = synthetic_instances(image.shape[0], image.shape[1], args.instances, len(metadata.thing_classes))
+
+    fast_time, fast_output = time_renderer(image, instances, metadata, "fast", args.repeats)
+    visualizer_time, visualizer_output = time_renderer(image, instances, metadata, "visualizer", args.repeats)
+    print("fast:       {:8.1f} ms/img".format(fast_time * 1000))
+    print("visualizer: {:8.1f} ms/img".format(visualizer_time * 1000))
+    print("speedup:    {:8.1f}x".format(visualizer_time / fast_time))
+    if fast_output.shape == visualizer_output.shape:
+        difference = np.abs(fast_output.astype(np.float32) - visualizer_output.astype(np.float32)).mean()
+        print("mean absolute pixel difference: {:.1f}".format(difference))
+
+
+if __name__ == "__main__":
+    main()
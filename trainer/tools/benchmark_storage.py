@@ -0,0 +1,61 @@
+"""
+Benchmarks bulk uploads through the TransferPool for a number of pool sizes, against the local stand-in of the
+bucket by default. The latency argument adds a delay to every request to mimic network round trips.
+
+Run from the root of the repository, with the trainer folder on the python path:
+
+    PYTHONPATH=trainer python trainer/tools/benchmark_storage.py --num-files 200 --latency 0.05
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from custom_methods.storage_backend import LocalBackend, TransferPool, get_backend
+
+
+def benchmark(backend, local_files, pool_sizes, remote_prefix):
+    total_bytes = sum(os.path.getsize(path) for path in local_files)
+    results = []
+    for pool_size in pool_sizes:
+        start = time.perf_counter()
+        with TransferPool(backend, max_workers=pool_size) as transfers:
+            for path in local_files:
+                transfers.upload(path, "{}/pool_{}/{}".format(remote_prefix, pool_size, os.path.basename(path)))
+        seconds = time.perf_counter() - start
+        results.append((pool_size, len(local_files) / seconds, total_bytes / seconds / 1e6))
+        print("pool size {:3d}: {:8.1f} files/s {:8.2f} MB/s".format(*results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk upload throughput per transfer pool size")
+    parser.add_argument("--bucket", default="", help="Bucket to upload to, by default a temporary local folder")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added per request of the local backend")
+    parser.add_argument("--num-files", type=int, default=200)
+    parser.add_argument("--file-size", type=int, default=100000, help="Size of every file in bytes")
+    parser.add_argument("--pool-sizes", type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="storage_benchmark_")
+    try:
+        local_files = []
+        for i in range(args.num_files):
+            path = os.path.join(work_dir, "file_{:05d}.bin".format(i))
+            with open(path, "wb") as file:
+                file.write(os.urandom(args.file_size))
+            local_files.append(path)
+
+        if args.bucket:
+            backend = get_backend(args.bucket)
+        else:
+            backend = LocalBackend(os.path.join(work_dir, "bucket"), latency=args.latency)
+        benchmark(backend, local_files, args.pool_sizes, "benchmark/storage")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
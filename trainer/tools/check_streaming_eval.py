@@ -0,0 +1,124 @@
+"""
+Checks the StreamingCOCOEvaluator against detectron2's COCOEvaluator on a synthetic dataset, with predictions made from
+the ground truth: shifted boxes with their masks and random scores, missed objects and false positives. The areas in
+the json are changed by up to 30%, so they differ from the mask areas like those of annotation tools do, and the area
+ranges (APs, APm and APl) only match if both evaluators take the areas of the json. Exits with an error if an AP
+differs more than --tolerance.
+
+    PYTHONPATH=trainer:. python trainer/tools/check_streaming_eval.py --images 200
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+from detectron2.data import DatasetCatalog
+from detectron2.data.datasets import register_coco_instances
+from detectron2.evaluation import COCOEvaluator
+from detectron2.structures import BoxMode, Boxes, Instances
+
+from custom_trainers import StreamingCOCOEvaluator
+from data.synthetic import make_dataset
+
+DATASET_NAME = "streaming_check_val"
+TASKS = ("bbox", "segm")
+
+
+def perturb_areas(json_file, rng, spread=0.3):
+    """
+    Scales the area of every annotation in json_file by a random factor in [1 - spread, 1 + spread].
+    """
+    with open(json_file) as f:
+        coco = json.load(f)
+    for annotation in coco["annotations"]:
+        annotation["area"] = annotation["area"] * rng.uniform(1 - spread, 1 + spread)
+    with open(json_file, "w") as f:
+        json.dump(coco, f)
+
+
+def fake_output(record, rng, num_classes):
+    """
+    @return: model output for record, the ground truth shifted by up to 20% of its size with some objects left out and
+        some false positives added, with box shaped masks
+    """
+    height, width = record["height"], record["width"]
+    boxes, classes, scores = [], [], []
+    for annotation in record["annotations"]:
+        if rng.rand() < 0.1:
+            continue
+        x, y, w, h = BoxMode.convert(annotation["bbox"], annotation["bbox_mode"], BoxMode.XYWH_ABS)
+        dx, dy = rng.uniform(-0.2, 0.2, size=2) * (w, h)
+        boxes.append([x + dx, y + dy, x + dx + w, y + dy + h])
+        classes.append(annotation["category_id"])
+        scores.append(rng.uniform(0.3, 1.0))
+    for _ in range(rng.randint(0, 3)):
+        x, y = rng.uniform(0, width - 40), rng.uniform(0, height - 40)
+        w, h = rng.uniform(20, 40, size=2)
+        boxes.append([x, y, x + w, y + h])
+        classes.append(rng.randint(num_classes))
+        scores.append(rng.uniform(0.05, 0.8))
+
+    boxes = np.clip(np.asarray(boxes, dtype=np.float32).reshape(-1, 4), 0, [width, height, width, height])
+    masks = np.zeros((len(boxes), height, width), dtype=bool)
+    for mask, (x0, y0, x1, y1) in zip(masks, np.round(boxes).astype(np.int64)):
+        mask[y0:y1, x0:x1] = True
+
+    instances = Instances((height, width))
+    instances.pred_boxes = Boxes(torch.as_tensor(boxes))
+    instances.scores = torch.as_tensor(scores, dtype=torch.float32)
+    instances.pred_classes = torch.as_tensor(classes, dtype=torch.int64)
+    instances.pred_masks = torch.as_tensor(masks)
+    return {"instances": instances}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the StreamingCOCOEvaluator with the COCOEvaluator")
+    parser.add_argument("--images", type=int, default=200, help="Images of the synthetic dataset, a fifth is val")
+    parser.add_argument("--score-bins", type=int, default=1000, help="Score bins of the StreamingCOCOEvaluator")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Largest allowed difference of an AP, in points")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    dataset = tempfile.mkdtemp(prefix="streaming_check_")
+    num_classes = make_dataset(dataset, args.images, seed=args.seed)
+    json_file = os.path.join(dataset, "val.json")
+    perturb_areas(json_file, rng)
+    register_coco_instances(DATASET_NAME, {}, json_file, os.path.join(dataset, "images"))
+
+    records = DatasetCatalog.get(DATASET_NAME)
+    outputs = [fake_output(record, rng, num_classes) for record in records]
+    evaluators = [("COCOEvaluator", COCOEvaluator(DATASET_NAME, tasks=TASKS)),
+                  ("StreamingCOCOEvaluator", StreamingCOCOEvaluator(DATASET_NAME, tasks=TASKS,
+                                                                    score_bins=args.score_bins))]
+    results = {}
+    for name, evaluator in evaluators:
+        evaluator.reset()
+        for record, output in zip(records, outputs):
+            evaluator.process([{"image_id": record["image_id"]}], [output])
+        results[name] = evaluator.evaluate()
+
+    worst = 0.0
+    print("task  metric        COCOEvaluator  streaming  difference")
+    for task in TASKS:
+        for key, expected in results["COCOEvaluator"][task].items():
+            value = results["StreamingCOCOEvaluator"][task][key]
+            difference = abs(value - expected)
+            if math.isnan(expected) != math.isnan(value):
+                difference = float("inf")
+            elif math.isnan(expected):
+                difference = 0.0
+            worst = max(worst, difference)
+            print("{:<5} {:<13} {:13.3f} {:10.3f} {:11.3f}".format(task, key, expected, value, difference))
+    print("largest difference {:.3f} AP points, tolerance {:.3f}".format(worst, args.tolerance))
+    if worst > args.tolerance:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
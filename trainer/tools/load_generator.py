@@ -0,0 +1,84 @@
+"""
+Load generator for serve.py. Sends images from a folder with a number of concurrent clients and reports the client
+side latency percentiles and throughput, next to the stats of the server itself.
+
+    PYTHONPATH=trainer python trainer/tools/load_generator.py --url http://localhost:8080 --images data/images \
+        --concurrency 1 4 16 --requests 200
+"""
+
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+import urllib.request
+from urllib.error import HTTPError
+
+from custom_methods.serving import percentile
+
+
+def run_load(url, payloads, concurrency, num_requests):
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(num_requests))
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            request = urllib.request.Request(url + "/predict", data=payloads[i % len(payloads)], method="POST")
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            except HTTPError as e:
+                with lock:
+                    errors.append(e.code)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests_per_second": len(latencies) / seconds,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the inference service")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--images", required=True, help="Folder with images to send")
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per concurrency level")
+    args = parser.parse_args()
+
+    payloads = []
+    for file in sorted(glob.glob(os.path.join(args.images, "*"))):
+        with open(file, "rb") as image_file:
+            payloads.append(image_file.read())
+    if not payloads:
+        raise ValueError("No images found in " + args.images)
+
+    for concurrency in args.concurrency:
+        result = run_load(args.url, payloads, concurrency, args.requests)
+        print("concurrency {concurrency:3d}: {requests_per_second:7.2f} req/s, p50 {p50_ms:7.1f} ms, "
+              "p90 {p90_ms:7.1f} ms, p99 {p99_ms:7.1f} ms, {errors} errors".format(**result))
+        with urllib.request.urlopen(args.url + "/stats") as response:
+            print("  server: " + json.dumps(json.loads(response.read())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Renders images from predictions that were exported with --export-format jsonl, so the eval job itself does not have
+to render every image.
+
+Run from the root of the repository, with the trainer folder on the python path:
+
+    PYTHONPATH=trainer python trainer/tools/render_predictions.py \
+        --predictions model_output/run_0/predictions0009999/predictions.jsonl \
+        --dataset-json data/val.json --images data/images --output rendered --fraction 0.1
+"""
+
+import argparse
+import json
+import os
+
+import cv2
+from detectron2.data import MetadataCatalog
+
+from custom_methods.inference import render_prediction
+from custom_methods.prediction_export import read_predictions, line_to_instances, should_render
+
+
+def build_metadata(dataset_json, name="rendered_predictions"):
+    """
+    Metadata with the category names and id mapping of the dataset json, as register_coco_instances would set.
+    """
+    with open(dataset_json) as file:
+        categories = sorted(json.load(file)["categories"], key=lambda category: category["id"])
+    metadata = MetadataCatalog.get(name)
+    metadata.set(
+        thing_classes=[category["name"] for category in categories],
+        thing_dataset_id_to_contiguous_id={category["id"]: i for i, category in enumerate(categories)},
+    )
+    return metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render exported predictions")
+    parser.add_argument("--predictions", required=True, help="predictions.jsonl written by the eval job")
+    parser.add_argument("--dataset-json", required=True, help="COCO json of the evaluated set, for category names")
+    parser.add_argument("--images", default="", help="Folder with the images, if not at the exported file names")
+    parser.add_argument("--output", required=True, help="Folder to write the rendered images to")
+    parser.add_argument("--fraction", type=float, default=1.0, help="Part of the images to render")
+    parser.add_argument("--renderer", default="fast", choices=["fast", "visualizer"])
+    args = parser.parse_args()
+
+    metadata = build_metadata(args.dataset_json)
+    os.makedirs(args.output, exist_ok=True)
+    rendered = 0
+    for line in read_predictions(args.predictions):
+        if not should_render(line["image_id"], args.fraction):
+            continue
+        file_name = line["file_name"]
+        if args.images:
+            file_name = os.path.join(args.images, os.path.basename(file_name))
+        im = cv2.imread(file_name)
+        if im is None:
+            print("Could not read {}, skipping".format(file_name))
+            continue
+
+        instances = line_to_instances(line, metadata.thing_dataset_id_to_contiguous_id)
+        image_id = os.path.splitext(os.path.basename(file_name))[0]
+        rendered_image = render_prediction(im, instances, metadata, args.renderer)
+        cv2.imwrite(os.path.join(args.output, image_id + "_pred.jpeg"), rendered_image)
+        rendered += 1
+    print("Rendered {} images to {}".format(rendered, args.output))
+
+
+if __name__ == "__main__":
+    main()